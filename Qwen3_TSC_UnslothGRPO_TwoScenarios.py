@@ -69,6 +69,11 @@ if FORCE_REGEN or not os.path.isdir(DATASET_PATH):
 else:
     print(f"✓ Dataset 已存在: {DATASET_PATH}")
 
+# 可选：离线预计算 reward 表（训练时 tsc_reward_sim_fn 查表，不再启动 SUMO）
+if os.getenv("PRECOMPUTE_REWARD_TABLE", "").strip() == "1":
+    from precompute_reward_table import main as precompute_main
+    precompute_main(dataset_dir=DATASET_PATH, num_workers=CONFIG.get("num_workers", 16))
+
 # %% [markdown]
 # ## 1.8 Generate Synthetic SFT Dataset
 # 
@@ -570,6 +575,10 @@ from tsc_reward_function import (
     cleanup_global_pool,
     reward_diag_snapshot,
     reward_diag_last,   
+    format_stage_lines,
+    format_resource_lines,
+    record_train_metrics,
+    start_metrics_exporter,
 )
 from transformers import TrainerCallback
 
@@ -583,6 +592,7 @@ class RewardDiagnosticsCallback(TrainerCallback):
             return
         if not getattr(state, "is_world_process_zero", True):
             return
+        record_train_metrics(state.global_step, logs)
 
         # Periodic window summary (aligned to logging)
         if getattr(args, "logging_steps", None) and state.global_step % int(args.logging_steps) == 0:
@@ -608,6 +618,12 @@ class RewardDiagnosticsCallback(TrainerCallback):
                     f"[reward_diag]  - {task}: invalid_rate={t_rate:.3f} "
                     f"({t_invalid}/{t_total}) top={top_str}"
                 )
+            # worker 各阶段耗时 p50/p95（按场景/任务类型）
+            for line in format_stage_lines(snap.get("stage_profile") or {}):
+                print(line)
+            # worker / SUMO 内存与 CPU、本步 worker 利用率
+            for line in format_resource_lines(snap.get("resources")):
+                print(line)
 
         # KL spike dump
         kl = logs.get("kl", None)
@@ -622,6 +638,8 @@ class RewardDiagnosticsCallback(TrainerCallback):
 
 
 diag_callback = RewardDiagnosticsCallback(kl_spike_threshold=5.0)
+# OpenMetrics 导出（REWARD_CONFIG 中 metrics_http_port / metrics_textfile 未配置时不启动）
+start_metrics_exporter()
 
 print("✓ Reward function 加载成功")
 
@@ -0,0 +1,181 @@
+"""
+Benchmark + 等价性检查：completion 解析的 schema 专用快速路径 vs 原解析器（_extract_json_object + 逐字段容错转换）
+
+语料：
+- 从训练日志（training_log.md 格式）收集的 completion：[completion_log] 行、KL spike 的 sample_completions、
+  以及按日志中已解析动作重新序列化的 JSON（含 ensure_ascii 转义版本）
+- 随机 fuzz：字段顺序/重复/缺失/多余、数值字符串、浮点、布尔、是/否同义值、\\u 转义与字面量转义、
+  JSON/Unicode 空白、前后说明文字、代码块、尾随的其他 {...}、嵌套与截断
+
+要求两种解析对每条语料、每种任务类型给出完全相同的 parse_output 结果；
+耗时按训练中的实际用法统计（每条 completion 只按自己的任务类型解析），报告每次解析的平均耗时与加速比。
+
+用法：python bench_completion_parser.py [log_path] [num_fuzz] [repeats]
+"""
+
+import ast
+import json
+import random
+import re
+import sys
+import time
+
+import tsc_reward_function as trf
+
+
+CONFIG = {
+    'log_path': 'training_log.md',
+    'num_fuzz': 20000,
+    'repeats': 5,
+    'seed': 0,
+}
+
+TASK_TYPES = ('signal_step', 'extend_decision')
+
+_RAW_LINE_RE = re.compile(r"^\s+\[\d+\] \((signal_step|extend_decision)\): (.*)$")
+_PARSED_LINE_RE = re.compile(r"^\[\d+\] \((signal_step|extend_decision)\):(\{.*\})$")
+_SAMPLES_RE = re.compile(r"'sample_completions': (\[.*?\]), 'sample_reasons'")
+
+
+def _guess_task_type(text: str) -> str:
+    return 'extend_decision' if '"extend' in text else 'signal_step'
+
+
+def harvest_log_completions(log_path: str):
+    """从训练日志收集 (completion 文本, 任务类型)"""
+    texts = []
+    try:
+        with open(log_path, encoding='utf-8') as f:
+            lines = f.read().splitlines()
+    except OSError as e:
+        print(f"⚠️ 无法读取日志 {log_path}: {e}")
+        return texts
+    for line in lines:
+        m = _RAW_LINE_RE.match(line)
+        if m:
+            texts.append((m.group(2), m.group(1)))
+            continue
+        m = _PARSED_LINE_RE.match(line)
+        if m:
+            try:
+                obj = ast.literal_eval(m.group(2))
+            except Exception:
+                continue
+            texts.append((json.dumps(obj, ensure_ascii=False), m.group(1)))
+            texts.append((json.dumps(obj), m.group(1)))
+            continue
+        m = _SAMPLES_RE.search(line)
+        if m:
+            try:
+                texts.extend((str(t), _guess_task_type(str(t))) for t in ast.literal_eval(m.group(1)))
+            except Exception:
+                continue
+    return texts
+
+
+def _fuzz_value(rng: random.Random, key: str) -> str:
+    if key == 'extend':
+        choices = [
+            '"是"', '"否"', '"yes"', '"No"', '" TRUE "', '"1"', '"0"', '"延长"', '"不延长"', '"maybe"',
+            '"\\u662f"', '"\\u5426"', '"\\\\u662f"', '"\\\\u5426"', '"\\\\u66"', 'true', 'false', 'null', '1', '"是\\n"',
+        ]
+        return rng.choice(choices)
+    choices = [
+        str(rng.randint(-5, 60)), '0', '-0', '05', '5.0', '1e2', '"%d"' % rng.randint(-5, 60), '" 7"', '"+7"',
+        '"７"', '"1_0"', '"x"', 'true', 'false', 'null', '[3]', '{"v": 3}', '"\\u0033"', '""',
+    ]
+    return rng.choice(choices)
+
+
+def _fuzz_ws(rng: random.Random) -> str:
+    return rng.choice(['', '', ' ', '  ', '\n', '\t', '\r\n ', '　', '\xa0'])
+
+
+def _fuzz_object(rng: random.Random, keys) -> str:
+    members = list(keys)
+    rng.shuffle(members)
+    r = rng.random()
+    if r < 0.1:
+        members = members[:1]
+    elif r < 0.15:
+        members.append(members[0])
+    elif r < 0.25:
+        members.append(rng.choice(['reason', 'note', 'phase']))
+    parts = []
+    for k in members:
+        parts.append(f'{_fuzz_ws(rng)}"{k}"{_fuzz_ws(rng)}:{_fuzz_ws(rng)}{_fuzz_value(rng, k)}{_fuzz_ws(rng)}')
+    return '{' + ','.join(parts) + '}'
+
+
+def fuzz_completions(num: int, rng: random.Random):
+    schemas = [('next_phase_id', 'green_sec'), ('extend', 'extend_sec')]
+    prefixes = ['', '', '  ', '好的，', '输出：\n', '```json\n', '<think>考虑 {相位} 排队</think>\n', '{"draft": 1}\n', '{']
+    suffixes = ['', '', '\n', '\n```', ' 以上。', ' {"extra": true}', ' {', '}', ' {"a": {"b": 1}}']
+    texts = []
+    for _ in range(num):
+        keys = rng.choice(schemas)
+        obj = _fuzz_object(rng, keys)
+        if rng.random() < 0.05:
+            obj = obj[: rng.randint(0, len(obj))]
+        task_type = 'extend_decision' if keys[0] == 'extend' else 'signal_step'
+        texts.append((rng.choice(prefixes) + obj + rng.choice(suffixes), task_type))
+    return texts
+
+
+def _parse_all(pairs, fast: bool):
+    trf.REWARD_CONFIG['fast_completion_parser'] = fast
+    return [trf.parse_output(t, tt) for t, tt in pairs]
+
+
+def _time_parse(pairs, fast: bool, repeats: int) -> float:
+    trf.REWARD_CONFIG['fast_completion_parser'] = fast
+    best = None
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        for t, tt in pairs:
+            trf.parse_output(t, tt)
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best / max(1, len(pairs))
+
+
+def main(log_path: str = None, num_fuzz: int = None, repeats: int = None):
+    log_path = log_path or CONFIG['log_path']
+    num_fuzz = int(num_fuzz or CONFIG['num_fuzz'])
+    repeats = int(repeats or CONFIG['repeats'])
+    rng = random.Random(CONFIG['seed'])
+
+    log_texts = harvest_log_completions(log_path)
+    fuzz_texts = fuzz_completions(num_fuzz, rng)
+    print(f"log completions={len(log_texts)} fuzz completions={len(fuzz_texts)}")
+
+    mismatches = 0
+    for name, texts in (('log', log_texts), ('fuzz', fuzz_texts)):
+        # 等价性：每条文本按两种任务类型都检查（含 schema 不符时的回退路径）
+        pairs = [(t, tt) for t, _ in texts for tt in TASK_TYPES]
+        legacy = _parse_all(pairs, fast=False)
+        fast = _parse_all(pairs, fast=True)
+        bad = [(pairs[i], legacy[i], fast[i]) for i in range(len(pairs)) if legacy[i] != fast[i]]
+        mismatches += len(bad)
+        for (text, tt), a, b in bad[:10]:
+            print(f"✗ 结果不一致 [{name}/{tt}] {text!r}: legacy={a} fast={b}")
+
+    results = {}
+    for name, texts in (('log', log_texts), ('fuzz', fuzz_texts)):
+        if not texts:
+            continue
+        t_legacy = _time_parse(texts, fast=False, repeats=repeats)
+        t_fast = _time_parse(texts, fast=True, repeats=repeats)
+        results[name] = {'legacy_us': 1e6 * t_legacy, 'fast_us': 1e6 * t_fast}
+        print(f"{name:5s} legacy: {1e6 * t_legacy:.2f} us/parse  fast: {1e6 * t_fast:.2f} us/parse  "
+              f"speedup: {t_legacy / max(1e-12, t_fast):.2f}x")
+    trf.REWARD_CONFIG['fast_completion_parser'] = True
+
+    print(f"mismatches: {mismatches}")
+    if mismatches:
+        sys.exit(1)
+    return results
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:4])
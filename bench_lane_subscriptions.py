@@ -0,0 +1,202 @@
+"""
+Benchmark + 等价性检查：_simulate_phase_window 的 lane 订阅读数 vs 逐车道查询
+
+对同一 state 分别以 lane_subscriptions=False / True 运行同一仿真窗口，
+要求两者指标完全一致，并报告每个窗口的平均耗时与加速比。
+
+--self-check：不需要 SUMO 和 dataset，用假的 traci 句柄（随机车流，含无法订阅/查询的车道）
+驱动 _LaneWatch，要求两种模式逐步给出相同的排队总数与车辆 ID，且 close() 后不留订阅。
+
+用法：python bench_lane_subscriptions.py [dataset_dir] [num_windows] [green_sec]
+      python bench_lane_subscriptions.py --self-check [num_windows] [green_sec]
+"""
+
+import random
+import sys
+import time
+from types import SimpleNamespace
+
+import tsc_reward_function as trf
+
+
+CONFIG = {
+    'dataset_dir': 'grpo_dataset_two_scenarios',
+    'num_windows': 50,
+    'green_sec': 60,
+    'seed': 0,
+}
+
+_HALTING = 0x14  # 与 traci.constants 的取值无关，只需两种变量可区分
+_VEH_IDS = 0x12
+
+
+class _FakeLaneDomain:
+    def __init__(self, world):
+        self._world = world
+
+    def _lane(self, ln: str):
+        if ln not in self._world.lanes or ln in self._world.broken:
+            raise KeyError(f"unknown lane {ln}")
+        return self._world.lanes[ln]
+
+    def subscribe(self, ln: str, varids):
+        self._lane(ln)
+        self._world.subscriptions[ln] = list(varids)
+
+    def unsubscribe(self, ln: str):
+        self._world.subscriptions.pop(ln, None)
+
+    def getSubscriptionResults(self, ln: str):
+        return self._world.results.get(ln)
+
+    def getLastStepHaltingNumber(self, ln: str) -> int:
+        return self._lane(ln)[1]
+
+    def getLastStepVehicleIDs(self, ln: str):
+        return tuple(self._lane(ln)[0])
+
+
+class _FakeTraci:
+    """
+    按 seed 确定的随机车流：每步各车道有车辆驶入/驶出，停车数不超过车辆数。
+    broken 中的车道订阅与查询都抛异常（SUMO 中不存在的车道）。
+    """
+
+    constants = SimpleNamespace(LAST_STEP_VEHICLE_HALTING_NUMBER=_HALTING, LAST_STEP_VEHICLE_ID_LIST=_VEH_IDS)
+
+    def __init__(self, lanes, broken, seed: int):
+        self._rng = random.Random(seed)
+        self._next_veh = 0
+        self.broken = set(broken)
+        self.lanes = {ln: ([], 0) for ln in lanes}
+        self.subscriptions = {}
+        self.results = {}
+        self.lane = _FakeLaneDomain(self)
+        self._advance()
+
+    def _advance(self):
+        for ln, (vehs, _halting) in self.lanes.items():
+            vehs = [v for v in vehs if self._rng.random() > 0.2]
+            for _ in range(self._rng.randint(0, 2)):
+                vehs.append(f"veh{self._next_veh}")
+                self._next_veh += 1
+            self.lanes[ln] = (vehs, self._rng.randint(0, len(vehs)))
+        self.results = {
+            ln: {
+                var: (tuple(self.lanes[ln][0]) if var == _VEH_IDS else self.lanes[ln][1])
+                for var in varids
+            }
+            for ln, varids in self.subscriptions.items()
+        }
+
+    def simulationStep(self):
+        self._advance()
+
+
+def _fake_window(subscriptions: bool, lanes, broken, halting_lanes, id_lanes, steps: int, seed: int):
+    """按 _simulate_phase_window_prefixes 的调用顺序读一个窗口：[(排队总数, 车辆 ID), ...]，含 step 前的一次读取"""
+    trf.REWARD_CONFIG['lane_subscriptions'] = subscriptions
+    traci = _FakeTraci(lanes, broken, seed)
+    watch = trf._LaneWatch(traci, halting_lanes, id_lanes)
+    readings = [(watch.halting_total(), watch.vehicle_ids())]
+    try:
+        for _ in range(steps):
+            watch.step()
+            readings.append((watch.halting_total(), watch.vehicle_ids()))
+    finally:
+        watch.close()
+    return readings, dict(traci.subscriptions)
+
+
+def self_check(num_windows: int = None, green_sec: int = None):
+    num_windows = int(num_windows or CONFIG['num_windows'])
+    green_sec = int(green_sec or CONFIG['green_sec'])
+    rng = random.Random(CONFIG['seed'])
+    mismatches = 0
+    for w in range(num_windows):
+        lanes = [f"e{k}_0" for k in range(rng.randint(1, 12))]
+        broken = rng.sample(lanes, rng.randint(0, min(2, len(lanes))))
+        halting_lanes = rng.sample(lanes, rng.randint(1, len(lanes))) + rng.sample(["missing_0"], rng.randint(0, 1))
+        id_lanes = rng.sample(lanes, rng.randint(0, len(lanes)))
+        seed = rng.randrange(1 << 30)
+        poll, _ = _fake_window(False, lanes, broken, halting_lanes, id_lanes, green_sec, seed)
+        subs, leftover = _fake_window(True, lanes, broken, halting_lanes, id_lanes, green_sec, seed)
+        if poll != subs or leftover:
+            mismatches += 1
+            first = next((t for t, (a, b) in enumerate(zip(poll, subs)) if a != b), None)
+            print(f"✗ 读数不一致 [window {w} step {first}] leftover_subscriptions={sorted(leftover)}")
+    trf.REWARD_CONFIG['lane_subscriptions'] = True
+    print(f"self-check windows={num_windows} steps={green_sec} mismatches={mismatches}")
+    if mismatches:
+        sys.exit(1)
+    return mismatches
+
+
+def _pick_windows(dataset, num_windows: int, rng: random.Random):
+    rows = [i for i, t in enumerate(dataset['task_type']) if t == 'signal_step']
+    rng.shuffle(rows)
+    windows = []
+    for idx in rows[:num_windows]:
+        row = dataset[idx]
+        if not row.get('phase_ids'):
+            continue
+        windows.append((row['sumocfg_path'], row['state_path'], row['tl_id'], rng.choice(row['phase_ids'])))
+    return windows
+
+
+def _run_window(sumocfg: str, state_path: str, tl_id: str, phase_id: int, green_sec: int, subscriptions: bool):
+    trf.REWARD_CONFIG['lane_subscriptions'] = subscriptions
+    simulator, reason = trf._acquire_worker_simulator(sumocfg, state_path)
+    if simulator is None:
+        raise RuntimeError(reason)
+    try:
+        t0 = time.perf_counter()
+        metrics = trf._simulate_phase_window(simulator, tl_id, phase_id, green_sec)
+        elapsed = time.perf_counter() - t0
+    finally:
+        trf._release_worker_simulator(sumocfg, simulator)
+    return metrics, elapsed
+
+
+def main(dataset_dir: str = None, num_windows: int = None, green_sec: int = None):
+    dataset_dir = dataset_dir or CONFIG['dataset_dir']
+    num_windows = int(num_windows or CONFIG['num_windows'])
+    green_sec = int(green_sec or CONFIG['green_sec'])
+
+    from datasets import load_from_disk
+
+    # 主进程按 worker 方式运行，复用常驻 SUMO（启动耗时不计入窗口）
+    trf._worker_initializer(trf.REWARD_CONFIG.get('parallel_port_base', 40000))
+
+    dataset = load_from_disk(dataset_dir)
+    windows = _pick_windows(dataset, num_windows, random.Random(CONFIG['seed']))
+    print(f"windows={len(windows)} green_sec={green_sec} backend={trf.REWARD_CONFIG.get('sim_backend')}")
+
+    t_poll = 0.0
+    t_subs = 0.0
+    mismatches = 0
+    for sumocfg, state_path, tl_id, phase_id in windows:
+        m_poll, dt_poll = _run_window(sumocfg, state_path, tl_id, phase_id, green_sec, subscriptions=False)
+        m_subs, dt_subs = _run_window(sumocfg, state_path, tl_id, phase_id, green_sec, subscriptions=True)
+        t_poll += dt_poll
+        t_subs += dt_subs
+        if m_poll != m_subs:
+            mismatches += 1
+            print(f"✗ 指标不一致 [{state_path} phase={phase_id}]: polling={m_poll} subscriptions={m_subs}")
+    trf._close_worker_sessions()
+
+    n = max(1, len(windows))
+    print(f"polling:       {1000 * t_poll / n:.1f} ms/window")
+    print(f"subscriptions: {1000 * t_subs / n:.1f} ms/window")
+    print(f"speedup:       {t_poll / max(1e-9, t_subs):.2f}x")
+    print(f"mismatches:    {mismatches}/{len(windows)}")
+    if mismatches:
+        sys.exit(1)
+    return {'polling_ms': 1000 * t_poll / n, 'subscriptions_ms': 1000 * t_subs / n}
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--self-check']:
+        self_check(*sys.argv[2:4])
+    else:
+        main(*sys.argv[1:4])
@@ -0,0 +1,100 @@
+"""
+Benchmark：同一决策 state 分支出 G 个 signal_step rollout 的两种方式
+
+- loadstate：TraCI + 决策点 saveState，每个候选前 loadState（默认路径）
+- fork：进程内 libsumo，在决策点 os.fork() 每个候选一个子进程
+
+用法：python bench_reward_branching.py [dataset_dir] [num_states] [num_candidates]
+"""
+
+import random
+import sys
+import time
+
+from datasets import load_from_disk
+
+import tsc_reward_function as trf
+
+
+CONFIG = {
+    'dataset_dir': 'grpo_dataset_two_scenarios',
+    'num_states': 20,
+    'num_candidates': 8,  # 每个 state 的候选动作数（GRPO 的 G）
+    'seed': 0,
+}
+
+
+def _build_state_groups(dataset, num_states: int, num_candidates: int, rng: random.Random):
+    rows = [i for i, t in enumerate(dataset['task_type']) if t == 'signal_step']
+    rng.shuffle(rows)
+    groups = []
+    for idx in rows:
+        row = dataset[idx]
+        columns = {k: [v] for k, v in row.items() if k != 'prompt'}
+        ctx = trf._sim_sample_context([row['prompt']], columns, 0)
+        if ctx is None or not ctx['phase_ids']:
+            continue
+        tasks = []
+        for _ in range(num_candidates):
+            action = {
+                'next_phase_id': rng.choice(ctx['phase_ids']),
+                'green_sec': rng.randint(5, 60),
+            }
+            task = trf._make_validated_sim_task(ctx, 'signal_step', action)
+            if task is not None:
+                tasks.append(task)
+        if tasks:
+            groups.append(tasks)
+        if len(groups) >= num_states:
+            break
+    return groups
+
+
+def _run(engine: str, groups):
+    trf.REWARD_CONFIG['branching_engine'] = engine
+    # 预热：启动 SUMO / libsumo 实例，不计入耗时
+    trf._simulate_valid_action_group_worker(groups[0])
+    t0 = time.perf_counter()
+    results = [trf._simulate_valid_action_group_worker(g) for g in groups]
+    return time.perf_counter() - t0, results
+
+
+def main(dataset_dir: str = None, num_states: int = None, num_candidates: int = None):
+    dataset_dir = dataset_dir or CONFIG['dataset_dir']
+    num_states = int(num_states or CONFIG['num_states'])
+    num_candidates = int(num_candidates or CONFIG['num_candidates'])
+
+    trf.REWARD_CONFIG.update({
+        'parallel_workers': 0,
+        'rollout_cache_path': None,
+        'use_reward_table': False,
+    })
+    # 主进程按 worker 方式运行，使 loadstate 路径也复用常驻 SUMO（否则每个 state 都计入启动耗时）
+    trf._worker_initializer(trf.REWARD_CONFIG.get('parallel_port_base', 40000))
+    if not trf._fork_engine_available():
+        print("libsumo / os.fork 不可用，无法对比")
+        return None
+
+    dataset = load_from_disk(dataset_dir)
+    groups = _build_state_groups(dataset, num_states, num_candidates, random.Random(CONFIG['seed']))
+    n_rollouts = sum(len(g) for g in groups)
+    print(f"states={len(groups)} rollouts={n_rollouts}")
+
+    t_load, res_load = _run('loadstate', groups)
+    t_fork, res_fork = _run('fork', groups)
+    trf.cleanup_global_pool()
+
+    max_diff = 0.0
+    for ga, gb in zip(res_load, res_fork):
+        for (ra, _, _), (rb, _, _) in zip(ga, gb):
+            max_diff = max(max_diff, abs(float(ra) - float(rb)))
+
+    print(f"loadstate: {t_load:.2f}s  ({1000 * t_load / max(1, n_rollouts):.1f} ms/rollout)")
+    print(f"fork:      {t_fork:.2f}s  ({1000 * t_fork / max(1, n_rollouts):.1f} ms/rollout)")
+    print(f"speedup:   {t_load / max(1e-9, t_fork):.2f}x")
+    print(f"max |reward diff|: {max_diff:.6f}")
+    return {'loadstate_sec': t_load, 'fork_sec': t_fork, 'max_reward_diff': max_diff}
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:4])
@@ -33,6 +33,8 @@ from sumo_simulator import SUMOSimulator
 sys.path.insert(0, os.getcwd())
 from scu_tsc_newprompt.phase_parser import get_net_phase_minmax_one_based, get_phase_order_one_based, get_green_phase_order_one_based
 from scu_tsc_newprompt.constraint_sampler import sample_phase_limits_hybrid
+from scu_tsc_newprompt.sim_backend import get_backend
+from scu_tsc_newprompt.tl_topology import build_tl_topology, dump_tl_topology, phase_state as topology_phase_state
 from scu_tsc_newprompt.prompt_builder import (
     build_cycle_predict_input_json,
     wrap_prompt_with_markers,
@@ -46,6 +48,7 @@ from scu_tsc_newprompt.prompt_builder import (
 # ==================== 配置 ====================
 CONFIG = {
     'gui': False,
+    'sim_backend': 'traci',  # traci（TCP socket）| libsumo（进程内，不占端口）
     'warmup_steps': 80,
     'steps_per_tl': 20,          # 每个信号灯采样多少个时间步
     'steps_per_tl_signal_step': 10,
@@ -182,13 +185,37 @@ def extract_traffic_light_ids(net_xml_path: str) -> List[str]:
     return tl_ids
 
 
-def collect_phase_waits_snapshot(simulator: SUMOSimulator, tl_id: str, phase_order: List[int]) -> List[dict]:
+def _sim_api():
+    """当前后端的 TraCI 兼容模块（traci 或 libsumo）"""
+    return get_backend(CONFIG.get('sim_backend', 'traci')).api
+
+
+def _create_simulator(sumocfg: str, port: int = None, additional_options: List[str] = None):
+    return get_backend(CONFIG.get('sim_backend', 'traci')).create_simulator(
+        sumocfg,
+        gui=CONFIG['gui'],
+        additional_options=additional_options,
+        port=port,
+    )
+
+
+def _phase_incoming_lanes(simulator: SUMOSimulator, tl_id: str, phase_idx: int, topology: Dict = None) -> List[str]:
+    """相位（0-based）控制的进口车道：有拓扑索引时查表，否则向仿真器查询"""
+    if topology is not None:
+        lanes = topology.get('phase_lanes', [])
+        return list(lanes[phase_idx]) if 0 <= phase_idx < len(lanes) else []
+    return simulator.get_phase_controlled_lanes(tl_id, phase_idx).get('incoming_lanes', [])
+
+
+def collect_phase_waits_snapshot(
+    simulator: SUMOSimulator, tl_id: str, phase_order: List[int], topology: Dict = None
+) -> List[dict]:
     """收集当前时刻各相位的等待车辆数（作为 avg_wait 代理）"""
-    import traci
+    traci = _sim_api()
     waits = []
     for phase_id in phase_order:
         phase_idx = phase_id - 1
-        lanes = simulator.get_phase_controlled_lanes(tl_id, phase_idx).get('incoming_lanes', [])
+        lanes = _phase_incoming_lanes(simulator, tl_id, phase_idx, topology)
         if not lanes:
             avg = 0.0
         else:
@@ -209,7 +236,10 @@ def _is_green_phase(phase_state: str) -> bool:
     return ("G" in phase_state) or ("g" in phase_state)
 
 
-def _get_current_phase_state(simulator: SUMOSimulator, tl_id: str) -> Tuple[int, str]:
+def _get_current_phase_state(simulator: SUMOSimulator, tl_id: str, topology: Dict = None) -> Tuple[int, str]:
+    if topology is not None:
+        current_idx = int(_sim_api().trafficlight.getPhase(tl_id))
+        return current_idx, topology_phase_state(topology, current_idx)
     info = simulator.get_phase_info(tl_id)
     current_idx = int(info.get('current_phase_index', 0))
     phase_states = info.get('phase_states', [])
@@ -217,11 +247,13 @@ def _get_current_phase_state(simulator: SUMOSimulator, tl_id: str) -> Tuple[int,
     return current_idx, state
 
 
-def _build_phase_lane_map(simulator: SUMOSimulator, tl_id: str, phase_ids: List[int]) -> Dict[str, List[str]]:
+def _build_phase_lane_map(
+    simulator: SUMOSimulator, tl_id: str, phase_ids: List[int], topology: Dict = None
+) -> Dict[str, List[str]]:
     phase_lane_map: Dict[str, List[str]] = {}
     for phase_id in phase_ids:
         phase_idx = phase_id - 1
-        lanes = simulator.get_phase_controlled_lanes(tl_id, phase_idx).get('incoming_lanes', [])
+        lanes = _phase_incoming_lanes(simulator, tl_id, phase_idx, topology)
         phase_lane_map[str(phase_id)] = list(lanes)
     return phase_lane_map
 
@@ -237,7 +269,7 @@ def _randomize_tl_program_durations(
     Returns:
         List[int]: 各相位的duration列表（秒）；失败时返回空列表
     """
-    import traci
+    traci = _sim_api()
 
     try:
         logics = traci.trafficlight.getAllProgramLogics(tl_id)
@@ -265,11 +297,11 @@ def _randomize_tl_program_durations(
         return []
 
 
-def _init_phase_tracking(simulator: SUMOSimulator, tl_id: str) -> Dict[str, Any]:
-    import traci
+def _init_phase_tracking(simulator: SUMOSimulator, tl_id: str, topology: Dict = None) -> Dict[str, Any]:
+    traci = _sim_api()
 
-    phase_idx, phase_state = _get_current_phase_state(simulator, tl_id)
-    lanes = simulator.get_phase_controlled_lanes(tl_id, phase_idx).get('incoming_lanes', [])
+    phase_idx, phase_state = _get_current_phase_state(simulator, tl_id, topology)
+    lanes = _phase_incoming_lanes(simulator, tl_id, phase_idx, topology)
     lane_prev_ids = {}
     for ln in lanes:
         try:
@@ -282,21 +314,23 @@ def _init_phase_tracking(simulator: SUMOSimulator, tl_id: str) -> Dict[str, Any]
         "phase_start_time": float(traci.simulation.getTime()),
         "passed_total": 0.0,
         "lane_prev_ids": lane_prev_ids,
+        "topology": topology,
     }
 
 
 def _step_and_track(simulator: SUMOSimulator, tl_id: str, track: Dict[str, Any]):
-    import traci
+    traci = _sim_api()
 
+    topology = track.get("topology")
     simulator.step()
     current_time = float(traci.simulation.getTime())
-    phase_idx, phase_state = _get_current_phase_state(simulator, tl_id)
+    phase_idx, phase_state = _get_current_phase_state(simulator, tl_id, topology)
     if phase_idx != track["phase_idx"]:
         track["phase_idx"] = phase_idx
         track["phase_state"] = phase_state
         track["phase_start_time"] = current_time
         track["passed_total"] = 0.0
-        lanes = simulator.get_phase_controlled_lanes(tl_id, phase_idx).get('incoming_lanes', [])
+        lanes = _phase_incoming_lanes(simulator, tl_id, phase_idx, topology)
         lane_prev_ids = {}
         for ln in lanes:
             try:
@@ -327,13 +361,14 @@ def _collect_phase_metrics_now(
     phase_ids: List[int],
     current_phase_id: int,
     current_phase_passed_total: float,
+    topology: Dict = None,
 ) -> List[Dict[str, Any]]:
-    import traci
+    traci = _sim_api()
 
     metrics = []
     for phase_id in phase_ids:
         phase_idx = phase_id - 1
-        lanes = simulator.get_phase_controlled_lanes(tl_id, phase_idx).get('incoming_lanes', [])
+        lanes = _phase_incoming_lanes(simulator, tl_id, phase_idx, topology)
         if lanes:
             total_queue = 0.0
             for ln in lanes:
@@ -389,12 +424,7 @@ def generate_dataset_for_one_tl(
         port: 指定的 SUMO 端口（用于避免并行冲突）
     """
     
-    simulator = SUMOSimulator(
-        config_file=env_info['sumocfg'],
-        junctions_file=None,
-        gui=CONFIG['gui'],
-        port=port,
-    )
+    simulator = _create_simulator(env_info['sumocfg'], port=port)
     
     if not simulator.start_simulation():
         print(f"✗ 启动失败: {scenario_name}/{tl_id}")
@@ -405,7 +435,7 @@ def generate_dataset_for_one_tl(
         if simulator.is_connected():
             simulator.step()
 
-    import traci
+    traci = _sim_api()
     if tl_id not in traci.trafficlight.getIDList():
         print(f"✗ 未在当前仿真中找到信号灯: {scenario_name}/{tl_id}")
         simulator.close()
@@ -418,6 +448,9 @@ def generate_dataset_for_one_tl(
         simulator.close()
         return []
 
+    # 静态拓扑索引：相位 state / 进口车道在整个仿真中不变，只查询一次
+    topology = build_tl_topology(simulator, tl_id)
+
     net_minmax = get_net_phase_minmax_one_based(env_info['net'], tl_id)
     recent_cycles_buf = deque(maxlen=CONFIG['recent_cycles_maxlen'])
 
@@ -452,7 +485,7 @@ def generate_dataset_for_one_tl(
         ]
 
         # 保存 SUMO state（使用自定义路径）
-        import traci
+        traci = _sim_api()
         current_time = traci.simulation.getTime()
         state_filename = f"{tl_id}_step{step_idx}_t{int(current_time)}.xml"
         state_path = os.path.join(state_dir, state_filename)
@@ -467,10 +500,11 @@ def generate_dataset_for_one_tl(
             'phase_order': phase_order,
             'phase_limits': phase_limits,
             'step_idx': step_idx,
+            'tl_topology': dump_tl_topology(topology),
         })
 
         # 执行一个默认周期（推进仿真）
-        waits = collect_phase_waits_snapshot(simulator, tl_id, phase_order)
+        waits = collect_phase_waits_snapshot(simulator, tl_id, phase_order, topology)
         recent_cycles_buf.append({
             'time': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
             'phase_waits': waits,
@@ -499,14 +533,12 @@ def generate_dataset_for_one_tl_two_scenarios(
     Args:
         port: 指定的 SUMO 端口（用于避免并行冲突）
     """
-    import traci
+    traci = _sim_api()
 
-    simulator = SUMOSimulator(
-        config_file=env_info['sumocfg'],
-        junctions_file=None,
-        gui=CONFIG['gui'],
-        additional_options=['--device.rerouting.probability', '0'],  # 禁用动态重路由
+    simulator = _create_simulator(
+        env_info['sumocfg'],
         port=port,
+        additional_options=['--device.rerouting.probability', '0'],  # 禁用动态重路由
     )
 
     if not simulator.start_simulation():
@@ -529,7 +561,11 @@ def generate_dataset_for_one_tl_two_scenarios(
         return []
 
     phase_ids = list(phase_order)
-    phase_lane_map = _build_phase_lane_map(simulator, tl_id, phase_ids)
+    # 静态拓扑索引：相位 state / 进口车道在整个仿真中不变（随机化只改时长），只查询一次并随样本保存，
+    # 供 reward 侧直接使用（见 tsc_reward_function._resolve_tl_topology）
+    topology = build_tl_topology(simulator, tl_id)
+    topology_json = dump_tl_topology(topology)
+    phase_lane_map = _build_phase_lane_map(simulator, tl_id, phase_ids, topology)
 
     state_dir = os.path.join(state_root, scenario_name)
     os.makedirs(state_dir, exist_ok=True)
@@ -553,7 +589,7 @@ def generate_dataset_for_one_tl_two_scenarios(
         return non_zero_count < len(phase_metrics) / 2
 
     # 初始化相位跟踪
-    track = _init_phase_tracking(simulator, tl_id)
+    track = _init_phase_tracking(simulator, tl_id, topology)
 
     # ========== 场景1: signal_step ==========
     steps_signal = CONFIG.get('steps_per_tl_signal_step', CONFIG['steps_per_tl'])
@@ -571,7 +607,7 @@ def generate_dataset_for_one_tl_two_scenarios(
         max_guard_steps = 600
         guard = 0
         while guard < max_guard_steps:
-            phase_idx, phase_state = _get_current_phase_state(simulator, tl_id)
+            phase_idx, phase_state = _get_current_phase_state(simulator, tl_id, topology)
             remaining = traci.trafficlight.getNextSwitch(tl_id) - traci.simulation.getTime()
             if _is_green_phase(phase_state) and remaining <= decision_lead_sec:
                 break
@@ -581,7 +617,7 @@ def generate_dataset_for_one_tl_two_scenarios(
         if guard >= max_guard_steps:
             continue
 
-        phase_idx, phase_state = _get_current_phase_state(simulator, tl_id)
+        phase_idx, phase_state = _get_current_phase_state(simulator, tl_id, topology)
         current_phase_id = phase_idx + 1
         remaining = traci.trafficlight.getNextSwitch(tl_id) - traci.simulation.getTime()
         decision_remaining_sec = int(max(0, round(remaining)))
@@ -596,6 +632,7 @@ def generate_dataset_for_one_tl_two_scenarios(
             phase_ids,
             current_phase_id,
             track["passed_total"],
+            topology,
         )
 
         payload = build_signal_step_input_json(
@@ -637,10 +674,12 @@ def generate_dataset_for_one_tl_two_scenarios(
             'phase_lane_map': phase_lane_map,
             'decision_lead_sec': decision_lead_sec,
             'decision_remaining_sec': decision_remaining_sec,
+            'current_phase_id': current_phase_id,
             'current_phase_elapsed_sec': current_elapsed,
             'current_phase_planned_green_sec': current_planned_green,
             'sumocfg_path': env_info['sumocfg'],
             'tls_phase_durations': tls_phase_durations,
+            'tl_topology': topology_json,
         })
 
         # 轻微推进仿真，避免同一状态
@@ -681,7 +720,7 @@ def generate_dataset_for_one_tl_two_scenarios(
         max_guard_steps = 600
         guard = 0
         while guard < max_guard_steps:
-            phase_idx, phase_state = _get_current_phase_state(simulator, tl_id)
+            phase_idx, phase_state = _get_current_phase_state(simulator, tl_id, topology)
             if not _is_green_phase(phase_state):
                 _step_and_track(simulator, tl_id, track)
                 guard += 1
@@ -714,8 +753,10 @@ def generate_dataset_for_one_tl_two_scenarios(
             phase_ids,
             current_phase_id,
             track["passed_total"],
+            topology,
         )
 
+        max_extend_sec = CONFIG.get('max_extend_sec', 8)
         payload = build_extend_decision_input_json(
             scenario_name=scenario_name,
             tl_id=tl_id,
@@ -726,7 +767,7 @@ def generate_dataset_for_one_tl_two_scenarios(
             current_phase_elapsed_sec=elapsed,
             wait_time_for_phase_change=wait_time,
             phase_metrics_now=phase_metrics_now,
-            max_extend_sec=CONFIG.get('max_extend_sec', 8),
+            max_extend_sec=max_extend_sec,
         )
 
         full_prompt = wrap_extend_decision_prompt(payload)
@@ -757,9 +798,12 @@ def generate_dataset_for_one_tl_two_scenarios(
             'phase_limits': phase_limits,
             'phase_lane_map': phase_lane_map,
             'wait_time_for_phase_change': wait_time,
+            'current_phase_id': current_phase_id,
             'current_phase_elapsed_sec': elapsed,
+            'max_extend_sec': max_extend_sec,
             'sumocfg_path': env_info['sumocfg'],
             'tls_phase_durations': tls_phase_durations,
+            'tl_topology': topology_json,
         })
 
         for _ in range(5):
@@ -777,7 +821,9 @@ def _worker_process_tl(args: Tuple) -> Tuple[str, str, List[dict]]:
     Returns:
         (scenario_name, tl_id, samples)
     """
-    scenario_name, tl_id, env_info, state_root, dataset_mode, worker_id, port_base = args
+    scenario_name, tl_id, env_info, state_root, dataset_mode, worker_id, port_base, sim_backend = args
+    # spawn 子进程看不到主进程对 CONFIG 的修改，后端随参数传入
+    CONFIG['sim_backend'] = sim_backend
     
     # 使用任务哈希值来分配端口，确保不同任务使用不同端口
     # 端口范围：port_base 到 port_base + 9999
@@ -862,7 +908,10 @@ def main(num_workers: int = None):
     worker_args = []
     for worker_id, (scenario_name, tl_id) in enumerate(all_pairs):
         env_info = available_envs[scenario_name]
-        worker_args.append((scenario_name, tl_id, env_info, state_root, dataset_mode, worker_id % num_workers, port_base))
+        worker_args.append((
+            scenario_name, tl_id, env_info, state_root, dataset_mode,
+            worker_id % num_workers, port_base, CONFIG.get('sim_backend', 'traci'),
+        ))
     
     all_samples = []
     
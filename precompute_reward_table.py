@@ -0,0 +1,101 @@
+"""
+离线预计算 GRPO Dataset 的 reward 表
+
+在 generate_grpo_dataset.main() 之后运行：
+1. 读取已生成的 dataset
+2. 对每个样本并行枚举动作空间（extend_decision 全量；signal_step 粗扫 + 最优附近细扫）并仿真
+3. 把 {动作: 原始指标} 写入 reward_table 列（紧凑 JSON 字符串，_meta 记录仿真语义）
+
+训练时 tsc_reward_sim_fn 命中 reward_table 直接查表，不启动 SUMO；未命中的动作仍走在线仿真。
+_meta 与当前代码的仿真语义（rollout 缓存 schema、extend_decision 窗口语义）不一致的表整表忽略，需重新运行本脚本。
+"""
+
+import os
+import shutil
+import time
+from collections import Counter
+
+from datasets import load_from_disk
+
+from tsc_reward_function import REWARD_CONFIG, precompute_reward_tables, cleanup_global_pool
+
+
+# ==================== 配置 ====================
+CONFIG = {
+    'dataset_dir': 'grpo_dataset',  # 输入 dataset（generate_grpo_dataset 的 output_dir）
+    'output_dir': None,             # None 表示原地覆盖 dataset_dir
+    'num_workers': 16,              # 并行 SUMO worker 数量（覆盖 REWARD_CONFIG['parallel_workers']）
+    'coarse_step': 5,               # signal_step 粗扫 green_sec 步长
+    'refine_top_k': 3,              # signal_step 细扫的候选数（0 关闭细扫）
+    'progress_every': 100,
+}
+
+
+def main(dataset_dir: str = None, output_dir: str = None, num_workers: int = None):
+    """主函数：为 dataset 增加 reward_table 列并保存
+
+    Args:
+        dataset_dir: 输入 dataset 目录，None 则使用 CONFIG 中的值
+        output_dir: 输出目录，None 则使用 CONFIG 中的值（仍为 None 时原地覆盖）
+        num_workers: 并行 worker 数量，None 则使用 CONFIG 中的值
+    """
+    dataset_dir = dataset_dir or CONFIG['dataset_dir']
+    output_dir = output_dir or CONFIG.get('output_dir') or dataset_dir
+    if num_workers is None:
+        num_workers = CONFIG.get('num_workers', 16)
+
+    REWARD_CONFIG.update({
+        'parallel_workers': int(num_workers),
+        'reward_table_coarse_step': int(CONFIG.get('coarse_step', 5)),
+        'reward_table_refine_top_k': int(CONFIG.get('refine_top_k', 3)),
+    })
+
+    dataset = load_from_disk(dataset_dir)
+    print(f"✓ Dataset 加载成功: {dataset_dir}，样本数: {len(dataset)}")
+    if 'reward_table' in dataset.column_names:
+        print("  - 已存在 reward_table 列，将重新计算")
+        dataset = dataset.remove_columns('reward_table')
+
+    columns = {name: dataset[name] for name in dataset.column_names if name != 'prompt'}
+    t0 = time.time()
+    try:
+        tables = precompute_reward_tables(
+            dataset['prompt'],
+            columns,
+            progress_every=CONFIG.get('progress_every', 100),
+        )
+    finally:
+        cleanup_global_pool()
+    print(f"✓ reward 表计算完成，用时 {time.time() - t0:.1f}s")
+
+    dataset = dataset.add_column('reward_table', tables)
+
+    # 原地覆盖时先写临时目录（load_from_disk 的 dataset 仍引用原目录下的 arrow 文件）
+    if os.path.abspath(output_dir) == os.path.abspath(dataset_dir):
+        tmp_dir = output_dir.rstrip('/') + '.tmp_reward_table'
+        dataset.save_to_disk(tmp_dir)
+        del dataset
+        shutil.rmtree(output_dir)
+        os.rename(tmp_dir, output_dir)
+        dataset = load_from_disk(output_dir)
+    else:
+        dataset.save_to_disk(output_dir)
+    print(f"✓ Dataset 已保存到: {output_dir}")
+
+    # 打印统计信息
+    print("\n=== Reward 表统计 ===")
+    covered = Counter()
+    sizes = Counter()
+    for task_type, raw in zip(columns.get('task_type', []), tables):
+        if raw:
+            covered[task_type] += 1
+            sizes[task_type] += raw.count('"valid"')
+    for task_type, n in sorted(covered.items()):
+        print(f"  - {task_type}: {n} 个样本，平均 {sizes[task_type] / n:.1f} 个动作")
+    print(f"  - 未覆盖样本: {sum(1 for t in tables if not t)}")
+
+    return dataset
+
+
+if __name__ == '__main__':
+    main()
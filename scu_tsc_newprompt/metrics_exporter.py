@@ -0,0 +1,175 @@
+"""
+OpenMetrics text exposition for reward/training diagnostics.
+
+The reward path never touches this module: MetricsExporter calls a `collect()` callback only when
+a scraper hits the HTTP endpoint or when the textfile is due for a rewrite, so the cost of an
+update is whatever the counters already cost. Both outputs are optional and independent:
+
+- http_port: `GET /metrics` on a local ThreadingHTTPServer (daemon thread).
+- textfile:  rewritten every interval_sec via tmp file + os.replace, so readers (e.g. the
+             node_exporter textfile collector, or a plain scp/tail) never see a partial file.
+"""
+
+import math
+import os
+import re
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+_NAME_RE = re.compile(r"[^a-zA-Z0-9_:]")
+
+
+class Sample(NamedTuple):
+    suffix: str  # appended to the family name: "" / "_total" / "_sum" / "_count"
+    labels: Dict[str, str]
+    value: float
+
+
+class MetricFamily(NamedTuple):
+    name: str
+    type: str  # counter | gauge | summary | info | unknown
+    help: str
+    samples: List[Sample]
+
+
+def metric_name(text: str) -> str:
+    """Sanitize an arbitrary key into a metric name component."""
+    name = _NAME_RE.sub("_", str(text))
+    return name if name and not name[0].isdigit() else f"_{name}"
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    v = float(value)
+    if math.isnan(v):
+        return "NaN"
+    if math.isinf(v):
+        return "+Inf" if v > 0 else "-Inf"
+    return repr(v) if not v.is_integer() else str(int(v))
+
+
+def render(families: Iterable[MetricFamily]) -> str:
+    """OpenMetrics text for `families`; families without samples are skipped."""
+    lines: List[str] = []
+    for fam in families:
+        if not fam.samples:
+            continue
+        lines.append(f"# TYPE {fam.name} {fam.type}")
+        if fam.help:
+            lines.append(f"# HELP {fam.name} {_escape(fam.help)}")
+        for s in fam.samples:
+            labels = ",".join(f'{metric_name(k)}="{_escape(v)}"' for k, v in sorted(s.labels.items()))
+            lines.append(f"{fam.name}{s.suffix}{{{labels}}} {_format_value(s.value)}" if labels else
+                         f"{fam.name}{s.suffix} {_format_value(s.value)}")
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+
+def write_atomic(path: str, text: str):
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(prefix=".metrics.", dir=directory)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+class MetricsExporter:
+    """Serve/write `collect()` (OpenMetrics text) over HTTP and/or as an atomically replaced textfile."""
+
+    def __init__(
+        self,
+        collect: Callable[[], str],
+        *,
+        http_port: Optional[int] = None,
+        host: str = "127.0.0.1",
+        textfile: Optional[str] = None,
+        interval_sec: float = 15.0,
+    ):
+        self._collect = collect
+        self.http_port = http_port
+        self.host = host
+        self.textfile = textfile
+        self.interval_sec = max(1.0, float(interval_sec))
+        self._server: Optional[ThreadingHTTPServer] = None
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+    @property
+    def address(self) -> Optional[Tuple[str, int]]:
+        return self._server.server_address[:2] if self._server is not None else None
+
+    def _handler(self):
+        exporter = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                try:
+                    body = exporter._collect().encode("utf-8")
+                except Exception as e:
+                    self.send_error(500, f"{type(e).__name__}: {e}")
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return _Handler
+
+    def start(self):
+        if self.http_port is not None and self._server is None:
+            self._server = ThreadingHTTPServer((self.host, int(self.http_port)), self._handler())
+            self._server.daemon_threads = True
+            t = threading.Thread(target=self._server.serve_forever, name="metrics_http", daemon=True)
+            t.start()
+            self._threads.append(t)
+        if self.textfile:
+            t = threading.Thread(target=self._write_loop, name="metrics_textfile", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def write_textfile(self):
+        if self.textfile:
+            write_atomic(self.textfile, self._collect())
+
+    def _write_loop(self):
+        while True:
+            try:
+                self.write_textfile()
+            except Exception as e:
+                print(f"[metrics_exporter] 写入 {self.textfile} 失败: {e}")
+            if self._stop.wait(self.interval_sec):
+                return
+
+    def stop(self):
+        """Stop serving; the textfile gets a final rewrite so it reflects the end of the run."""
+        self._stop.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        try:
+            self.write_textfile()
+        except Exception:
+            pass
@@ -0,0 +1,219 @@
+"""
+Resource telemetry for reward workers and their SUMO processes, read from /proc (Linux only;
+elsewhere every read returns None and the sampler records nothing).
+
+A background ResourceSampler polls, per worker slot, the worker process and the SUMO processes
+serving it: RSS/PSS, CPU seconds, threads and open fds. Per snapshot window it reports CPU
+utilisation per slot, window peaks per slot and per scenario (of the job running on the slot at
+sample time), and the largest worker + SUMO footprint seen so far, which pool sizing uses instead
+of a configured guess.
+"""
+
+import os
+import threading
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+try:
+    _CLK_TCK = float(os.sysconf("SC_CLK_TCK"))
+except (AttributeError, ValueError, OSError):
+    _CLK_TCK = 100.0
+
+
+class ProcSample(NamedTuple):
+    rss_mb: float
+    pss_mb: Optional[float]  # proportional share (shared pages split between processes); None if unreadable
+    cpu_sec: float  # user + system
+    threads: int
+    fds: Optional[int]  # None without permission to list /proc/<pid>/fd
+
+
+def read_proc(pid: int, pss: bool = True) -> Optional[ProcSample]:
+    """One /proc reading of `pid`; None if the process is gone or /proc is unavailable."""
+    base = f"/proc/{int(pid)}"
+    try:
+        with open(f"{base}/stat") as f:
+            stat = f.read()
+        rss_kb, threads = 0, 0
+        with open(f"{base}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    rss_kb = int(line.split()[1])
+                elif line.startswith("Threads:"):
+                    threads = int(line.split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    # fields after "(comm)": state is field 3, utime/stime are fields 14/15
+    fields = stat[stat.rfind(")") + 2:].split()
+    try:
+        cpu_sec = (int(fields[11]) + int(fields[12])) / _CLK_TCK
+    except (IndexError, ValueError):
+        cpu_sec = 0.0
+    pss_mb = None
+    if pss:
+        try:
+            with open(f"{base}/smaps_rollup") as f:
+                for line in f:
+                    if line.startswith("Pss:"):
+                        pss_mb = int(line.split()[1]) / 1024.0
+                        break
+        except (OSError, ValueError, IndexError):
+            pss_mb = None
+    try:
+        fds: Optional[int] = len(os.listdir(f"{base}/fd"))
+    except OSError:
+        fds = None
+    return ProcSample(rss_kb / 1024.0, pss_mb, cpu_sec, threads, fds)
+
+
+def _footprint(s: ProcSample) -> float:
+    return s.pss_mb if s.pss_mb is not None else s.rss_mb
+
+
+class ResourceSampler:
+    """
+    Periodic /proc sampler for a worker pool.
+
+    - targets() -> {slot: (worker_pid or None, [sumo_pid, ...])} for the running slots; a worker
+      pid of None (thread workers share the trainer process) counts only the SUMO processes.
+    - tags() -> {slot: scenario of the job currently running there, or None when idle}.
+    """
+
+    def __init__(
+        self,
+        targets: Callable[[], Dict[int, Tuple[Optional[int], List[int]]]],
+        tags: Callable[[], Dict[int, Optional[str]]],
+        interval_sec: float = 2.0,
+    ):
+        self._targets = targets
+        self._tags = tags
+        self.interval_sec = max(0.1, float(interval_sec))
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._last_cpu: Dict[int, float] = {}
+        self._sampled = False
+        self._worker_mem_mb: Optional[float] = None
+        self._reset_window(time.monotonic())
+
+    def _reset_window(self, now: float):
+        self._window_start = now
+        self._samples = 0
+        self._slots: Dict[int, Dict[str, float]] = {}
+        self._scenario_peak: Dict[str, float] = {}
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="reward_resource_sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval_sec + 1.0)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval_sec):
+            try:
+                self.sample_once()
+            except Exception:
+                continue
+
+    def sample_once(self):
+        targets = self._targets()
+        tags = self._tags()
+        readings = {}
+        for slot, (worker_pid, sumo_pids) in targets.items():
+            worker = read_proc(worker_pid) if worker_pid is not None else None
+            sumo = [(pid, s) for pid, s in ((pid, read_proc(pid)) for pid in sumo_pids) if s is not None]
+            readings[slot] = (worker_pid, worker, sumo)
+
+        with self._lock:
+            first = not self._sampled
+            self._sampled = True
+            seen: Dict[int, float] = {}
+            for slot, (worker_pid, worker, sumo) in readings.items():
+                cpu_delta = 0.0
+                pairs = ([(worker_pid, worker)] if worker is not None else []) + sumo
+                samples = [s for _, s in pairs]
+                for pid, s in pairs:
+                    # a pid first seen after the first sample started since then: all its CPU is new
+                    prev = self._last_cpu.get(pid, s.cpu_sec if first else 0.0)
+                    cpu_delta += max(0.0, s.cpu_sec - prev)
+                    seen[pid] = s.cpu_sec
+                worker_mb = _footprint(worker) if worker is not None else 0.0
+                sumo_mb = sum((_footprint(s) for _, s in sumo), 0.0)
+                total_mb = worker_mb + sumo_mb
+                slot_stats = self._slots.setdefault(slot, {"cpu_sec": 0.0, "peak_mb": 0.0})
+                slot_stats["cpu_sec"] += cpu_delta
+                slot_stats["peak_mb"] = max(slot_stats["peak_mb"], total_mb)
+                slot_stats.update(
+                    worker_mb=round(worker_mb, 1),
+                    sumo_mb=round(sumo_mb, 1),
+                    sumo_procs=len(sumo),
+                    threads=sum(s.threads for s in samples),
+                    fds=sum(s.fds or 0 for s in samples),
+                )
+                scenario = tags.get(slot)
+                if scenario is not None:
+                    self._scenario_peak[scenario] = max(self._scenario_peak.get(scenario, 0.0), total_mb)
+                if total_mb > 0:
+                    self._worker_mem_mb = max(self._worker_mem_mb or 0.0, total_mb)
+            self._last_cpu = seen
+            self._samples += 1
+
+    def worker_mem_mb(self) -> Optional[float]:
+        """Largest worker + SUMO footprint (MB, PSS when available) observed on one slot; None before any sample."""
+        with self._lock:
+            return self._worker_mem_mb
+
+    def snapshot(self, reset: bool = False) -> Dict[str, object]:
+        now = time.monotonic()
+        with self._lock:
+            wall = max(1e-9, now - self._window_start)
+            slots = {
+                slot: {
+                    **{k: v for k, v in s.items() if k != "cpu_sec"},
+                    "peak_mb": round(s["peak_mb"], 1),
+                    "cpu_util": round(s["cpu_sec"] / wall, 4),
+                }
+                for slot, s in sorted(self._slots.items())
+            }
+            snap = {
+                "samples": self._samples,
+                "window_sec": round(wall, 3),
+                "slots": slots,
+                "scenario_peak_mb": {k: round(v, 1) for k, v in sorted(self._scenario_peak.items())},
+                "worker_mem_mb": None if self._worker_mem_mb is None else round(self._worker_mem_mb, 1),
+            }
+            if reset:
+                self._reset_window(now)
+        return snap
+
+
+def format_resource_lines(stats: Optional[Dict[str, object]], prefix: str = "[reward_diag]") -> List[str]:
+    """Memory/CPU summary of the snapshot window and the worker utilisation of its last training step."""
+    if not stats:
+        return []
+    lines = []
+    slots = stats.get("slots") or {}
+    if slots:
+        peak = max(s["peak_mb"] for s in slots.values())
+        cpu = sum(s["cpu_util"] for s in slots.values()) / len(slots)
+        scenarios = ", ".join(f"{k}:{v:.0f}" for k, v in (stats.get("scenario_peak_mb") or {}).items()) or "n/a"
+        lines.append(
+            f"{prefix}  - resources: workers={len(slots)} peak_mb/worker={peak:.0f} "
+            f"worker_mem_mb={stats.get('worker_mem_mb')} cpu_util/worker={cpu:.2f} scenario_peak_mb={scenarios}"
+        )
+    steps = stats.get("steps") or {}
+    if steps:
+        step, last = max(steps.items())
+        per_slot = " ".join(f"{u:.2f}" for u in (last.get("slot_utilisation") or []))
+        lines.append(
+            f"{prefix}  - pool step {step}: utilisation={last.get('utilisation')} "
+            f"idle_fraction={last.get('idle_fraction')} per_worker=[{per_slot}]"
+        )
+    return lines
@@ -0,0 +1,340 @@
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+
+class TaskFailed(RuntimeError):
+    """A reward job attempt that did not produce a result; `reason` is reported per task."""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class LatencyTracker:
+    """
+    Recent ratios of observed to expected job seconds. Percentiles of the ratio scale a job's
+    expected cost into its hedge threshold / deadline, so long and short jobs get their own limits.
+    """
+
+    def __init__(self, maxlen: int = 512, min_samples: int = 20):
+        self.min_samples = int(min_samples)
+        self._ratios: "deque[float]" = deque(maxlen=int(maxlen))
+        self._lock = threading.Lock()
+
+    def observe(self, elapsed_sec: float, expected_sec: float):
+        if expected_sec > 0:
+            with self._lock:
+                self._ratios.append(float(elapsed_sec) / float(expected_sec))
+
+    def ratio_quantile(self, q: float) -> Optional[float]:
+        """q-th percentile (0-100) of the ratio; None until min_samples observations."""
+        with self._lock:
+            data = sorted(self._ratios)
+        if len(data) < self.min_samples:
+            return None
+        idx = min(len(data) - 1, max(0, int(round(q / 100.0 * (len(data) - 1)))))
+        return data[idx]
+
+
+class JobProfile(NamedTuple):
+    """Scheduling attributes of one reward job."""
+
+    net_key: str  # sumocfg: a worker holding it skips the SUMO start
+    state_key: str  # state_path: a worker holding it skips loadState
+    scenario: str  # cost-model bucket
+    work: float  # scenario-independent work units (see job_work)
+
+
+def job_work(state_path: str, window_sec: float) -> float:
+    """
+    Work units of simulating `window_sec` seconds from `state_path`.
+    The state file size (KB) stands in for the vehicle count: the saved state is dominated by
+    per-vehicle entries and is available without parsing.
+    """
+    try:
+        size_kb = os.path.getsize(state_path) / 1024.0
+    except OSError:
+        size_kb = 1.0
+    return max(1.0, float(window_sec)) * max(1.0, size_kb)
+
+
+class TaskCostModel:
+    """
+    Learned seconds-per-work-unit per scenario (EMA over observed warm jobs).
+    Unseen scenarios use the median of the known ones, or `prior` before any observation.
+    """
+
+    def __init__(self, prior: float = 2e-5, alpha: float = 0.2):
+        self.prior = float(prior)
+        self.alpha = float(alpha)
+        self._rate: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def rate(self, scenario: str) -> float:
+        with self._lock:
+            r = self._rate.get(scenario)
+            if r is not None:
+                return r
+            known = sorted(self._rate.values())
+        return known[len(known) // 2] if known else self.prior
+
+    def predict(self, profile: JobProfile) -> float:
+        return self.rate(profile.scenario) * profile.work
+
+    def observe(self, profile: JobProfile, elapsed_sec: float):
+        if profile.work <= 0 or elapsed_sec <= 0:
+            return
+        sample = float(elapsed_sec) / profile.work
+        with self._lock:
+            old = self._rate.get(profile.scenario)
+            self._rate[profile.scenario] = sample if old is None else (1 - self.alpha) * old + self.alpha * sample
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            return dict(self._rate)
+
+
+class AffinityScheduler:
+    """
+    Run jobs on `num_slots` worker slots (one pool process or thread each):
+
+    1. Jobs are placed longest-expected-first on the slot with the earliest expected finish time,
+       where a slot that already holds the job's sumocfg (and state) is charged no switch cost.
+    2. One dispatcher thread per slot pops its own queue from the front and, when empty, steals
+       from the busiest slot: a job on a network it already holds, else the tail job if the victim
+       would stay busy longer than the cold start costs.
+    3. Observed wall times of warm jobs update the cost model and the latency tracker; the last
+       network/state of each slot is remembered for the next batch.
+    4. Optionally, idle slots re-run stragglers (hedging) and failed jobs get per-job failure results.
+    """
+
+    def __init__(
+        self,
+        num_slots: int,
+        cost_model: TaskCostModel,
+        *,
+        switch_state_sec: float = 0.05,
+        switch_net_sec: float = 2.0,
+        nets_per_slot: int = 1,
+    ):
+        self.num_slots = max(1, int(num_slots))
+        self.cost_model = cost_model
+        self.switch_state_sec = float(switch_state_sec)
+        self.switch_net_sec = float(switch_net_sec)
+        self.nets_per_slot = max(1, int(nets_per_slot))
+        # per slot: warm sumocfgs (LRU) and the state_path loaded last
+        self._warm_nets: List["OrderedDict[str, None]"] = [OrderedDict() for _ in range(self.num_slots)]
+        self._warm_state: List[Optional[str]] = [None] * self.num_slots
+        self.latency = LatencyTracker()
+        self.stats = {"jobs": 0, "affinity_hits": 0, "steals": 0, "hedges": 0, "failures": 0}
+
+    def resize(self, num_slots: int):
+        """Change the slot count, keeping the warm network/state of the slots that remain."""
+        n = max(1, int(num_slots))
+        self._warm_nets = (self._warm_nets + [OrderedDict() for _ in range(n)])[:n]
+        self._warm_state = (self._warm_state + [None] * n)[:n]
+        self.num_slots = n
+
+    def forget(self, slots: List[int]):
+        """Drop the warm network/state of slots whose worker was stopped or replaced."""
+        for slot in slots:
+            if slot < self.num_slots:
+                self._warm_nets[slot].clear()
+                self._warm_state[slot] = None
+
+    def _mark_warm(self, slot: int, profile: JobProfile):
+        nets = self._warm_nets[slot]
+        nets[profile.net_key] = None
+        nets.move_to_end(profile.net_key)
+        while len(nets) > self.nets_per_slot:
+            nets.popitem(last=False)
+        self._warm_state[slot] = profile.state_key
+
+    def plan(self, profiles: List[JobProfile]) -> Tuple[List["deque[int]"], List[float]]:
+        """Assign job indices to slot queues; returns (queues, expected cost per job)."""
+        costs = [self.cost_model.predict(p) for p in profiles]
+        order = sorted(range(len(profiles)), key=lambda i: -costs[i])
+        queues: List["deque[int]"] = [deque() for _ in range(self.num_slots)]
+        load = [0.0] * self.num_slots
+        # networks/states each slot holds or will load for its queued jobs (queues are grouped below,
+        # so each one is switched to once per slot)
+        nets = [set(n) for n in self._warm_nets]
+        states = [{st} if st is not None else set() for st in self._warm_state]
+        for i in order:
+            p = profiles[i]
+            best, best_finish = 0, None
+            for s in range(self.num_slots):
+                if p.state_key in states[s]:
+                    switch = 0.0
+                elif p.net_key in nets[s]:
+                    switch = self.switch_state_sec
+                else:
+                    switch = self.switch_net_sec + self.switch_state_sec
+                finish = load[s] + switch + costs[i]
+                if best_finish is None or finish < best_finish:
+                    best, best_finish = s, finish
+            queues[best].append(i)
+            load[best] = best_finish
+            nets[best].add(p.net_key)
+            states[best].add(p.state_key)
+
+        # per slot: warm network/state first, then by first appearance; longest-first within a group
+        for s, q in enumerate(queues):
+            net_rank = {net: -1 for net in self._warm_nets[s]}
+            state_rank = {self._warm_state[s]: -1}
+            for i in q:
+                net_rank.setdefault(profiles[i].net_key, len(net_rank))
+                state_rank.setdefault(profiles[i].state_key, len(state_rank))
+            queues[s] = deque(sorted(q, key=lambda i: (net_rank[profiles[i].net_key], state_rank[profiles[i].state_key])))
+        return queues, costs
+
+    def run(
+        self,
+        run_on: Callable[[int, Any, float], Any],
+        jobs: List[Any],
+        profiles: List[JobProfile],
+        *,
+        fail: Optional[Callable[[Any, str], Any]] = None,
+        hedge_after: Optional[Callable[[float], Optional[float]]] = None,
+        cancel: Optional[Callable[[int], None]] = None,
+    ) -> List[Any]:
+        """
+        Execute run_on(slot, job, expected_sec) for every job; returns results in job order.
+
+        - fail(job, reason): result used for a job whose attempts all raised (TaskFailed.reason or
+          the exception type). Without it the first error is re-raised after the batch.
+        - hedge_after(expected_sec): seconds after which an idle slot re-runs a still-running job
+          (None: never). The first attempt to finish wins; cancel(slot) aborts the other one.
+        """
+        queues, costs = self.plan(profiles)
+        remaining = [sum(costs[i] for i in q) for q in queues]
+        results: List[Any] = [None] * len(jobs)
+        done = [False] * len(jobs)
+        running: Dict[int, Dict[int, float]] = {}  # job -> {slot: start time}
+        hedged = set()
+        cancelling = set()  # slots whose losing attempt is being cancelled; they take no new job meanwhile
+        errors: List[BaseException] = []
+        lock = threading.Lock()
+        wait = object()
+
+        def _next_job(slot: int):
+            with lock:
+                if slot in cancelling:
+                    return wait
+                if queues[slot]:
+                    i = queues[slot].popleft()
+                    remaining[slot] -= costs[i]
+                    return i
+                i = _steal(slot)
+                if i is not None:
+                    self.stats["steals"] += 1
+                    return i
+                if hedge_after is None:
+                    return None
+                # nothing queued: hedge the oldest straggler, or wait while one may still become one
+                now = time.perf_counter()
+                pending = False
+                for i, attempts in running.items():
+                    if done[i] or i in hedged or slot in attempts:
+                        continue
+                    limit = hedge_after(costs[i])
+                    if limit is None:
+                        continue
+                    if now - min(attempts.values()) >= limit:
+                        hedged.add(i)
+                        self.stats["hedges"] += 1
+                        return i
+                    pending = True
+                return wait if pending else None
+
+        def _steal(slot: int) -> Optional[int]:
+            # busiest victim first; prefer a job on a network this slot already holds, otherwise take
+            # the victim's tail job only if the victim would stay busy longer than a cold start here
+            warm_nets = self._warm_nets[slot]
+            for victim in sorted(range(self.num_slots), key=lambda s: -remaining[s]):
+                q = queues[victim]
+                if not q:
+                    continue
+                for pos in range(len(q) - 1, -1, -1):
+                    i = q[pos]
+                    if profiles[i].net_key in warm_nets:
+                        del q[pos]
+                        remaining[victim] -= costs[i]
+                        return i
+                i = q[-1]
+                if remaining[victim] - costs[i] >= self.switch_net_sec + costs[i]:
+                    q.pop()
+                    remaining[victim] -= costs[i]
+                    return i
+            return None
+
+        def _dispatch(slot: int):
+            while not errors:
+                i = _next_job(slot)
+                if i is None:
+                    return
+                if i is wait:
+                    time.sleep(0.05)
+                    continue
+                p = profiles[i]
+                with lock:
+                    warm = p.net_key in self._warm_nets[slot]
+                    self.stats["jobs"] += 1
+                    self.stats["affinity_hits"] += int(warm)
+                    t0 = time.perf_counter()
+                    running.setdefault(i, {})[slot] = t0
+                try:
+                    value, error = run_on(slot, jobs[i], costs[i]), None
+                except BaseException as e:
+                    value, error = None, e
+                elapsed = time.perf_counter() - t0
+                with lock:
+                    attempts = running.get(i, {})
+                    attempts.pop(slot, None)
+                    losers: List[int] = []
+                    if error is None:
+                        self._mark_warm(slot, p)
+                        if not done[i]:
+                            results[i], done[i] = value, True
+                            losers = list(attempts)
+                            cancelling.update(losers)
+                            if warm:
+                                self.cost_model.observe(p, elapsed)
+                                self.latency.observe(elapsed, costs[i])
+                    else:
+                        self._warm_nets[slot].clear()
+                        self._warm_state[slot] = None
+                        if not done[i] and not attempts:
+                            if fail is None:
+                                errors.append(error)
+                            else:
+                                results[i], done[i] = fail(jobs[i], getattr(error, "reason", type(error).__name__)), True
+                                self.stats["failures"] += 1
+                    if not attempts:
+                        running.pop(i, None)
+                # cancel outside the lock (recycling a process worker blocks); a loser cannot start its
+                # next job until it leaves `cancelling`, and one whose attempt already ended is left alone
+                for other in losers:
+                    with lock:
+                        still_running = other in running.get(i, {})
+                    try:
+                        if cancel is not None and still_running:
+                            cancel(other)
+                    finally:
+                        with lock:
+                            cancelling.discard(other)
+
+        threads = [
+            threading.Thread(target=_dispatch, args=(s,), name=f"reward_sched_{s}", daemon=True)
+            for s in range(self.num_slots)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0]
+        return results
@@ -1,10 +1,13 @@
+import heapq
 import json
 import math
 import re
-from collections import deque
+from collections import Counter, deque
 from dataclasses import dataclass, field
 from typing import Any, Dict, List, Optional, Tuple
 
+import numpy as np
+
 
 @dataclass
 class ParsedPlan:
@@ -175,29 +178,121 @@ def compute_soft_constraint_reward(
 # ==================== 自适应尺度器（按路口维护 P95）====================
 
 
+class SlidingQuantile:
+    """
+    窗口内数值的 q 分位数（排序后下标 min(int(n*q), n-1) 处的值，与对整个窗口排序取值完全相同）。
+    双堆 + 惰性删除：_low（取负的最大堆）保存最小的 k = idx+1 个值，其余在 _high；
+    insert / remove 均摊 O(log n)，分位数即 _low 堆顶。
+    """
+
+    def __init__(self, q: float = 0.95):
+        self.q = float(q)
+        self._low: List[float] = []  # 取负
+        self._high: List[float] = []
+        self._low_size = 0
+        self._high_size = 0
+        self._low_deleted: Counter = Counter()
+        self._high_deleted: Counter = Counter()
+
+    def __len__(self) -> int:
+        return self._low_size + self._high_size
+
+    def _prune(self):
+        while self._low and self._low_deleted[-self._low[0]] > 0:
+            self._low_deleted[-heapq.heappop(self._low)] -= 1
+        while self._high and self._high_deleted[self._high[0]] > 0:
+            self._high_deleted[heapq.heappop(self._high)] -= 1
+
+    def _rebalance(self):
+        n = len(self)
+        k = min(int(n * self.q), n - 1) + 1 if n else 0
+        while self._low_size > k:
+            heapq.heappush(self._high, -heapq.heappop(self._low))
+            self._low_size -= 1
+            self._high_size += 1
+            self._prune()
+        while self._low_size < k:
+            heapq.heappush(self._low, -heapq.heappop(self._high))
+            self._low_size += 1
+            self._high_size -= 1
+            self._prune()
+        # 惰性删除的残留过多时重建（只保留有效值）
+        if len(self._low) + len(self._high) > 4 * max(16, n):
+            low = sorted(-v for v in self._low)
+            high = sorted(self._high)
+            for v, c in self._low_deleted.items():
+                for _ in range(c):
+                    low.remove(v)
+            for v, c in self._high_deleted.items():
+                for _ in range(c):
+                    high.remove(v)
+            self._low = [-v for v in low]
+            heapq.heapify(self._low)
+            self._high = high
+            self._low_deleted.clear()
+            self._high_deleted.clear()
+
+    def insert(self, v: float):
+        if self._low and v <= -self._low[0]:
+            heapq.heappush(self._low, -v)
+            self._low_size += 1
+        else:
+            heapq.heappush(self._high, v)
+            self._high_size += 1
+        self._rebalance()
+
+    def remove(self, v: float):
+        """删除一个已插入的值（调用方保证存在）"""
+        if self._low and v <= -self._low[0]:
+            self._low_deleted[v] += 1
+            self._low_size -= 1
+        else:
+            self._high_deleted[v] += 1
+            self._high_size -= 1
+        self._prune()
+        self._rebalance()
+
+    def value(self) -> Optional[float]:
+        return -self._low[0] if self._low_size else None
+
+
 @dataclass
 class MetricBuffer:
-    """单个指标的滑动窗口缓冲区"""
+    """单个指标的滑动窗口缓冲区（P95 由 SlidingQuantile 增量维护）"""
     values: deque = field(default_factory=lambda: deque(maxlen=200))
     scale: float = 1.0  # 当前 P95 尺度
-    
-    def add(self, v: float):
+    _quantile: SlidingQuantile = field(default_factory=lambda: SlidingQuantile(0.95), repr=False, compare=False)
+
+    def _push(self, v: float):
+        if self.values.maxlen is not None and len(self.values) == self.values.maxlen:
+            self._quantile.remove(self.values[0])
         self.values.append(v)
+        self._quantile.insert(v)
+
+    def add(self, v: float):
+        self._push(v)
         self._update_scale()
     
     def add_batch(self, vs: List[float]):
         for v in vs:
-            self.values.append(v)
+            self._push(v)
         self._update_scale()
     
     def _update_scale(self):
         if len(self.values) < 5:
             return  # 数据太少，保持默认
-        sorted_vals = sorted(self.values)
-        idx = int(len(sorted_vals) * 0.95)
-        idx = min(idx, len(sorted_vals) - 1)
-        p95 = sorted_vals[idx]
-        self.scale = max(1.0, p95)  # 至少为 1，防止除零
+        self.scale = max(1.0, self._quantile.value())  # 至少为 1，防止除零
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"values": list(self.values), "scale": self.scale, "maxlen": self.values.maxlen}
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> "MetricBuffer":
+        buf = cls(values=deque(maxlen=d.get("maxlen", 200)))
+        buf.add_batch([float(v) for v in d.get("values", [])])
+        if len(buf.values) < 5:
+            buf.scale = float(d.get("scale", buf.scale))
+        return buf
 
 
 @dataclass
@@ -222,11 +317,10 @@ class AdaptiveScaler:
         self.proxy_buf.add(proxy)
     
     def add_observations_batch(self, results: List[Dict[str, float]]):
-        """批量添加多个评估结果"""
-        for r in results:
-            self.passed_buf.add(r.get('passed_vehicles', 0.0))
-            self.queue_buf.add(r.get('queue_vehicles', 0.0))
-            self.proxy_buf.add(r.get('total_queue_proxy', 0.0))
+        """批量添加多个评估结果（每个指标只在最后更新一次尺度）"""
+        self.passed_buf.add_batch([r.get('passed_vehicles', 0.0) for r in results])
+        self.queue_buf.add_batch([r.get('queue_vehicles', 0.0) for r in results])
+        self.proxy_buf.add_batch([r.get('total_queue_proxy', 0.0) for r in results])
     
     def get_scales(self) -> Tuple[float, float, float]:
         """返回 (passed_scale, queue_scale, proxy_scale)"""
@@ -239,6 +333,28 @@ class AdaptiveScaler:
         """用 warmup 阶段的数据初始化尺度"""
         self.add_observations_batch(results)
 
+    def to_dict(self) -> Dict[str, Any]:
+        """可 JSON 序列化的状态（窗口内的观测值 + 默认尺度），用于跨进程/重启恢复"""
+        return {
+            "passed": self.passed_buf.to_dict(),
+            "queue": self.queue_buf.to_dict(),
+            "proxy": self.proxy_buf.to_dict(),
+            "default_passed_scale": self.default_passed_scale,
+            "default_queue_scale": self.default_queue_scale,
+            "default_proxy_scale": self.default_proxy_scale,
+        }
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> "AdaptiveScaler":
+        return cls(
+            passed_buf=MetricBuffer.from_dict(d.get("passed", {})),
+            queue_buf=MetricBuffer.from_dict(d.get("queue", {})),
+            proxy_buf=MetricBuffer.from_dict(d.get("proxy", {})),
+            default_passed_scale=float(d.get("default_passed_scale", 20.0)),
+            default_queue_scale=float(d.get("default_queue_scale", 30.0)),
+            default_proxy_scale=float(d.get("default_proxy_scale", 2000.0)),
+        )
+
 
 def compute_sim_reward_adaptive(
     result: Dict[str, float],
@@ -298,6 +414,41 @@ def compute_sim_reward_adaptive(
     return sim_reward, info
 
 
+def compute_sim_rewards_adaptive(
+    results: List[Dict[str, float]],
+    scaler: AdaptiveScaler,
+    w_passed: float = 1.0,
+    w_queue: float = 1.0,
+    w_proxy: float = 0.2,
+    observe: bool = False,
+) -> np.ndarray:
+    """
+    compute_sim_reward_adaptive 的批量版本（同一路口的一组仿真结果），返回 sim_reward 数组。
+
+    observe=True 时先把每个结果依次加入 scaler 再打分，第 j 个结果使用加入前 j+1 个观测后的尺度，
+    与逐个 add_observation + compute_sim_reward_adaptive 的尺度完全相同；reward 仅有浮点舍入差异
+    （np.tanh 与 math.tanh 可能相差 1 ulp）。
+    """
+    n = len(results)
+    passed = np.array([r.get('passed_vehicles', 0.0) for r in results], dtype=np.float64)
+    queue = np.array([r.get('queue_vehicles', 0.0) for r in results], dtype=np.float64)
+    proxy = np.array([r.get('total_queue_proxy', 0.0) for r in results], dtype=np.float64)
+
+    if observe:
+        scales = np.empty((n, 3), dtype=np.float64)
+        for j in range(n):
+            scaler.add_observation(passed=float(passed[j]), queue=float(queue[j]), proxy=float(proxy[j]))
+            scales[j] = scaler.get_scales()
+    else:
+        scales = np.tile(np.array(scaler.get_scales(), dtype=np.float64), (n, 1))
+
+    R_passed = np.tanh(passed / scales[:, 0])
+    R_queue = -np.tanh(queue / scales[:, 1])
+    R_proxy = -np.tanh(proxy / scales[:, 2])
+    total_weight = w_passed + w_queue + w_proxy
+    return (w_passed * R_passed + w_queue * R_queue + w_proxy * R_proxy) / total_weight * 1.5
+
+
 def compute_total_reward(
     constraint_score: float,
     sim_reward: float,
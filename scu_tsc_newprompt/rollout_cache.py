@@ -0,0 +1,176 @@
+import hashlib
+import json
+import os
+import sqlite3
+import subprocess
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+
+# 缓存 key 的语义版本：仿真窗口/指标定义变化时递增，使旧条目自然失效
+ROLLOUT_CACHE_SCHEMA = 3
+
+_STATE_DIGESTS: Dict[Tuple[str, int, int], str] = {}
+_SUMO_VERSION: Optional[str] = None
+
+
+def state_file_digest(state_path: str) -> Optional[str]:
+    """
+    Return sha1 of the state file bytes (memoized by path + mtime + size).
+    Returns None if the file cannot be read.
+    """
+    try:
+        st = os.stat(state_path)
+    except OSError:
+        return None
+    memo_key = (state_path, int(st.st_mtime_ns), int(st.st_size))
+    digest = _STATE_DIGESTS.get(memo_key)
+    if digest is not None:
+        return digest
+    h = hashlib.sha1()
+    try:
+        with open(state_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+    except OSError:
+        return None
+    digest = h.hexdigest()
+    _STATE_DIGESTS[memo_key] = digest
+    return digest
+
+
+def detect_sumo_version() -> str:
+    """Best-effort SUMO version string (first line of `sumo --version`), cached per process."""
+    global _SUMO_VERSION
+    if _SUMO_VERSION is not None:
+        return _SUMO_VERSION
+    binary = "sumo"
+    sumo_home = os.environ.get("SUMO_HOME")
+    if sumo_home and os.path.isfile(os.path.join(sumo_home, "bin", "sumo")):
+        binary = os.path.join(sumo_home, "bin", "sumo")
+    version = "unknown"
+    try:
+        res = subprocess.run([binary, "--version"], capture_output=True, text=True, check=False, timeout=10)
+        for line in (res.stdout or "").splitlines():
+            line = line.strip()
+            if line:
+                version = line
+                break
+    except Exception:
+        pass
+    _SUMO_VERSION = version
+    return version
+
+
+def make_rollout_key(state_digest: str, fields: Any, sumo_version: str) -> str:
+    """
+    Build a cache key from state content digest + task fields (task type, normalized action,
+    TLS durations, decision context) + SUMO version. `fields` must be JSON serializable.
+    """
+    payload = json.dumps(
+        [ROLLOUT_CACHE_SCHEMA, state_digest, sumo_version, fields],
+        sort_keys=True,
+        ensure_ascii=False,
+        default=str,
+    )
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+class RolloutMetricsCache:
+    """
+    Single-file SQLite cache of raw rollout metrics (passed_total / avg_passed_veh / avg_queue_veh / flags).
+
+    - Stores metrics only, never rewards: rewards are recomputed from metrics with the current
+      REWARD_CONFIG, so weight changes do not invalidate entries.
+    - WAL journal + busy timeout make it safe to share between processes (reward workers, DDP ranks).
+    - Connections are opened lazily per process/thread, so the object survives fork.
+    """
+
+    def __init__(self, path: str, timeout_sec: float = 30.0):
+        self.path = path
+        self.timeout_sec = float(timeout_sec)
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self._local = threading.local()
+        self._pid = None
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and self._pid == os.getpid():
+            return conn
+        parent = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(parent, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=self.timeout_sec, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS rollout_metrics ("
+            " key TEXT PRIMARY KEY,"
+            " metrics TEXT NOT NULL,"
+            " created REAL NOT NULL)"
+        )
+        self._local.conn = conn
+        self._pid = os.getpid()
+        return conn
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        keys = list(dict.fromkeys(keys))
+        found: Dict[str, Dict[str, Any]] = {}
+        if not keys:
+            return found
+        conn = self._conn()
+        # SQLite 默认最多 999 个绑定参数
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            placeholders = ",".join("?" for _ in chunk)
+            rows = conn.execute(
+                f"SELECT key, metrics FROM rollout_metrics WHERE key IN ({placeholders})",
+                chunk,
+            ).fetchall()
+            for key, raw in rows:
+                try:
+                    found[key] = json.loads(raw)
+                except Exception:
+                    continue
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, items: List[Tuple[str, Dict[str, Any]]]):
+        if not items:
+            return
+        now = time.time()
+        rows = [(k, json.dumps(v, sort_keys=True), now) for k, v in items]
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "INSERT OR REPLACE INTO rollout_metrics (key, metrics, created) VALUES (?, ?, ?)",
+                rows,
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        self.writes += len(rows)
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "path": self.path,
+            "hits": int(self.hits),
+            "misses": int(self.misses),
+            "writes": int(self.writes),
+            "hit_rate": (self.hits / total) if total else 0.0,
+        }
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            try:
+                conn.close()
+            except Exception:
+                pass
+            self._local.conn = None
@@ -0,0 +1,240 @@
+"""
+SUMO simulation backends.
+
+- traci:   SUMOSimulator over a TCP socket to a separate SUMO process (needs a port per instance).
+- libsumo: SUMO runs inside the calling process; same API as traci without socket round trips.
+           Only one simulation per process.
+
+Callers obtain the TraCI-compatible module via `backend.api` instead of `import traci`, and create
+simulators via `backend.create_simulator(...)`; both objects expose the SUMOSimulator methods used by
+the dataset generators and reward functions.
+
+With `label=...`, the traci backend returns a TraciConnectionSimulator on its own labeled TraCI
+connection; several of them can be driven from different threads of one process, each through its
+`simulator.api` handle instead of the global traci module.
+"""
+
+import abc
+from typing import Any, Dict, List, Optional
+
+
+class TraciBackend:
+    name = "traci"
+    uses_ports = True
+    max_instances: Optional[int] = None
+
+    @property
+    def api(self):
+        import traci
+
+        return traci
+
+    def create_simulator(
+        self,
+        sumocfg: str,
+        *,
+        port: Optional[int] = None,
+        gui: bool = False,
+        verbose: Optional[bool] = None,
+        additional_options: Optional[List[str]] = None,
+        label: Optional[str] = None,
+    ):
+        if label is not None:
+            return TraciConnectionSimulator(
+                sumocfg, port=port, label=label, additional_options=additional_options, verbose=bool(verbose)
+            )
+
+        from sumo_simulator import SUMOSimulator
+
+        kwargs: Dict[str, Any] = {
+            "config_file": sumocfg,
+            "junctions_file": None,
+            "gui": gui,
+            "port": port,
+        }
+        if additional_options is not None:
+            kwargs["additional_options"] = list(additional_options)
+        if verbose is not None:
+            kwargs["verbose"] = verbose
+        return SUMOSimulator(**kwargs)
+
+
+class LibsumoBackend:
+    name = "libsumo"
+    uses_ports = False
+    max_instances: Optional[int] = 1
+
+    @property
+    def api(self):
+        import libsumo
+
+        return libsumo
+
+    def create_simulator(
+        self,
+        sumocfg: str,
+        *,
+        port: Optional[int] = None,
+        gui: bool = False,
+        verbose: Optional[bool] = None,
+        additional_options: Optional[List[str]] = None,
+        label: Optional[str] = None,
+    ):
+        # libsumo 无 GUI、无端口、无多连接；port/gui/label 参数仅为与 TraciBackend 对齐
+        return LibsumoSimulator(sumocfg, additional_options=additional_options, verbose=bool(verbose))
+
+
+class _ApiSimulator(abc.ABC):
+    """
+    Minimal SUMOSimulator counterpart on top of a TraCI-compatible API object (`self._api`).
+    Phase-controlled incoming lanes: incoming lanes of links whose state in that phase is G/g.
+    """
+
+    def __init__(self, sumocfg: str, additional_options: Optional[List[str]] = None, verbose: bool = False):
+        self._api: Any = None
+        self.config_file = sumocfg
+        self._options = list(additional_options or [])
+        self._verbose = bool(verbose)
+        self._connected = False
+        self._phase_lanes: Dict[tuple, List[str]] = {}
+
+    @property
+    def api(self):
+        """TraCI-compatible handle driving this simulator"""
+        return self._api
+
+    def _command(self) -> List[str]:
+        cmd = ["sumo", "-c", self.config_file]
+        if not self._verbose:
+            cmd += ["--no-step-log", "true", "--no-warnings", "true"]
+        return cmd + self._options
+
+    @abc.abstractmethod
+    def _start(self, cmd: List[str]):
+        """Launch SUMO with `cmd` and bind `self._api` to it."""
+
+    def start_simulation(self) -> bool:
+        try:
+            self._start(self._command())
+        except Exception as e:
+            print(f"[{type(self).__name__}] 启动失败: {e}")
+            return False
+        self._connected = True
+        self._phase_lanes.clear()
+        return True
+
+    def is_connected(self) -> bool:
+        return self._connected
+
+    def step(self):
+        self._api.simulationStep()
+
+    def get_phase_info(self, tl_id: str) -> Dict[str, Any]:
+        logics = self._api.trafficlight.getAllProgramLogics(tl_id)
+        phases = logics[0].phases if logics else []
+        return {
+            "num_phases": len(phases),
+            "phase_states": [ph.state for ph in phases],
+            "current_phase_index": int(self._api.trafficlight.getPhase(tl_id)),
+        }
+
+    def get_phase_controlled_lanes(self, tl_id: str, phase_idx: int) -> Dict[str, Any]:
+        key = (tl_id, int(phase_idx))
+        if key not in self._phase_lanes:
+            states = self.get_phase_info(tl_id)["phase_states"]
+            lanes: List[str] = []
+            if 0 <= int(phase_idx) < len(states):
+                state = states[int(phase_idx)]
+                links = self._api.trafficlight.getControlledLinks(tl_id)
+                for link_idx, link in enumerate(links):
+                    if link_idx < len(state) and state[link_idx] in "Gg":
+                        for in_lane, _out_lane, _via in link:
+                            if in_lane not in lanes:
+                                lanes.append(in_lane)
+            self._phase_lanes[key] = lanes
+        return {"incoming_lanes": list(self._phase_lanes[key])}
+
+    def restore_simulation_state(self, state_path: str):
+        self._api.simulation.loadState(state_path)
+
+    def close(self):
+        if self._connected:
+            try:
+                self._api.close()
+            except Exception:
+                pass
+            self._connected = False
+
+
+class LibsumoSimulator(_ApiSimulator):
+    """In-process libsumo simulation (one per process)."""
+
+    def __init__(self, sumocfg: str, additional_options: Optional[List[str]] = None, verbose: bool = False):
+        import libsumo
+
+        super().__init__(sumocfg, additional_options=additional_options, verbose=verbose)
+        self._api = libsumo
+
+    def _start(self, cmd: List[str]):
+        self._api.start(cmd)
+
+
+class _ConnectionApi:
+    """traci-module-shaped view of one labeled connection: domains/simulationStep from the connection, constants from traci."""
+
+    def __init__(self, connection):
+        import traci
+
+        self._connection = connection
+        self.constants = traci.constants
+
+    def __getattr__(self, name: str):
+        return getattr(self._connection, name)
+
+
+class TraciConnectionSimulator(_ApiSimulator):
+    """
+    SUMO process on its own labeled TraCI connection. Does not switch the global traci connection,
+    so several instances can be driven concurrently from different threads.
+    """
+
+    def __init__(
+        self,
+        sumocfg: str,
+        *,
+        port: Optional[int],
+        label: str,
+        additional_options: Optional[List[str]] = None,
+        verbose: bool = False,
+    ):
+        super().__init__(sumocfg, additional_options=additional_options, verbose=verbose)
+        self.port = port
+        self.label = label
+
+    def _start(self, cmd: List[str]):
+        import traci
+
+        traci.start(cmd, port=self.port, label=self.label, doSwitch=False)
+        self._api = _ConnectionApi(traci.getConnection(self.label))
+
+
+_BACKENDS = {
+    "traci": TraciBackend(),
+    "libsumo": LibsumoBackend(),
+}
+
+
+def get_backend(name: Optional[str] = None):
+    """Return the backend registered under `name` (default: traci)."""
+    key = str(name or "traci").lower()
+    if key not in _BACKENDS:
+        raise ValueError(f"未知的仿真后端: {name}（可选: {', '.join(_BACKENDS)}）")
+    return _BACKENDS[key]
+
+
+def libsumo_available() -> bool:
+    try:
+        import libsumo  # noqa: F401
+    except Exception:
+        return False
+    return True
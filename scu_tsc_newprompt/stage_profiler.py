@@ -0,0 +1,139 @@
+"""
+Per-stage latency histograms for reward evaluation.
+
+Reward workers time each stage of a job (SUMO start, state restore, TLS re-timing, stepping, lane
+polling, teardown) and return the per-job seconds next to the job result; the parent records them
+here per (scenario, task_type). Histograms use log-spaced buckets, so memory stays constant and
+percentiles are accurate to the bucket width (~19%, four buckets per doubling).
+"""
+
+import math
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# display order; stages not listed here are printed after these
+STAGES = ("sumo_start", "restore_state", "apply_tls", "step", "lane_poll", "teardown", "total")
+
+_BUCKETS_PER_OCTAVE = 4
+_MIN_SEC = 1e-4  # everything below falls into bucket 0
+
+
+def _bucket(sec: float) -> int:
+    if sec <= _MIN_SEC:
+        return 0
+    return 1 + int(math.log2(sec / _MIN_SEC) * _BUCKETS_PER_OCTAVE)
+
+
+def _bucket_bounds(b: int) -> Tuple[float, float]:
+    if b == 0:
+        return 0.0, _MIN_SEC
+    return _MIN_SEC * 2 ** ((b - 1) / _BUCKETS_PER_OCTAVE), _MIN_SEC * 2 ** (b / _BUCKETS_PER_OCTAVE)
+
+
+class StageHistogram:
+    """Log-bucket histogram of one stage's per-job seconds."""
+
+    def __init__(self):
+        self.counts: Dict[int, int] = {}
+        self.n = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def copy(self) -> "StageHistogram":
+        h = StageHistogram()
+        h.counts, h.n, h.total, h.max = dict(self.counts), self.n, self.total, self.max
+        return h
+
+    def add(self, sec: float):
+        sec = max(0.0, float(sec))
+        b = _bucket(sec)
+        self.counts[b] = self.counts.get(b, 0) + 1
+        self.n += 1
+        self.total += sec
+        self.max = max(self.max, sec)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """q in [0, 1]; geometric interpolation inside the bucket, capped at the observed max."""
+        if not self.n:
+            return None
+        rank = q * self.n
+        seen = 0
+        for b in sorted(self.counts):
+            c = self.counts[b]
+            if seen + c >= rank:
+                lo, hi = _bucket_bounds(b)
+                frac = (rank - seen) / c
+                value = lo + (hi - lo) * frac if lo <= 0 else lo * (hi / lo) ** frac
+                return min(value, self.max)
+            seen += c
+        return self.max
+
+    def summary(self) -> Dict[str, float]:
+        return {
+            "n": self.n,
+            "mean": self.total / self.n if self.n else 0.0,
+            "p50": self.quantile(0.5) or 0.0,
+            "p95": self.quantile(0.95) or 0.0,
+            "p99": self.quantile(0.99) or 0.0,
+            "max": self.max,
+            "sum": self.total,
+        }
+
+    def histogram(self) -> List[Tuple[float, float, int]]:
+        """[(bucket_lo_sec, bucket_hi_sec, count), ...] for the non-empty buckets."""
+        return [(*_bucket_bounds(b), self.counts[b]) for b in sorted(self.counts)]
+
+
+class StageProfile:
+    """
+    Stage histograms per (scenario, task_type); thread-safe. Keeps a resettable window and a
+    cumulative copy (for exporters that need monotonic counts).
+    """
+
+    def __init__(self):
+        self._hists: Dict[Tuple[str, str], Dict[str, StageHistogram]] = {}
+        self._total: Dict[Tuple[str, str], Dict[str, StageHistogram]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, scenario: str, task_type: str, stages: Dict[str, float]):
+        key = (str(scenario), str(task_type))
+        with self._lock:
+            for hists in (self._hists, self._total):
+                per_stage = hists.setdefault(key, {})
+                for stage, sec in stages.items():
+                    per_stage.setdefault(stage, StageHistogram()).add(sec)
+
+    def snapshot(self, reset: bool = False, cumulative: bool = False) -> Dict[str, Dict[str, Dict[str, object]]]:
+        """
+        {"scenario/task_type": {stage: {n, mean, p50, p95, p99, max, sum, histogram}}} of the window
+        (cumulative=True: since creation; reset then only clears the window).
+        """
+        with self._lock:
+            source = self._total if cumulative else self._hists
+            hists = {key: {st: h.copy() for st, h in per.items()} for key, per in source.items()}
+            if reset:
+                self._hists = {}
+        out: Dict[str, Dict[str, Dict[str, object]]] = {}
+        for (scenario, task_type), per_stage in sorted(hists.items()):
+            out[f"{scenario}/{task_type}"] = {
+                stage: {**h.summary(), "histogram": h.histogram()} for stage, h in _ordered(per_stage.items())
+            }
+        return out
+
+
+def _ordered(items: Iterable[Tuple[str, StageHistogram]]) -> List[Tuple[str, StageHistogram]]:
+    rank = {s: i for i, s in enumerate(STAGES)}
+    return sorted(items, key=lambda kv: (rank.get(kv[0], len(rank)), kv[0]))
+
+
+def format_stage_lines(snapshot: Dict[str, Dict[str, Dict[str, object]]], prefix: str = "[reward_diag]") -> List[str]:
+    """One line per scenario/task_type: `stage=p50/p95 ms` for every recorded stage."""
+    lines = []
+    for key, per_stage in snapshot.items():
+        total = per_stage.get("total") or {}
+        parts = [
+            f"{stage}={1e3 * float(s['p50']):.0f}/{1e3 * float(s['p95']):.0f}ms"
+            for stage, s in per_stage.items()
+        ]
+        lines.append(f"{prefix}  - stages {key} (jobs={int(total.get('n', 0))}, p50/p95): " + " ".join(parts))
+    return lines
@@ -0,0 +1,67 @@
+import json
+from typing import Any, Dict, List, Optional, Union
+
+
+# 拓扑索引格式版本：字段含义变化时递增，旧索引视为缺失（回退为实时查询）
+TL_TOPOLOGY_VERSION = 1
+
+
+def build_tl_topology(simulator: Any, tl_id: str) -> Dict[str, Any]:
+    """
+    Build the static topology index of one traffic light from a running simulator.
+
+    Fields (phase lists are indexed 0-based, like SUMO phase indices):
+      - phase_states:  tlLogic state string per phase
+      - green:         whether the phase contains a G/g signal
+      - phase_lanes:   incoming lanes controlled by each phase (simulator.get_phase_controlled_lanes)
+      - all_lanes:     sorted union of phase_lanes
+
+    Uses the same simulator queries as the live reward path, so the index reproduces it exactly.
+    """
+    info = simulator.get_phase_info(tl_id)
+    states = [str(s) for s in info.get("phase_states", [])]
+    n = int(info.get("num_phases", len(states)))
+    phase_lanes: List[List[str]] = []
+    for idx in range(n):
+        lanes = simulator.get_phase_controlled_lanes(tl_id, idx).get("incoming_lanes", [])
+        phase_lanes.append(list(lanes))
+    all_lanes = sorted(set(ln for lanes in phase_lanes for ln in lanes))
+    return {
+        "version": TL_TOPOLOGY_VERSION,
+        "tl_id": tl_id,
+        "phase_states": states,
+        "green": [("G" in s) or ("g" in s) for s in states],
+        "phase_lanes": phase_lanes,
+        "all_lanes": all_lanes,
+    }
+
+
+def load_tl_topology(raw: Union[str, Dict[str, Any], None]) -> Optional[Dict[str, Any]]:
+    """Parse a stored topology (JSON string or dict); returns None if missing or of another version."""
+    if not raw:
+        return None
+    try:
+        topo = json.loads(raw) if isinstance(raw, str) else dict(raw)
+    except Exception:
+        return None
+    if topo.get("version") != TL_TOPOLOGY_VERSION:
+        return None
+    return topo
+
+
+def dump_tl_topology(topo: Dict[str, Any]) -> str:
+    """Compact JSON for storing the index as a dataset column."""
+    return json.dumps(topo, ensure_ascii=False, separators=(",", ":"))
+
+
+def phase_lanes(topo: Dict[str, Any], phase_id: int) -> List[str]:
+    """Incoming lanes of a 1-based phase id (empty if out of range)."""
+    idx = max(0, int(phase_id) - 1)
+    lanes = topo.get("phase_lanes", [])
+    return list(lanes[idx]) if idx < len(lanes) else []
+
+
+def phase_state(topo: Dict[str, Any], phase_idx: int) -> str:
+    """State string of a 0-based phase index (empty if out of range)."""
+    states = topo.get("phase_states", [])
+    return states[phase_idx] if 0 <= int(phase_idx) < len(states) else ""
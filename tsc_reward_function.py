@@ -13,9 +13,10 @@ TSC GRPO Reward Function
 
 import os
 import sys
+import abc
 import torch
 from typing import List, Dict, Any, Union
-from collections import defaultdict, Counter
+from collections import defaultdict, Counter, OrderedDict, deque
 import json
 import re
 import multiprocessing as mp
@@ -23,7 +24,12 @@ from functools import partial
 import atexit
 import signal
 import subprocess
+import tempfile
+import threading
+import itertools
+import hashlib
 import time
+from concurrent.futures import ThreadPoolExecutor, wait as futures_wait
 
 # 添加项目路径
 sumo_sim_path = os.path.join(os.getcwd(), 'sumo_simulation')
@@ -37,13 +43,29 @@ from scu_tsc_newprompt.rewards import (
     score_constraints_and_format,
     AdaptiveScaler,
     compute_sim_reward_adaptive,
+    compute_sim_rewards_adaptive,
     compute_total_reward,
 )
+from scu_tsc_newprompt.sim_backend import get_backend, libsumo_available
+from scu_tsc_newprompt.tl_topology import build_tl_topology, load_tl_topology, phase_lanes as topology_phase_lanes
+from scu_tsc_newprompt.reward_scheduler import AffinityScheduler, JobProfile, TaskCostModel, TaskFailed, job_work
+from scu_tsc_newprompt.stage_profiler import StageProfile, format_stage_lines
+from scu_tsc_newprompt.proc_telemetry import ResourceSampler, format_resource_lines
+from scu_tsc_newprompt.metrics_exporter import MetricFamily, MetricsExporter, Sample, metric_name, render
+from scu_tsc_newprompt.rollout_cache import (
+    ROLLOUT_CACHE_SCHEMA,
+    RolloutMetricsCache,
+    detect_sumo_version,
+    make_rollout_key,
+    state_file_digest,
+)
 
 
 # ==================== 全局配置 ====================
 REWARD_CONFIG = {
     'gui': False,
+    # 仿真后端：traci（TCP socket，独立 SUMO 进程）| libsumo（进程内，无 socket 往返，不占端口）
+    'sim_backend': 'traci',
     # SUMO 输出控制：False 时屏蔽 SUMO 启动/预热/step 日志（推荐训练时关闭）
     'sim_verbose': False,
     'w_passed': 1.0,
@@ -51,19 +73,91 @@ REWARD_CONFIG = {
     'w_proxy': 0.2,
     'w_sim': 1.5,
     'w_constraint': 1.0,
-    # 'D0': 25.0,  # 软约束归一化尺度
+    # 'D0': 25.0,  # 软约束归一化尺度（cycle_predict；未设置时用 score_constraints_and_format 的默认值 30）
     'alpha_passed': 0.5,
     'beta_queue': 1.0,
     'invalid_output_reward': -1.0,
     # Multi-reward mode (when using GRPOTrainer(reward_funcs=[sim, format]))
     'format_reward_valid': 0.1,
     'format_reward_invalid': -0.5,
+    # sim / format / constraint 对同一批（同一 prompts/completions 对象）共用一次 completion 解析、prompt 兜底提取和仿真上下文
+    'reward_batch_context': True,
+    # 旧 dataset（无 current_phase_id / max_extend_sec 列）从 prompt 解析元数据时的 LRU 容量（按 prompt 内容摘要）
+    'prompt_meta_cache_size': 4096,
+    # completion 解析先走两种输出 schema 的专用快速路径（结果与原解析器相同，非常规形态自动回退）
+    'fast_completion_parser': True,
+    # worker 内按阶段计时（SUMO 启动 / restore_state / TLS 配时 / step / 车道查询 / 关闭），
+    # 随结果回传并按 (场景, 任务类型) 汇总为直方图与分位数，见 reward_diag_snapshot()['stage_profile']
+    'stage_profiling': True,
     'sim_reward_clip_min': -1.0,
     'sim_reward_clip_max': 1.0,
-    'parallel_workers': 16,  # 并行 SUMO worker 数量（使用固定端口池避免冲突）
+    'parallel_workers': 16,  # 并行 SUMO worker 数量上限（使用固定端口池避免冲突）
+    # 按需伸缩：每次派发前把活跃 worker 数调到 近期派发任务数峰值 / CPU 数 / 内存余量 的最小值；
+    # 退出活跃范围或空闲超过 worker_idle_ttl_sec 的 worker 连同常驻 SUMO 退役，下次用到时重启
+    'pool_autoscale': True,
+    'pool_min_workers': 1,
+    'pool_scale_window': 20,  # 按最近多少次派发的任务数峰值定池大小（缩容的滞后）
+    'pool_mem_per_worker_mb': 400,  # 每个 worker（Python 进程/线程 + SUMO）的估计内存；资源采样有观测值后改用观测峰值
+    # 资源采样：后台线程每 resource_sample_sec 秒读 /proc 中各 worker 及其 SUMO 子进程的内存（RSS/PSS）、CPU 时间、
+    # 线程数、fd 数，见 reward_diag_snapshot()['resources']
+    'resource_telemetry': True,
+    'resource_sample_sec': 2.0,
+    # OpenMetrics 导出（start_metrics_exporter）：本地 HTTP 端点 GET /metrics 和/或定期原子重写的文本文件，
+    # 仅在抓取/写文件时汇总已有计数，不增加 reward 路径的开销；两者均为 None 时不启动
+    'metrics_http_port': None,
+    'metrics_http_host': '127.0.0.1',
+    'metrics_textfile': None,
+    'metrics_interval_sec': 15,  # 文本文件重写间隔
+    'worker_idle_ttl_sec': 300,  # None 时不按空闲时间退役
+    # worker 执行方式：process（forkserver 进程池，每个 worker 一个 Python 进程）|
+    # thread（单进程线程池，每个线程经带 label 的 TraCI 连接驱动自己的 SUMO；需 traci 后端）
+    'reward_executor': 'process',
+    # 任务调度：affinity（发给已持有同一 sumocfg/state 的 worker，按学习到的代价最长优先，空闲 worker 窃取任务）|
+    # fifo（空闲 worker 依次取下一个任务，等同 pool.map(chunksize=1)）
+    'reward_scheduler': 'affinity',
+    'sched_switch_state_sec': 0.05,  # 代价模型中 worker 切换 state（loadState）的估计耗时
+    'sched_switch_net_sec': 2.0,  # 代价模型中 worker 切换路网（启动 SUMO）的估计耗时
+    'sched_default_window_sec': 30,  # 无法预知窗口长度的任务（tsc_reward_fn 的 completion）按此估计
+    # 单任务时限：预期耗时 × (实际/预期 比值的 task_timeout_percentile 分位) × task_timeout_multiplier，
+    # 夹在 [min, max] 内（样本不足时取 max）；超时的任务记为 timeout，其 worker 连同 SUMO 被替换
+    'task_timeout_max_sec': 600,
+    'task_timeout_min_sec': 30,
+    'task_timeout_percentile': 99,
+    'task_timeout_multiplier': 5.0,
+    # 对冲重试（仅 affinity 调度）：任务运行超过 预期 × (比值的 hedge_percentile 分位) × hedge_multiplier
+    # （至少 hedge_min_sec）时，空闲 worker 再跑一份，先完成者生效，另一个 worker 被替换
+    'hedge_stragglers': True,
+    'hedge_percentile': 90,
+    'hedge_multiplier': 2.0,
+    'hedge_min_sec': 2.0,
     'parallel_port_base': 40000,  # 并行端口基址（worker_i 使用 base + i*100 范围内的端口）
     'auto_cleanup_ports': True,  # 训练前自动清理占用端口的进程
     'port_cleanup_mode': 'sumo_only',  # sumo_only | any
+    'persistent_worker_sessions': True,  # worker 常驻 SUMO 实例（按 sumocfg 复用，仅 loadState 切换 state）
+    'worker_session_max': 1,  # 每个 worker 最多常驻的 SUMO 实例数（全局 traci 同一时刻只驱动一个连接）
+    'reward_dispatch_mode': 'completion',  # completion: 每个 completion 一个任务 | group: 每个 prompt 组一个任务
+    'dedup_sim_actions': True,  # tsc_reward_sim_fn 中相同 (state, 任务, 归一化动作, TLS 配时) 只仿真一次
+    'extend_prefix_sharing': True,  # 同一 state 的 extend_decision 动作只仿真最长窗口，较短时长取前缀指标
+    'signal_step_warm_sharing': True,  # 同一 state 的 signal_step 动作只推进一次决策前窗口，各动作从快照分支
+    'warm_snapshot_dir': None,  # 决策点快照目录，None 时优先 /dev/shm
+    # 静态拓扑索引（相位 state / 绿灯标记 / 各相位进口车道）：优先用 dataset 的 tl_topology 列，
+    # 缺失时每个 worker 按 (sumocfg, tl_id) 实时构建一次并复用；False 时每次实时查询
+    'tl_topology_index': True,
+    # 仿真窗口内用 lane 上下文订阅取排队数/车辆 ID（每个 simulationStep 一次往返）；False 退回逐车道查询
+    'lane_subscriptions': True,
+    # 同一 state 多个候选的分支方式：loadstate（saveState/loadState，TraCI）| fork（进程内 libsumo + os.fork）
+    'branching_engine': 'loadstate',
+    'fork_max_concurrency': 4,  # fork 引擎中每个 worker 同时存活的子进程数
+    # 跨 epoch rollout 指标缓存（SQLite 单文件，仅存原始指标，reward 按当前权重重算）；None 关闭
+    'rollout_cache_path': 'grpo_rollout_cache.sqlite',
+    'rollout_cache_sumo_version': None,  # None 时自动探测 `sumo --version`
+    # 旧 cycle_predict 任务各路口 AdaptiveScaler 的状态文件（每批结束时保存，重启后恢复 P95 尺度）；
+    # None 关闭（默认，新训练从空尺度开始）。续训时按 run 指定，如 <output_dir>/grpo_adaptive_scalers.json
+    'adaptive_scaler_path': None,
+    # 离线 reward 表（precompute_reward_table.py 写入 dataset 的 reward_table 列）：命中时不启动 SUMO
+    'use_reward_table': True,
+    'reward_table_coarse_step': 5,  # signal_step 粗扫 green_sec 的步长
+    'reward_table_refine_top_k': 3,  # signal_step 粗扫后在最优的 k 个 (相位, 时长) 附近逐秒细扫
     'green_sec_min': 1,     # signal_step 的 green_sec 下限
     'green_sec_max': 120,   # signal_step 的 green_sec 上限
     # Constraint reward config for extend_decision (used by tsc_reward_constraint_fn)
@@ -86,11 +180,109 @@ except ValueError:
     # forkserver 不可用时回退到 fork
     _MP_CONTEXT = mp.get_context("fork")
 _GLOBAL_MP_POOL = None  # 延迟初始化
+_RESOURCE_SAMPLER = None  # 随 worker 池启动，见 _start_resource_sampler
 _MP_POOL_INITIALIZED = False  # 标记是否已尝试初始化
 
-# Worker 端口分配：每个 worker 获得一个固定端口
-# 使用进程本地存储来保存 worker 的分配端口
-_WORKER_PORT: Dict[str, int] = {}  # 进程本地变量（spawn 模式下每个 worker 独立）
+# Worker 本地状态：进程池 worker 每进程一份；reward_executor="thread" 时每个线程一份
+class _WorkerState:
+    def __init__(self):
+        self.port: Union[int, None] = None  # 分配的端口基址（None 表示不在 worker 内）
+        self.next_offset = 0
+        self.label: Union[str, None] = None  # 线程 worker 的 TraCI 连接 label 前缀
+        # 由 _worker_initializer 置位：当前是单线程的 worker 进程，可以 os.fork()（fork 引擎）；
+        # 训练主进程（串行回退路径）和线程 worker 保持 False
+        self.is_pool_worker = False
+        # 按 (后端, sumocfg) 常驻的 SUMO 会话，见 _acquire_worker_simulator
+        self.sessions: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        # 当前任务所属 session 的 TLS 原始程序表，见 _apply_tls_phase_durations
+        self.tls_baseline: Union[Dict[str, Any], None] = None
+        # 当前 simulator 的 TraCI 句柄（带 label 的连接）；None 时用后端的全局模块
+        self.api = None
+        # 线程 worker 被 recycle 替换后置位：旧线程剩余的任务不再启动 SUMO
+        self.retired = False
+        # 当前任务各阶段累计耗时（秒），见 _stage / _profiled_job
+        self.stage_times: Dict[str, float] = {}
+
+
+_WORKER_LOCAL = threading.local()
+
+
+def _worker() -> _WorkerState:
+    state = getattr(_WORKER_LOCAL, "state", None)
+    if state is None:
+        state = _WORKER_LOCAL.state = _WorkerState()
+    return state
+
+
+class _Stage:
+    """with _stage(name): 把块内耗时累加到当前 worker 本任务的 stage_times[name]"""
+
+    __slots__ = ("_times", "_name", "_t0")
+
+    def __init__(self, times: Dict[str, float], name: str):
+        self._times = times
+        self._name = name
+
+    def __enter__(self):
+        self._t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._times[self._name] = self._times.get(self._name, 0.0) + (time.perf_counter() - self._t0)
+        return False
+
+
+class _NoStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_STAGE = _NoStage()
+
+
+def _stage(name: str):
+    if not REWARD_CONFIG.get("stage_profiling", True):
+        return _NO_STAGE
+    return _Stage(_worker().stage_times, name)
+
+
+# 当前进程临时覆盖的仿真后端（fork 引擎在批次内切到 libsumo）；None 时按 REWARD_CONFIG['sim_backend']
+_ACTIVE_BACKEND = None
+
+
+def _sim_backend():
+    return _ACTIVE_BACKEND or get_backend(REWARD_CONFIG.get("sim_backend", "traci"))
+
+
+def _sim_api():
+    """
+    当前 TraCI 兼容句柄，替代函数内的 `import traci`：
+    线程 worker 中为当前 simulator 的带 label 连接，否则为后端模块（traci 或 libsumo）。
+    """
+    return _worker().api or _sim_backend().api
+
+
+class _using_backend:
+    """在 with 块内把当前进程的仿真后端切换为 name"""
+
+    def __init__(self, name: str):
+        self._backend = get_backend(name)
+
+    def __enter__(self):
+        global _ACTIVE_BACKEND
+        self._saved = _ACTIVE_BACKEND
+        _ACTIVE_BACKEND = self._backend
+        return self._backend
+
+    def __exit__(self, *exc):
+        global _ACTIVE_BACKEND
+        _ACTIVE_BACKEND = self._saved
+        return False
 
 
 # ==================== Reward Diagnostics ====================
@@ -101,16 +293,57 @@ _REWARD_DIAG: Dict[str, Any] = {
     "window_total_by_task": Counter(),
     "window_invalid_by_task": Counter(),
     "window_reason_by_task": {},  # task_type -> Counter
+    "window_sim_tasks": 0,  # tsc_reward_sim_fn 中通过校验、需要仿真的任务数
+    "window_sim_unique_tasks": 0,  # 去重后实际提交仿真的任务数
+    "window_cache_hits": 0,  # rollout 指标缓存命中数
+    "window_cache_misses": 0,
+    "window_table_hits": 0,  # 离线 reward 表命中数（不进入仿真/缓存路径）
+    "window_stage_profile": StageProfile(),  # worker 各阶段耗时，按 (场景, 任务类型)
+    "window_pool_steps": {},  # global_step -> 本步 reward 派发的 worker 利用率，见 _record_pool_step
     "last_batch_by_step": {},  # global_step -> dict
     "max_steps_kept": 300,
 }
 
 
+# 已 reset 的诊断窗口累加到这里，供 OpenMetrics 导出单调计数（窗口计数本身每次 on_log 清零）
+_DIAG_COUNTER_KEYS = (
+    "window_total",
+    "window_invalid",
+    "window_sim_tasks",
+    "window_sim_unique_tasks",
+    "window_cache_hits",
+    "window_cache_misses",
+    "window_table_hits",
+)
+_REWARD_DIAG_TOTALS: Dict[str, Any] = {
+    **{k: 0 for k in _DIAG_COUNTER_KEYS},
+    "window_total_by_task": Counter(),
+    "window_invalid_by_task": Counter(),
+    "window_reason_by_task": {},
+}
+# 只在 reset 窗口与导出读取之间互斥（reward 路径不取锁），避免导出时同一批计数被算两次或暂时消失
+_DIAG_TOTALS_LOCK = threading.Lock()
+
+
+def _fold_diag_totals(snap: Dict[str, Any]):
+    for k in _DIAG_COUNTER_KEYS:
+        _REWARD_DIAG_TOTALS[k] += int(snap.get(k, 0))
+    _REWARD_DIAG_TOTALS["window_total_by_task"].update(snap["window_total_by_task"])
+    _REWARD_DIAG_TOTALS["window_invalid_by_task"].update(snap["window_invalid_by_task"])
+    for task, reasons in snap["window_reason_by_task"].items():
+        _REWARD_DIAG_TOTALS["window_reason_by_task"].setdefault(task, Counter()).update(reasons)
+
+
 def reward_diag_snapshot(reset: bool = False) -> Dict[str, Any]:
     """
     Snapshot diagnostics accumulated since last reset.
     Designed to be called from a TrainerCallback on log events.
     """
+    with _DIAG_TOTALS_LOCK:
+        return _reward_diag_snapshot(reset)
+
+
+def _reward_diag_snapshot(reset: bool) -> Dict[str, Any]:
     reason_by_task = {
         task: dict(counter)
         for task, counter in _REWARD_DIAG.get("window_reason_by_task", {}).items()
@@ -122,14 +355,29 @@ def reward_diag_snapshot(reset: bool = False) -> Dict[str, Any]:
         "window_total_by_task": dict(_REWARD_DIAG.get("window_total_by_task", {})),
         "window_invalid_by_task": dict(_REWARD_DIAG.get("window_invalid_by_task", {})),
         "window_reason_by_task": reason_by_task,
+        "window_sim_tasks": int(_REWARD_DIAG.get("window_sim_tasks", 0)),
+        "window_sim_unique_tasks": int(_REWARD_DIAG.get("window_sim_unique_tasks", 0)),
+        "window_cache_hits": int(_REWARD_DIAG.get("window_cache_hits", 0)),
+        "window_cache_misses": int(_REWARD_DIAG.get("window_cache_misses", 0)),
+        "window_table_hits": int(_REWARD_DIAG.get("window_table_hits", 0)),
+        "rollout_cache": rollout_cache_stats(),
+        "reward_scheduler": reward_scheduler_stats(),
+        "stage_profile": _REWARD_DIAG["window_stage_profile"].snapshot(reset=reset),
+        "resources": reward_resource_stats(reset=reset),
     }
     if reset:
+        _fold_diag_totals(snap)
         _REWARD_DIAG["window_start_step"] = None
         _REWARD_DIAG["window_total"] = 0
         _REWARD_DIAG["window_invalid"] = 0
         _REWARD_DIAG["window_total_by_task"] = Counter()
         _REWARD_DIAG["window_invalid_by_task"] = Counter()
         _REWARD_DIAG["window_reason_by_task"] = {}
+        _REWARD_DIAG["window_sim_tasks"] = 0
+        _REWARD_DIAG["window_sim_unique_tasks"] = 0
+        _REWARD_DIAG["window_cache_hits"] = 0
+        _REWARD_DIAG["window_cache_misses"] = 0
+        _REWARD_DIAG["window_table_hits"] = 0
     return snap
 
 
@@ -144,24 +392,67 @@ def reward_diag_last(global_step: int) -> Union[Dict[str, Any], None]:
         return None
 
 
-def _worker_initializer(port_base: int):
+# ==================== Rollout 指标缓存 ====================
+_ROLLOUT_CACHE: Union[RolloutMetricsCache, None] = None
+
+
+def _get_rollout_cache() -> Union[RolloutMetricsCache, None]:
+    """按 REWARD_CONFIG['rollout_cache_path'] 延迟打开缓存；路径变化时重新打开"""
+    global _ROLLOUT_CACHE
+    path = REWARD_CONFIG.get("rollout_cache_path")
+    if not path:
+        return None
+    if _ROLLOUT_CACHE is None or _ROLLOUT_CACHE.path != path:
+        if _ROLLOUT_CACHE is not None:
+            _ROLLOUT_CACHE.close()
+        _ROLLOUT_CACHE = RolloutMetricsCache(path)
+    return _ROLLOUT_CACHE
+
+
+def rollout_cache_stats() -> Union[Dict[str, Any], None]:
+    """Return cumulative hit/miss/write counters of the rollout metrics cache (None if disabled)."""
+    if _ROLLOUT_CACHE is None:
+        return None
+    return _ROLLOUT_CACHE.stats()
+
+
+def _worker_initializer(port_base: int, ident: Union[int, None] = None):
     """
     Worker 初始化函数（在每个 worker 进程启动时调用）
-    为该 worker 分配一个固定端口
+    为该 worker 分配一个固定端口（ident 为 worker 序号；None 时取进程池内的进程序号）
     """
-    global _WORKER_PORT
-    try:
-        ident = mp.current_process()._identity[0] - 1
-    except Exception:
-        ident = 0
-    assigned_port = port_base + int(ident) * 100  # 每个 worker 分配 100 个端口的空间
-    _WORKER_PORT["port"] = assigned_port
+    if ident is None:
+        try:
+            ident = mp.current_process()._identity[0] - 1
+        except Exception:
+            ident = 0
+    state = _worker()
+    state.port = port_base + int(ident) * 100  # 每个 worker 分配 100 个端口的空间
+    state.next_offset = 0
+    state.is_pool_worker = True
+    # worker 退出时关闭常驻的 SUMO 实例（Pool worker 不执行 atexit，但会执行 multiprocessing 的 Finalize）
+    from multiprocessing.util import Finalize
+    Finalize(None, _close_worker_sessions, exitpriority=10)
     # 静默初始化，不打印日志
 
 
 def _get_worker_port() -> int:
     """获取当前 worker 的分配端口"""
-    return _WORKER_PORT.get("port", None)
+    return _worker().port
+
+
+def _next_worker_session_port() -> Union[int, None]:
+    """
+    在 worker 的 100 端口空间内轮转分配端口。
+    重启 SUMO 时换用新端口，避免旧进程尚未释放端口导致 "Address already in use"。
+    """
+    base = _get_worker_port()
+    if base is None:
+        return None
+    state = _worker()
+    offset = int(state.next_offset)
+    state.next_offset = (offset + 1) % 100
+    return base + offset
 
 
 def _iter_ports_for_workers(port_base: int, num_workers: int) -> List[int]:
@@ -235,6 +526,8 @@ def _cleanup_listening_ports_if_needed():
     """
     if not REWARD_CONFIG.get("auto_cleanup_ports", False):
         return
+    if not _sim_backend().uses_ports:
+        return
     port_base = int(REWARD_CONFIG.get("parallel_port_base", 20000))
     num_workers = int(REWARD_CONFIG.get("parallel_workers", 0))
     if num_workers <= 0:
@@ -285,17 +578,26 @@ def _ensure_mp_pool_initialized():
         num_workers = REWARD_CONFIG['parallel_workers']
         if num_workers > 0:
             port_base = REWARD_CONFIG.get('parallel_port_base', 20000)
-            print(f"[tsc_reward_function] 初始化进程池，workers={num_workers}，端口范围={port_base}-{port_base + num_workers * 100}")
+            executor = str(REWARD_CONFIG.get('reward_executor', 'process')).lower()
+            if executor == 'thread' and not _sim_backend().uses_ports:
+                print(f"[tsc_reward_function] reward_executor=thread 需要 traci 后端（{_sim_backend().name} 不支持多连接），改用进程池")
+                executor = 'process'
+            kind = "线程池" if executor == 'thread' else "进程池"
+            scaling = "按需伸缩，上限 " if REWARD_CONFIG.get('pool_autoscale', True) else ""
+            print(f"[tsc_reward_function] 初始化{kind}，workers={scaling}{num_workers}，端口范围={port_base}-{port_base + num_workers * 100}")
             _cleanup_listening_ports_if_needed()
+
+            if executor == 'thread':
+                _GLOBAL_MP_POOL = _ThreadWorkerPool(num_workers, port_base)
+                atexit.register(_cleanup_mp_pool)
+                _start_resource_sampler(_GLOBAL_MP_POOL)
+                return _GLOBAL_MP_POOL
             
             try:
-                _GLOBAL_MP_POOL = _MP_CONTEXT.Pool(
-                    processes=num_workers,
-                    initializer=_worker_initializer,
-                    initargs=(port_base,),
-                )
+                _GLOBAL_MP_POOL = _ProcessWorkerPool(num_workers, port_base)
                 # 注册 atexit 钩子确保程序退出时清理
                 atexit.register(_cleanup_mp_pool)
+                _start_resource_sampler(_GLOBAL_MP_POOL)
                 print(f"[tsc_reward_function] 进程池初始化成功")
             except Exception as e:
                 print(f"[tsc_reward_function] 进程池初始化失败，将使用串行模式: {e}")
@@ -303,9 +605,593 @@ def _ensure_mp_pool_initialized():
     return _GLOBAL_MP_POOL
 
 
+def _sumo_remote_ports() -> Dict[int, int]:
+    """所有带 --remote-port 的 SUMO 进程：{pid: port}（扫描 /proc，不依赖 lsof）"""
+    ports: Dict[int, int] = {}
+    try:
+        names = os.listdir("/proc")
+    except Exception:
+        return ports
+    for name in names:
+        if not name.isdigit():
+            continue
+        args = _pid_cmdline(int(name)).split()
+        if not args or "sumo" not in os.path.basename(args[0]).lower() or "--remote-port" not in args:
+            continue
+        try:
+            ports[int(name)] = int(args[args.index("--remote-port") + 1])
+        except (ValueError, IndexError):
+            continue
+    return ports
+
+
+def _sumo_pids_on_ports(port_lo: int, port_hi: int) -> List[int]:
+    """SUMO 进程中 --remote-port 落在 [port_lo, port_hi) 的 pid"""
+    return [pid for pid, port in _sumo_remote_ports().items() if port_lo <= port < port_hi]
+
+
+class _SlotWorkerPool(abc.ABC):
+    """
+    reward worker 池：最多 max_slots 个可单独寻址的 worker（slot），call(slot, fn, arg, timeout) 在指定 worker 上同步执行。
+    map / imap 与 multiprocessing.Pool 的同名接口一致（共享队列，空闲 slot 依次取下一个任务）；
+    AffinityScheduler 经 call 把任务派给已持有对应 sumocfg/state 的 worker（见 _dispatch_reward_jobs）。
+
+    - 任务只派给前 num_slots 个 slot（resize 调整）；worker 在 slot 第一次收到任务时才启动，stop 后下次使用时重启。
+    - 超时的任务由 recycle 处理：杀掉该 slot 端口段内的 SUMO 进程并替换 worker，调用方得到 TaskFailed("timeout")；
+      同一 slot 上被替换前提交的其他调用得到 TaskFailed("cancelled")。
+    """
+
+    def __init__(self, max_slots: int, port_base: int):
+        self.max_slots = int(max_slots)
+        self.num_slots = self.max_slots
+        self._port_base = int(port_base)
+        self._workers: List[Any] = [None] * self.max_slots
+        # slot 代数：recycle / stop 时递增，旧代的调用不再等待结果
+        self._gen = [0] * self.max_slots
+        self._slot_locks = [threading.Lock() for _ in range(self.max_slots)]
+        self._last_used = [0.0] * self.max_slots
+        # 各 slot 累计执行任务的秒数，以及正在执行的任务所属场景（资源采样按场景归属内存峰值）
+        self.slot_busy_sec = [0.0] * self.max_slots
+        self.slot_tags: List[Union[str, None]] = [None] * self.max_slots
+        self._stats_lock = threading.Lock()
+        self.stats = {
+            "workers": self.num_slots,
+            "running": 0,
+            "started": 0,
+            "retired": 0,
+            "timeouts": 0,
+            "recycled": 0,
+            "killed_sumo": 0,
+            "busy_sec": 0.0,
+            "slot_sec": 0.0,
+            "utilisation": None,
+            "idle_fraction": None,
+            "slot_utilisation": None,  # 最近一批各活跃 slot 的 忙碌秒数 / 批次墙钟
+        }
+
+    @abc.abstractmethod
+    def _new_worker(self, slot: int, gen: int):
+        """启动 slot 的 worker（gen 为该 slot 的代数）"""
+
+    @abc.abstractmethod
+    def _discard(self, slot: int, worker, kill: bool):
+        """释放已从 slot 摘下的 worker；kill=False 为空闲退役（正常关闭常驻 SUMO），True 为 recycle"""
+
+    @abc.abstractmethod
+    def _submit(self, worker, fn, arg):
+        """在 worker 上异步执行 fn(arg)，返回 _wait / _result 使用的句柄"""
+
+    @abc.abstractmethod
+    def _wait(self, handle, timeout: float) -> bool:
+        """最多等待 timeout 秒，返回任务是否已结束"""
+
+    @abc.abstractmethod
+    def _result(self, handle):
+        """已结束任务的结果（任务抛出的异常原样抛出）"""
+
+    def _worker_pid(self, worker) -> Union[int, None]:
+        """worker 的进程号；线程 worker 与训练进程共用进程，返回 None"""
+        return None
+
+    def resource_targets(self) -> Dict[int, tuple]:
+        """资源采样对象：{slot: (worker pid 或 None, [该 slot 端口段内的 SUMO pid])}，仅已启动的 slot"""
+        by_port = _sumo_remote_ports()
+        targets = {}
+        for slot, worker in enumerate(list(self._workers)):
+            if worker is None:
+                continue
+            port_lo = self._port_base + slot * 100
+            sumo = [pid for pid, port in by_port.items() if port_lo <= port < port_lo + 100]
+            targets[slot] = (self._worker_pid(worker), sumo)
+        return targets
+
+    def call(self, slot: int, fn, arg, timeout: Union[float, None] = None, tag: Union[str, None] = None):
+        with self._slot_locks[slot]:
+            if self._workers[slot] is None:
+                self._workers[slot] = self._new_worker(slot, self._gen[slot])
+                self.stats["started"] += 1
+            gen = self._gen[slot]
+            handle = self._submit(self._workers[slot], fn, arg)
+        self.slot_tags[slot] = tag
+        t0 = time.monotonic()
+        deadline = None if timeout is None else t0 + float(timeout)
+        try:
+            while not self._wait(handle, 0.2):
+                if self._gen[slot] != gen:
+                    raise TaskFailed("cancelled")
+                if deadline is not None and time.monotonic() >= deadline:
+                    self.stats["timeouts"] += 1
+                    self.recycle(slot, gen)
+                    raise TaskFailed("timeout")
+            try:
+                return self._result(handle)
+            except Exception as e:
+                raise TaskFailed(f"worker_exception:{type(e).__name__}") from e
+        finally:
+            now = time.monotonic()
+            self._last_used[slot] = now
+            self.slot_tags[slot] = None
+            with self._stats_lock:
+                self.stats["busy_sec"] += now - t0
+                self.slot_busy_sec[slot] += now - t0
+
+    def recycle(self, slot: int, gen: Union[int, None] = None):
+        """杀掉 slot 端口段内的 SUMO 进程并丢弃 worker（下次使用时重启）；gen 不是当前代（已被替换）时不做任何事"""
+        with self._slot_locks[slot]:
+            if gen is not None and gen != self._gen[slot]:
+                return
+            self._gen[slot] += 1
+            port_lo = self._port_base + slot * 100
+            killed = []
+            for pid in _sumo_pids_on_ports(port_lo, port_lo + 100):
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                    killed.append(pid)
+                except Exception:
+                    continue
+            worker, self._workers[slot] = self._workers[slot], None
+            if worker is not None:
+                self._discard(slot, worker, kill=True)
+            self.stats["recycled"] += 1
+            self.stats["killed_sumo"] += len(killed)
+        print(f"[tsc_reward_function] worker slot {slot} 已替换（第 {self._gen[slot]} 代），清理 SUMO 进程: {killed}")
+
+    def stop(self, slot: int) -> bool:
+        """空闲 slot 退役：关闭其 worker 和常驻 SUMO，释放端口段与内存（下次使用时重启）"""
+        with self._slot_locks[slot]:
+            worker, self._workers[slot] = self._workers[slot], None
+            if worker is None:
+                return False
+            self._gen[slot] += 1
+            self._discard(slot, worker, kill=False)
+            self.stats["retired"] += 1
+        return True
+
+    def resize(self, num_slots: int) -> List[int]:
+        """任务只派给前 num_slots 个 slot，其余已启动的 worker 退役。Returns 退役的 slot。"""
+        self.num_slots = max(1, min(self.max_slots, int(num_slots)))
+        self.stats["workers"] = self.num_slots
+        return [slot for slot in range(self.num_slots, self.max_slots) if self.stop(slot)]
+
+    def retire_idle(self, ttl_sec: float) -> List[int]:
+        """空闲超过 ttl_sec 的 worker（连同常驻 SUMO）退役。Returns 退役的 slot。"""
+        now = time.monotonic()
+        return [
+            slot
+            for slot in range(self.max_slots)
+            if self._workers[slot] is not None and now - self._last_used[slot] > ttl_sec and self.stop(slot)
+        ]
+
+    def record_batch(self, wall_sec: float, busy_sec: float, slot_busy_sec: Union[List[float], None] = None):
+        """
+        一次派发结束：busy_sec 为本批各 slot 执行任务的总秒数；utilisation = busy / (wall × 活跃 slot 数)，
+        idle_fraction = 1 - utilisation；slot_busy_sec 给出时按 slot 记录本批利用率。
+        """
+        slot_sec = wall_sec * self.num_slots
+        with self._stats_lock:
+            self.stats["slot_sec"] += slot_sec
+            self.stats["utilisation"] = round(busy_sec / slot_sec, 4) if slot_sec > 0 else None
+            self.stats["idle_fraction"] = None if slot_sec <= 0 else round(max(0.0, 1.0 - busy_sec / slot_sec), 4)
+            if slot_busy_sec is not None and wall_sec > 0:
+                self.stats["slot_utilisation"] = [round(b / wall_sec, 4) for b in slot_busy_sec[: self.num_slots]]
+            self.stats["running"] = sum(1 for w in self._workers if w is not None)
+
+    def imap(self, fn, iterable, chunksize: int = 1, fail=None, timeout: Union[float, None] = None, tags=None):
+        """
+        fail(item, reason) 给出失败任务的结果（None 时第一个异常在该位置抛出）；timeout 为单任务时限；
+        tags 为各任务的场景（见 call）
+        """
+        items = list(iterable)
+        results: List[Any] = [None] * len(items)
+        done = [threading.Event() for _ in items]
+        errors: List[BaseException] = []
+        pending = iter(range(len(items)))
+        lock = threading.Lock()
+
+        def _drain(slot: int):
+            while not errors:
+                with lock:
+                    i = next(pending, None)
+                if i is None:
+                    return
+                try:
+                    results[i] = self.call(slot, fn, items[i], timeout, tags[i] if tags is not None else None)
+                except BaseException as e:
+                    if fail is None:
+                        errors.append(e)
+                    else:
+                        results[i] = fail(items[i], getattr(e, "reason", type(e).__name__))
+                finally:
+                    done[i].set()
+
+        for slot in range(min(self.num_slots, len(items))):
+            threading.Thread(target=_drain, args=(slot,), daemon=True).start()
+        for i in range(len(items)):
+            done[i].wait()
+            if errors:
+                raise errors[0]
+            yield results[i]
+
+    def map(self, fn, iterable, chunksize: int = 1, fail=None, timeout: Union[float, None] = None, tags=None) -> List[Any]:
+        return list(self.imap(fn, iterable, fail=fail, timeout=timeout, tags=tags))
+
+
+def _run_with_config(item: tuple):
+    """
+    进程 worker 侧：item = (config, fn, arg)。forkserver worker 重新导入本模块，只看得到默认 REWARD_CONFIG；
+    每个任务随附主进程当前的 REWARD_CONFIG，先同步再执行 fn(arg)，worker 内的开关（branching_engine、
+    sim_backend、lane_subscriptions、stage_profiling 等）与主进程的设置一致。
+    """
+    config, fn, arg = item
+    REWARD_CONFIG.update(config)
+    return fn(arg)
+
+
+class _ProcessWorkerPool(_SlotWorkerPool):
+    """reward_executor="process"：每个 slot 是一个单进程 forkserver Pool（常驻 worker 进程，固定端口段）"""
+
+    def _new_worker(self, slot: int, gen: int):
+        return _MP_CONTEXT.Pool(processes=1, initializer=_worker_initializer, initargs=(self._port_base, slot))
+
+    def _discard(self, slot: int, worker, kill: bool):
+        if kill:
+            worker.terminate()
+            return
+        # close 后 worker 进程退出时经 Finalize 关闭常驻 SUMO；join 放到后台，不阻塞本次派发
+        worker.close()
+        threading.Thread(target=worker.join, daemon=True).start()
+
+    def _submit(self, worker, fn, arg):
+        return worker.apply_async(_run_with_config, ((dict(REWARD_CONFIG), fn, arg),))
+
+    def _worker_pid(self, worker) -> Union[int, None]:
+        procs = getattr(worker, "_pool", None) or []
+        return procs[0].pid if procs else None
+
+    def _wait(self, handle, timeout: float) -> bool:
+        handle.wait(timeout)
+        return handle.ready()
+
+    def _result(self, handle):
+        return handle.get()
+
+    def close(self):
+        for p in self._workers:
+            if p is not None:
+                p.close()
+
+    def join(self):
+        for p in self._workers:
+            if p is not None:
+                p.join()
+
+
+class _ThreadWorkerPool(_SlotWorkerPool):
+    """
+    reward_executor="thread"：单个进程内 N 个线程，每个线程有自己的 _WorkerState（端口段、常驻 session），
+    经带 label 的 TraCI 连接驱动各自的 SUMO。等待 SUMO socket 时释放 GIL，因此多个实例可同时仿真；
+    任务/结果不经 pickle，也没有 forkserver 启动开销。
+    线程无法强制终止：recycle 时旧线程的 state 标记为 retired（不再启动 SUMO），SUMO 被杀后其任务随 socket 出错结束。
+    """
+
+    def __init__(self, num_threads: int, port_base: int):
+        super().__init__(num_threads, port_base)
+        self._states: List[_WorkerState] = []
+        self._current: Dict[int, _WorkerState] = {}
+        self._lock = threading.Lock()
+
+    def _new_worker(self, slot: int, gen: int) -> ThreadPoolExecutor:
+        return ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix=f"tsc_reward_{slot}", initializer=self._init_thread, initargs=(slot, gen)
+        )
+
+    def _init_thread(self, ident: int, gen: int = 0):
+        state = _worker()
+        state.port = self._port_base + ident * 100  # 与进程池相同的端口段划分
+        state.next_offset = 0
+        # 重启后的线程用新 label，避免与旧线程尚未关闭的连接重名
+        state.label = f"tsc_reward_{ident}" if gen == 0 else f"tsc_reward_{ident}g{gen}"
+        with self._lock:
+            self._states.append(state)
+            self._current[ident] = state
+
+    def _discard(self, slot: int, worker, kill: bool):
+        with self._lock:
+            state = self._current.pop(slot, None)
+            if state is not None and not kill:
+                self._states.remove(state)
+        if kill:
+            if state is not None:
+                state.retired = True
+            worker.shutdown(wait=False, cancel_futures=True)
+            return
+        # 在该线程内关闭它的常驻 SUMO，随后线程退出
+        worker.submit(_close_worker_sessions)
+        worker.shutdown(wait=False)
+
+    def _submit(self, worker, fn, arg):
+        return worker.submit(fn, arg)
+
+    def _wait(self, handle, timeout: float) -> bool:
+        futures_wait([handle], timeout=timeout)
+        return handle.done()
+
+    def _result(self, handle):
+        return handle.result()
+
+    def close(self):
+        for ex in self._workers:
+            if ex is not None:
+                ex.shutdown(wait=True)
+        with self._lock:
+            states = list(self._states)
+            self._states.clear()
+            self._current.clear()
+        for state in states:
+            _close_worker_sessions(state)
+
+    def join(self):
+        pass
+
+
+def _available_memory_mb() -> Union[float, None]:
+    """MemAvailable（MB）；读不到时 None"""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024.0
+    except Exception:
+        pass
+    return None
+
+
+# 最近 pool_scale_window 次派发的任务数（autoscale 按其峰值定池大小）
+_POOL_DEMAND: "deque[int]" = deque(maxlen=int(REWARD_CONFIG.get("pool_scale_window", 20)))
+
+
+def _autoscale_target(pool: _SlotWorkerPool, num_jobs: int) -> int:
+    """
+    活跃 worker 数 = min(近期单次派发任务数峰值, CPU 数, 内存余量可容纳数, parallel_workers)，至少 pool_min_workers。
+    内存余量按 MemAvailable / 单 worker 内存 计，再加上已运行的 worker（它们的内存已不在 MemAvailable 中）；
+    单 worker 内存取资源采样观测到的 worker + SUMO 峰值，尚无观测时用 pool_mem_per_worker_mb。
+    """
+    global _POOL_DEMAND
+    window = max(1, int(REWARD_CONFIG.get("pool_scale_window", 20)))
+    if _POOL_DEMAND.maxlen != window:
+        _POOL_DEMAND = deque(_POOL_DEMAND, maxlen=window)
+    _POOL_DEMAND.append(int(num_jobs))
+    target = min(max(_POOL_DEMAND), pool.max_slots)
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except Exception:
+        cpus = os.cpu_count() or pool.max_slots
+    target = min(target, cpus)
+    avail_mb = _available_memory_mb()
+    per_worker_mb = float(REWARD_CONFIG.get("pool_mem_per_worker_mb", 400))
+    observed_mb = _RESOURCE_SAMPLER.worker_mem_mb() if _RESOURCE_SAMPLER is not None else None
+    if observed_mb:
+        per_worker_mb = observed_mb
+    if avail_mb is not None and per_worker_mb > 0:
+        running = sum(1 for w in pool._workers if w is not None)
+        target = min(target, running + int(avail_mb // per_worker_mb))
+    return max(int(REWARD_CONFIG.get("pool_min_workers", 1)), target)
+
+
+_TASK_COST_MODEL = TaskCostModel()
+_REWARD_SCHEDULER: Union[AffinityScheduler, None] = None
+
+
+def _get_reward_scheduler(pool: _SlotWorkerPool) -> AffinityScheduler:
+    global _REWARD_SCHEDULER
+    if _REWARD_SCHEDULER is not None and _REWARD_SCHEDULER.num_slots != pool.num_slots:
+        _REWARD_SCHEDULER.resize(pool.num_slots)
+    if _REWARD_SCHEDULER is None:
+        _REWARD_SCHEDULER = AffinityScheduler(
+            pool.num_slots,
+            _TASK_COST_MODEL,
+            switch_state_sec=float(REWARD_CONFIG.get("sched_switch_state_sec", 0.05)),
+            switch_net_sec=float(REWARD_CONFIG.get("sched_switch_net_sec", 2.0)),
+            nets_per_slot=int(REWARD_CONFIG.get("worker_session_max", 1)),
+        )
+    return _REWARD_SCHEDULER
+
+
+def _task_deadline(expected_sec: float) -> float:
+    """单任务时限（秒），见 task_timeout_* 配置"""
+    max_sec = float(REWARD_CONFIG.get("task_timeout_max_sec", 600))
+    if _REWARD_SCHEDULER is None:
+        return max_sec
+    ratio = _REWARD_SCHEDULER.latency.ratio_quantile(float(REWARD_CONFIG.get("task_timeout_percentile", 99)))
+    if ratio is None:
+        return max_sec
+    limit = expected_sec * ratio * float(REWARD_CONFIG.get("task_timeout_multiplier", 5.0))
+    return min(max_sec, max(float(REWARD_CONFIG.get("task_timeout_min_sec", 30)), limit))
+
+
+def _hedge_after(expected_sec: float) -> Union[float, None]:
+    """任务运行多久后由空闲 worker 对冲重试（None：不对冲），见 hedge_* 配置"""
+    if not REWARD_CONFIG.get("hedge_stragglers", True) or _REWARD_SCHEDULER is None:
+        return None
+    ratio = _REWARD_SCHEDULER.latency.ratio_quantile(float(REWARD_CONFIG.get("hedge_percentile", 90)))
+    if ratio is None:
+        return None
+    return max(float(REWARD_CONFIG.get("hedge_min_sec", 2.0)), expected_sec * ratio * float(REWARD_CONFIG.get("hedge_multiplier", 2.0)))
+
+
+def _profiled_job(item: tuple) -> tuple:
+    """worker 侧：item = (fn, job)，执行 fn(job) 并返回 (结果, {阶段: 秒})；total 为整个任务的耗时"""
+    fn, job = item
+    state = _worker()
+    state.stage_times = times = {}
+    t0 = time.perf_counter()
+    try:
+        result = fn(job)
+    finally:
+        state.stage_times = {}
+    times["total"] = time.perf_counter() - t0
+    return result, times
+
+
+def _record_stage_times(jobs: List[Any], outputs: List[tuple], label_fn) -> List[Any]:
+    """解包 _profiled_job 的输出，各阶段耗时按 label_fn(job) = (场景, 任务类型) 计入诊断窗口"""
+    profile = _REWARD_DIAG["window_stage_profile"]
+    results = []
+    for job, (result, times) in zip(jobs, outputs):
+        if times:
+            scenario, task_type = label_fn(job)
+            profile.record(scenario, task_type, times)
+        results.append(result)
+    return results
+
+
+def _map_reward_jobs(fn, jobs: List[Any], label_fn) -> List[Any]:
+    """在当前进程/线程串行执行 fn(job)（无进程池或并行失败时的回退），同样记录阶段耗时"""
+    if not REWARD_CONFIG.get("stage_profiling", True):
+        return list(map(fn, jobs))
+    return _record_stage_times(jobs, [_profiled_job((fn, job)) for job in jobs], label_fn)
+
+
+def _dispatch_reward_jobs(pool, fn, jobs: List[Any], profile_fn, fail_fn, label_fn) -> List[Any]:
+    """
+    把 jobs 派给 worker 池执行 fn(job)，结果按 jobs 顺序返回。
+    reward_scheduler=affinity 时经 AffinityScheduler（亲和性 + 代价模型 + work stealing + 对冲重试），否则 pool.map。
+    超时或出错的任务不影响同批其他任务：其结果为 fail_fn(job, reason)，reason 如 timeout / worker_exception:<类型>。
+    stage_profiling 开启时 worker 随结果回传各阶段耗时，按 label_fn(job) = (场景, 任务类型) 汇总（失败的任务不计）。
+    """
+    if not REWARD_CONFIG.get("stage_profiling", True):
+        return _run_reward_jobs(pool, fn, jobs, profile_fn, fail_fn)
+    outputs = _run_reward_jobs(
+        pool,
+        _profiled_job,
+        [(fn, job) for job in jobs],
+        lambda item: profile_fn(item[1]),
+        lambda item, reason: (fail_fn(item[1], reason), None),
+    )
+    return _record_stage_times(jobs, outputs, label_fn)
+
+
+def _run_reward_jobs(pool, fn, jobs: List[Any], profile_fn, fail_fn) -> List[Any]:
+    """_dispatch_reward_jobs 的派发部分；派发前按 pool_autoscale / worker_idle_ttl_sec 调整活跃 worker，结束后记录本批利用率"""
+    if not isinstance(pool, _SlotWorkerPool):
+        return pool.map(fn, jobs, chunksize=1)
+
+    retired = []
+    if REWARD_CONFIG.get("pool_autoscale", True):
+        retired += pool.resize(_autoscale_target(pool, len(jobs)))
+    ttl = REWARD_CONFIG.get("worker_idle_ttl_sec")
+    if ttl is not None:
+        retired += pool.retire_idle(float(ttl))
+    if retired and _REWARD_SCHEDULER is not None:
+        _REWARD_SCHEDULER.forget(retired)
+
+    t0 = time.monotonic()
+    busy0 = pool.stats["busy_sec"]
+    slot_busy0 = list(pool.slot_busy_sec)
+    try:
+        profiles = [profile_fn(job) for job in jobs]
+        if str(REWARD_CONFIG.get("reward_scheduler", "affinity")) == "affinity":
+            scheduler = _get_reward_scheduler(pool)
+            scenario_of = {id(job): p.scenario for job, p in zip(jobs, profiles)}
+            return scheduler.run(
+                lambda slot, job, expected: pool.call(slot, fn, job, _task_deadline(expected), scenario_of.get(id(job))),
+                jobs,
+                profiles,
+                fail=fail_fn,
+                hedge_after=_hedge_after,
+                cancel=pool.recycle,
+            )
+        return pool.map(
+            fn,
+            jobs,
+            fail=fail_fn,
+            timeout=float(REWARD_CONFIG.get("task_timeout_max_sec", 600)),
+            tags=[p.scenario for p in profiles],
+        )
+    finally:
+        pool.record_batch(
+            time.monotonic() - t0,
+            pool.stats["busy_sec"] - busy0,
+            [b - b0 for b, b0 in zip(pool.slot_busy_sec, slot_busy0)],
+        )
+
+
+def reward_scheduler_stats() -> Union[Dict[str, Any], None]:
+    """Cumulative scheduler/pool counters and learned per-scenario cost rates (None before first use)."""
+    stats: Dict[str, Any] = {}
+    if _REWARD_SCHEDULER is not None:
+        stats.update(_REWARD_SCHEDULER.stats, cost_rates=_TASK_COST_MODEL.snapshot())
+    if isinstance(_GLOBAL_MP_POOL, _SlotWorkerPool):
+        stats["pool"] = dict(_GLOBAL_MP_POOL.stats)
+    return stats or None
+
+
+def _start_resource_sampler(pool):
+    """为 worker 池启动后台资源采样（resource_telemetry 关闭时不启动）"""
+    global _RESOURCE_SAMPLER
+    if not REWARD_CONFIG.get("resource_telemetry", True) or not isinstance(pool, _SlotWorkerPool):
+        return
+    _RESOURCE_SAMPLER = ResourceSampler(
+        pool.resource_targets,
+        lambda: dict(enumerate(pool.slot_tags)),
+        interval_sec=float(REWARD_CONFIG.get("resource_sample_sec", 2.0)),
+    )
+    _RESOURCE_SAMPLER.start()
+
+
+def _record_pool_step(pool, kwargs: Dict[str, Any]):
+    """本训练步 reward 派发的 worker 利用率（整体 / 各 slot / 空闲比例），按 global_step 计入诊断窗口"""
+    step = getattr(kwargs.get("trainer_state"), "global_step", None)
+    if step is None or not isinstance(pool, _SlotWorkerPool):
+        return
+    _REWARD_DIAG["window_pool_steps"][int(step)] = {
+        k: pool.stats.get(k) for k in ("utilisation", "idle_fraction", "slot_utilisation")
+    }
+
+
+def reward_resource_stats(reset: bool = False) -> Union[Dict[str, Any], None]:
+    """
+    诊断窗口内的资源数据（None：未启动 worker 池）：
+    slots（各 slot 的 worker/SUMO 内存、窗口峰值、CPU 利用率、线程数、fd 数）、scenario_peak_mb（各场景任务运行时的
+    worker + SUMO 内存峰值）、worker_mem_mb（autoscale 使用的单 worker 内存观测值）、steps（各训练步的 worker 利用率）。
+    """
+    steps = _REWARD_DIAG["window_pool_steps"]
+    if reset:
+        _REWARD_DIAG["window_pool_steps"] = {}
+    if _RESOURCE_SAMPLER is None and not steps:
+        return None
+    stats: Dict[str, Any] = {"steps": dict(sorted(steps.items()))}
+    if _RESOURCE_SAMPLER is not None:
+        stats.update(_RESOURCE_SAMPLER.snapshot(reset=reset))
+    return stats
+
+
 def _cleanup_mp_pool():
     """清理全局进程池"""
-    global _GLOBAL_MP_POOL
+    global _GLOBAL_MP_POOL, _RESOURCE_SAMPLER
+    if _RESOURCE_SAMPLER is not None:
+        _RESOURCE_SAMPLER.stop()
+        _RESOURCE_SAMPLER = None
     if _GLOBAL_MP_POOL is not None:
         try:
             print("[tsc_reward_function] 关闭进程池...")
@@ -328,6 +1214,7 @@ class SimulatorPool:
     def __init__(self):
         self._pool: Dict[str, SUMOSimulator] = {}
         self._scalers: Dict[str, AdaptiveScaler] = {}  # 每个 tl_id 一个 scaler
+        self._saved_scalers: Union[Dict[str, Any], None] = None  # adaptive_scaler_path 中的状态（延迟读取）
     
     def get_simulator(self, scenario: str, sumocfg: str) -> SUMOSimulator:
         """获取或创建 simulator"""
@@ -336,9 +1223,8 @@ class SimulatorPool:
         if key not in self._pool:
             if REWARD_CONFIG.get("sim_verbose", False):
                 print(f"[SimulatorPool] 创建新 simulator: {scenario}")
-            sim = SUMOSimulator(
-                config_file=sumocfg,
-                junctions_file=None,
+            sim = _sim_backend().create_simulator(
+                sumocfg,
                 gui=REWARD_CONFIG['gui'],
                 additional_options=['--device.rerouting.probability', '0'],  # 禁用动态重路由
                 verbose=bool(REWARD_CONFIG.get("sim_verbose", False)),
@@ -350,13 +1236,43 @@ class SimulatorPool:
         return self._pool[key]
     
     def get_scaler(self, tl_id: str) -> AdaptiveScaler:
-        """获取或创建 scaler"""
+        """获取或创建 scaler（有保存的状态时从中恢复）"""
         if tl_id not in self._scalers:
-            self._scalers[tl_id] = AdaptiveScaler()
+            state = self._load_saved_scalers().get(tl_id)
+            self._scalers[tl_id] = AdaptiveScaler.from_dict(state) if state else AdaptiveScaler()
         return self._scalers[tl_id]
+
+    def _load_saved_scalers(self) -> Dict[str, Any]:
+        if self._saved_scalers is None:
+            self._saved_scalers = {}
+            path = REWARD_CONFIG.get("adaptive_scaler_path")
+            if path and os.path.exists(path):
+                try:
+                    with open(path, "r", encoding="utf-8") as f:
+                        self._saved_scalers = dict(json.load(f))
+                except Exception as e:
+                    print(f"[SimulatorPool] 读取 scaler 状态失败: {e}")
+        return self._saved_scalers
+
+    def save_scalers(self):
+        """把各路口 scaler 状态写入 REWARD_CONFIG['adaptive_scaler_path']（原子替换；未加载的路口保留原状态）"""
+        path = REWARD_CONFIG.get("adaptive_scaler_path")
+        if not path or not self._scalers:
+            return
+        states = dict(self._load_saved_scalers())
+        states.update({tl_id: scaler.to_dict() for tl_id, scaler in self._scalers.items()})
+        tmp = f"{path}.tmp{os.getpid()}"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(states, f, ensure_ascii=False)
+            os.replace(tmp, path)
+            self._saved_scalers = states
+        except Exception as e:
+            print(f"[SimulatorPool] 保存 scaler 状态失败: {e}")
     
     def close_all(self):
         """关闭所有 simulator"""
+        self.save_scalers()
         for sim in self._pool.values():
             try:
                 sim.close()
@@ -370,98 +1286,465 @@ class SimulatorPool:
 _GLOBAL_POOL = SimulatorPool()
 
 
-# ==================== 评估辅助函数 ====================
-def evaluate_plan_once_reward_fn(
-    simulator: SUMOSimulator,
-    tl_id: str,
-    plan: List[dict]
-) -> dict:
-    """
-    在当前 SUMO state 下执行一个信号配时方案并返回交通指标。
-    
-    Args:
-        simulator: SUMO 仿真器实例
-        tl_id: 信号灯 ID
-        plan: 配时方案 [{"phase_id": int, "final": int}, ...]
-    
-    Returns:
-        dict: {"passed_vehicles": float, "queue_vehicles": float, "total_queue_proxy": float, "sim_time": float}
-    """
-    import traci
-    
-    # 收集所有相位控制的 lanes
-    phase_info = simulator.get_phase_info(tl_id)
-    n = int(phase_info.get('num_phases', 0))
-    all_lanes = set()
-    for idx in range(n):
-        all_lanes.update(simulator.get_phase_controlled_lanes(tl_id, idx).get('incoming_lanes', []))
-    all_lanes = list(all_lanes)
-    
-    # 记录执行前的车辆
-    vehicles_before = set()
-    for ln in all_lanes:
-        try:
-            vehicles_before.update(traci.lane.getLastStepVehicleIDs(ln))
-        except Exception:
-            pass
-    
-    # 执行配时方案
-    total_queue_proxy = 0.0
-    for step in plan:
-        pid = int(step['phase_id'])
-        dur = int(step['final'])
-        traci.trafficlight.setPhase(tl_id, pid - 1)
-        for _ in range(max(0, dur)):
-            traci.simulationStep()
-            q = 0.0
-            for ln in all_lanes:
-                try:
-                    q += traci.lane.getLastStepHaltingNumber(ln)
-                except Exception:
-                    pass
-            total_queue_proxy += q
-    
-    # 记录执行后的车辆和排队
-    vehicles_after = set()
-    queue_end = 0.0
-    for ln in all_lanes:
-        try:
-            vehicles_after.update(traci.lane.getLastStepVehicleIDs(ln))
-            queue_end += traci.lane.getLastStepHaltingNumber(ln)
-        except Exception:
-            pass
-    
-    passed = len(vehicles_before - vehicles_after)
-    
-    return {
-        'passed_vehicles': float(passed),
-        'queue_vehicles': float(queue_end),
-        'total_queue_proxy': float(total_queue_proxy),
-        'sim_time': float(traci.simulation.getTime()),
-    }
+# ==================== Worker 常驻 SUMO 会话 ====================
+# 每个 worker（进程或线程，见 _WorkerState）按 (后端, sumocfg) 缓存已启动的 simulator，后续任务只需 loadState，
+# 省去每个 completion 的进程启动、TraCI 连接和路网加载。
+# session key: "<backend>:<sumocfg>"（见 _session_key）
+# session: {"simulator", "port", "tls_baseline": {tl_id: 原始 Logic}, "tasks", "last_used"}
+# tls_baseline：_apply_tls_phase_durations 修改程序前在此登记原始 Logic，
+# 下一个任务 loadState 前据此还原，保证与“每次新启动 SUMO”时的配时一致
 
 
-def _extract_json_object(text: str) -> Union[Dict[str, Any], None]:
+def _simulator_is_healthy(simulator: SUMOSimulator) -> bool:
+    """健康检查：连接仍在且能完成一次 TraCI 往返"""
+    try:
+        if not simulator.is_connected():
+            return False
+        (getattr(simulator, "api", None) or _sim_api()).simulation.getTime()
+        return True
+    except Exception:
+        return False
+
+
+# 静态 TL 拓扑索引（进程内）：(sumocfg, tl_id) -> topology，见 _resolve_tl_topology
+_TL_TOPOLOGY_CACHE: Dict[tuple, Dict[str, Any]] = {}
+
+
+def _resolve_tl_topology(
+    simulator: SUMOSimulator, sumocfg: str, tl_id: str, raw: Union[str, Dict[str, Any], None] = None
+) -> Union[Dict[str, Any], None]:
     """
-    提取JSON对象，使用最后一个匹配的 {...}（更容错）。
+    取 (sumocfg, tl_id) 的静态拓扑索引：进程内缓存 → dataset 的 tl_topology 列 → 在当前 simulator 上实时构建一次。
+    tl_topology_index=False 或构建失败时返回 None（调用方回退为逐次查询）。
     """
-    if not text:
+    if not REWARD_CONFIG.get("tl_topology_index", True):
         return None
-    s = text.strip()
-    
-    # 快速路径：纯JSON
-    if s.startswith("{") and s.endswith("}"):
-        try:
-            return json.loads(s)
-        except Exception:
-            pass
-    
-    # 查找所有 {...} 匹配，取最后一个（通常是真正的JSON输出）
-    matches = list(re.finditer(r"\{[^{}]*\}", s))
-    if not matches:
-        # 尝试更复杂的嵌套匹配
-        matches = list(re.finditer(r"\{[\s\S]*?\}", s))
-    
+    key = (str(sumocfg), str(tl_id))
+    topo = _TL_TOPOLOGY_CACHE.get(key)
+    if topo is None:
+        topo = load_tl_topology(raw)
+        if topo is None:
+            try:
+                topo = build_tl_topology(simulator, tl_id)
+            except Exception:
+                return None
+        _TL_TOPOLOGY_CACHE[key] = topo
+    return topo
+
+
+def _session_key(sumocfg: str) -> str:
+    return f"{_sim_backend().name}:{sumocfg}"
+
+
+def _drop_worker_session(key: str, state: Union[_WorkerState, None] = None):
+    """关闭并移除一个 session（连接失效或被淘汰时调用）"""
+    state = state or _worker()
+    session = state.sessions.pop(key, None)
+    if session is None:
+        return
+    if state.tls_baseline is session["tls_baseline"]:
+        state.tls_baseline = None
+    if state.api is not None and state.api is getattr(session["simulator"], "api", None):
+        state.api = None
+    try:
+        with _stage("teardown"):
+            session["simulator"].close()
+    except Exception:
+        pass
+
+
+def _close_worker_sessions(state: Union[_WorkerState, None] = None):
+    """关闭当前 worker（或指定 worker 状态）内所有常驻 SUMO 实例"""
+    state = state or _worker()
+    for key in list(state.sessions.keys()):
+        _drop_worker_session(key, state)
+
+
+def _start_worker_simulator(sumocfg: str, port: Union[int, None]) -> Union[SUMOSimulator, None]:
+    backend = _sim_backend()
+    label = _worker().label
+    extra = {}
+    if label is not None and backend.uses_ports:
+        # 线程 worker：独立的带 label 连接，不切换进程内全局 traci 连接
+        extra["label"] = f"{label}:{port}"
+    with _stage("sumo_start"):
+        simulator = backend.create_simulator(
+            sumocfg,
+            gui=False,
+            additional_options=["--device.rerouting.probability", "0"],
+            verbose=False,
+            port=port if backend.uses_ports else None,  # 使用分配的固定端口
+            **extra,
+        )
+        started = simulator.start_simulation()
+    if not started:
+        try:
+            simulator.close()
+        except Exception:
+            pass
+        return None
+    return simulator
+
+
+def _reset_tls_programs(tls_baseline: Dict[str, Any]):
+    """还原被上一个任务修改过的 TLS 程序（在 loadState 之前调用）"""
+    if not tls_baseline:
+        return
+    traci = _sim_api()
+
+    for tl_id, logic in tls_baseline.items():
+        traci.trafficlight.setProgramLogic(tl_id, logic)
+
+
+def _evict_worker_sessions():
+    """
+    为即将新建的 session 腾出名额：总数受 worker_session_max 限制，
+    同一后端的实例数受后端上限限制（libsumo 每进程只能有一个仿真）。
+    """
+    backend = _sim_backend()
+    sessions = _worker().sessions
+    max_sessions = max(1, int(REWARD_CONFIG.get("worker_session_max", 1)))
+    prefix = f"{backend.name}:"
+    while sessions:
+        same = [k for k in sessions if k.startswith(prefix)]
+        if backend.max_instances is not None and len(same) >= backend.max_instances:
+            _drop_worker_session(same[0])
+        elif len(sessions) >= max_sessions:
+            _drop_worker_session(next(iter(sessions)))
+        else:
+            break
+
+
+def _acquire_worker_simulator(
+    sumocfg: str,
+    state_path: str,
+    port: Union[int, None] = None,
+) -> tuple[Union[SUMOSimulator, None], str]:
+    """
+    获取一个已恢复到 state_path 的 simulator。Returns (simulator, reason)。
+
+    - persistent_worker_sessions=True：复用本 worker 中同一 sumocfg 的常驻实例，仅 loadState；
+      实例不健康或 loadState 失败时自动重启一次。
+    - 否则：与旧行为一致，每次新启动 SUMO（调用方用完后经 _release_worker_simulator 关闭）。
+    """
+    state = _worker()
+
+    if state.retired:
+        return None, "worker_recycled"
+    if not os.path.exists(state_path):
+        return None, "state_path_missing"
+
+    # 仅在 pool worker 内常驻（主进程的串行回退仍用一次性实例，避免与 _GLOBAL_POOL 争用全局 traci 连接）
+    if not (REWARD_CONFIG.get("persistent_worker_sessions", False) and _get_worker_port() is not None):
+        state.tls_baseline = {}
+        if port is None:
+            port = _get_worker_port()
+        simulator = _start_worker_simulator(sumocfg, port)
+        if simulator is None:
+            return None, "start_simulation_failed"
+        state.api = getattr(simulator, "api", None)
+        try:
+            with _stage("restore_state"):
+                simulator.restore_simulation_state(state_path)
+        except Exception:
+            simulator.close()
+            raise
+        return simulator, "ok"
+
+    key = _session_key(sumocfg)
+    for attempt in range(2):
+        session = state.sessions.get(key)
+        if session is not None and not _simulator_is_healthy(session["simulator"]):
+            _drop_worker_session(key)
+            session = None
+
+        if session is None:
+            _evict_worker_sessions()
+            session_port = port if (port is not None and attempt == 0) else _next_worker_session_port()
+            simulator = _start_worker_simulator(sumocfg, session_port)
+            if simulator is None:
+                continue
+            session = {
+                "simulator": simulator,
+                "port": session_port,
+                "tls_baseline": {},
+                "tasks": 0,
+                "last_used": time.time(),
+            }
+            state.sessions[key] = session
+
+        state.sessions.move_to_end(key)
+        simulator = session["simulator"]
+        state.api = getattr(simulator, "api", None)
+        try:
+            with _stage("restore_state"):
+                _reset_tls_programs(session["tls_baseline"])
+                simulator.restore_simulation_state(state_path)
+        except Exception:
+            # 连接中断 / SUMO 崩溃：丢弃该实例，透明重启后重试
+            _drop_worker_session(key)
+            continue
+
+        session["tasks"] += 1
+        session["last_used"] = time.time()
+        state.tls_baseline = session["tls_baseline"]
+        return simulator, "ok"
+
+    return None, "start_simulation_failed"
+
+
+def _release_worker_simulator(sumocfg: str, simulator: Union[SUMOSimulator, None], *, broken: bool = False):
+    """
+    任务结束后释放 simulator：常驻模式下保留实例（broken=True 时丢弃以便下次重启），
+    非常驻模式下直接关闭。
+    """
+    state = _worker()
+    state.tls_baseline = None
+    if simulator is None:
+        return
+    state.api = None
+    key = _session_key(sumocfg)
+    session = state.sessions.get(key)
+    if session is not None and session["simulator"] is simulator:
+        if broken:
+            _drop_worker_session(key)
+        return
+    try:
+        with _stage("teardown"):
+            simulator.close()
+    except Exception:
+        pass
+
+
+def _reload_worker_state(simulator: SUMOSimulator, state_path: str):
+    """
+    在已持有的 simulator 上重新 loadState（同组多个动作之间调用），
+    先还原上一个动作修改过的 TLS 程序。
+    """
+    if not os.path.exists(state_path):
+        raise FileNotFoundError(state_path)
+    with _stage("restore_state"):
+        _reset_tls_programs(_worker().tls_baseline or {})
+        simulator.restore_simulation_state(state_path)
+
+
+# ==================== fork 分支引擎（进程内 libsumo） ====================
+# branching_engine="fork"：worker 内切到 libsumo 后端在本进程运行 SUMO，同一 state 的多个候选动作
+# 在决策点 os.fork()，每个子进程在写时复制的仿真副本上跑 _simulate_phase_window，经 pipe 回传指标。
+# 省去 saveState/loadState 的 XML 序列化。仅 POSIX + libsumo 可用，否则回退到 loadstate 路径。
+_FORK_ENGINE_WARNED = False
+
+
+def _fork_engine_available() -> bool:
+    global _FORK_ENGINE_WARNED
+    ok = hasattr(os, "fork") and libsumo_available()
+    if not ok and not _FORK_ENGINE_WARNED:
+        print("[tsc_reward_function] branching_engine=fork 需要 libsumo 和 os.fork，回退到 loadstate")
+        _FORK_ENGINE_WARNED = True
+    return ok
+
+
+def _fork_map(fn, items: List[Any]) -> List[Any]:
+    """
+    对每个 item os.fork() 一个子进程执行 fn(item)（子进程拿到父进程仿真的写时复制副本），
+    结果 JSON 序列化后经 pipe 回传。同时存活的子进程数受 fork_max_concurrency 限制。
+    子进程异常时在父进程重新抛出 RuntimeError。
+    """
+    max_conc = max(1, int(REWARD_CONFIG.get("fork_max_concurrency", 4)))
+    results: List[Any] = [None] * len(items)
+    for start in range(0, len(items), max_conc):
+        children = []
+        for idx in range(start, min(len(items), start + max_conc)):
+            r_fd, w_fd = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                os.close(r_fd)
+                try:
+                    payload = json.dumps(["ok", fn(items[idx])], default=str)
+                except BaseException as e:
+                    payload = json.dumps(["err", f"{type(e).__name__}: {e}"])
+                data = payload.encode("utf-8")
+                while data:
+                    data = data[os.write(w_fd, data):]
+                os.close(w_fd)
+                os._exit(0)
+            os.close(w_fd)
+            children.append((idx, pid, r_fd))
+
+        errors = []
+        for idx, pid, r_fd in children:
+            chunks = []
+            while True:
+                chunk = os.read(r_fd, 1 << 16)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            os.close(r_fd)
+            os.waitpid(pid, 0)
+            try:
+                status, value = json.loads(b"".join(chunks).decode("utf-8"))
+            except Exception:
+                status, value = "err", "child_exited_without_result"
+            if status == "ok":
+                results[idx] = value
+            else:
+                errors.append(value)
+        if errors:
+            raise RuntimeError(f"fork branch failed: {errors[0]}")
+    return results
+
+
+def _fork_engine_group_worker(group: List[tuple]) -> List[tuple]:
+    """
+    Parallel worker（fork 引擎）：与 _simulate_valid_action_group_worker 相同的输入/输出，
+    但在进程内 libsumo 上运行，signal_step 候选从决策点 fork 分支。
+    """
+    with _using_backend("libsumo"):
+        return _run_valid_action_group(group, branch="fork")
+
+
+def _group_task_indices(tasks: List[Any], key_fn) -> List[List[int]]:
+    """按 key_fn 把任务分组（保持首次出现顺序），返回每组的任务下标列表"""
+    groups: "OrderedDict[Any, List[int]]" = OrderedDict()
+    for i, task in enumerate(tasks):
+        groups.setdefault(key_fn(task), []).append(i)
+    return list(groups.values())
+
+
+def _sim_task_dedup_key(task: tuple) -> str:
+    """
+    sim 任务的去重 key：(state_path, task_type, 归一化动作, tls_phase_durations) 以及其余影响仿真的字段。
+    同一 prompt 的上下文字段相同，因此等价于按动作去重；port 不参与。
+    """
+    fields = _unpack_valid_action_task(task)[:14]
+    return json.dumps(fields, sort_keys=True, ensure_ascii=False, default=str)
+
+
+def _extend_window_mode() -> str:
+    """
+    extend_decision 仿真窗口的语义（rollout 缓存 key 与 reward 表标记的一部分）：
+    shared —— extend_prefix_sharing 开启，无论批次内有几个时长，目标相位都保持到窗口结束后 1 秒；
+    single —— 原始语义，phaseDuration 等于窗口长度（最后一秒可能已切入下一相位）。
+    """
+    return "shared" if REWARD_CONFIG.get("extend_prefix_sharing", True) else "single"
+
+
+def _rollout_cache_key(task: tuple) -> Union[str, None]:
+    """
+    rollout 缓存 key：state 文件内容哈希 + 任务类型 + 归一化动作 + TLS 配时 + 决策上下文 + SUMO 版本
+    （extend_decision 另含窗口语义，见 _extend_window_mode）。
+    用内容哈希而非路径，重新生成 dataset 后同名文件不会误命中。
+    """
+    (task_type, action, state_path, scenario, tl_id, sumocfg, phase_ids, decision_lead_sec,
+     decision_remaining_sec, wait_time, phase_limits, current_elapsed_sec, tls_phase_durations,
+     max_extend_sec, _port, _topology) = _unpack_valid_action_task(task)
+    digest = state_file_digest(state_path)
+    if digest is None:
+        return None
+    sumo_version = REWARD_CONFIG.get("rollout_cache_sumo_version") or detect_sumo_version()
+    fields = [
+        task_type, action, scenario, tl_id, os.path.basename(str(sumocfg)), phase_ids,
+        decision_lead_sec, decision_remaining_sec, wait_time, phase_limits,
+        current_elapsed_sec, tls_phase_durations, max_extend_sec,
+        _extend_window_mode() if task_type == "extend_decision" else None,
+    ]
+    return make_rollout_key(digest, fields, str(sumo_version))
+
+
+def _scatter_group_results(groups: List[List[int]], grouped_results: List[List[Any]], n: int) -> List[Any]:
+    """把按组返回的结果按原任务下标展开"""
+    out: List[Any] = [None] * n
+    for idxs, res in zip(groups, grouped_results):
+        for i, r in zip(idxs, res):
+            out[i] = r
+    return out
+
+
+# ==================== 评估辅助函数 ====================
+def evaluate_plan_once_reward_fn(
+    simulator: SUMOSimulator,
+    tl_id: str,
+    plan: List[dict],
+    topology: Union[Dict[str, Any], None] = None,
+) -> dict:
+    """
+    在当前 SUMO state 下执行一个信号配时方案并返回交通指标。
+    
+    Args:
+        simulator: SUMO 仿真器实例
+        tl_id: 信号灯 ID
+        plan: 配时方案 [{"phase_id": int, "final": int}, ...]
+        topology: 静态拓扑索引（可选），提供时直接取其 all_lanes
+    
+    Returns:
+        dict: {"passed_vehicles": float, "queue_vehicles": float, "total_queue_proxy": float, "sim_time": float}
+    """
+    traci = _sim_api()
+    
+    # 收集所有相位控制的 lanes
+    all_lanes = _get_all_incoming_lanes(simulator, tl_id, topology)
+    
+    # 记录执行前的车辆
+    vehicles_before = set()
+    with _stage("lane_poll"):
+        for ln in all_lanes:
+            try:
+                vehicles_before.update(traci.lane.getLastStepVehicleIDs(ln))
+            except Exception:
+                pass
+    
+    # 执行配时方案
+    total_queue_proxy = 0.0
+    watch = _LaneWatch(traci, all_lanes, all_lanes)
+    try:
+        for step in plan:
+            pid = int(step['phase_id'])
+            dur = int(step['final'])
+            traci.trafficlight.setPhase(tl_id, pid - 1)
+            for _ in range(max(0, dur)):
+                watch.step()
+                total_queue_proxy += watch.halting_total()
+
+        # 记录执行后的车辆和排队
+        vehicles_after = watch.vehicle_ids()
+        queue_end = watch.halting_total()
+    finally:
+        watch.close()
+    
+    passed = len(vehicles_before - vehicles_after)
+    
+    return {
+        'passed_vehicles': float(passed),
+        'queue_vehicles': float(queue_end),
+        'total_queue_proxy': float(total_queue_proxy),
+        'sim_time': float(traci.simulation.getTime()),
+    }
+
+
+_LITERAL_UNICODE_ESCAPE_RE = re.compile(r"\\u[0-9a-fA-F]{4}")
+
+
+def _extract_json_object(text: str) -> Union[Dict[str, Any], None]:
+    """
+    提取JSON对象，使用最后一个匹配的 {...}（更容错）。
+    """
+    if not text:
+        return None
+    s = text.strip()
+    
+    # 快速路径：纯JSON
+    if s.startswith("{") and s.endswith("}"):
+        try:
+            return json.loads(s)
+        except Exception:
+            pass
+    
+    # 查找所有 {...} 匹配，取最后一个（通常是真正的JSON输出）
+    matches = list(re.finditer(r"\{[^{}]*\}", s))
+    if not matches:
+        # 尝试更复杂的嵌套匹配
+        matches = list(re.finditer(r"\{[\s\S]*?\}", s))
+    
     # 从后往前尝试解析
     for m in reversed(matches):
         try:
@@ -474,10 +1757,130 @@ def _extract_json_object(text: str) -> Union[Dict[str, Any], None]:
     return None
 
 
+# ==================== 快速 completion 解析（两种输出 schema 的常见形态） ====================
+# 最后一个扁平 {...} 只含本任务字段（signal_step 两个字段任意顺序；extend_decision 为 extend [+ extend_sec]）、
+# 取值为整数/字符串时，一次正则匹配直接得到规范化动作；其余形态（多余或重复字段、浮点、null、嵌套、非法 JSON 等）
+# 返回 _FALLBACK，由原解析器处理，因此结果与原解析器完全相同。
+# JSON 标记之间只允许 JSON 空白（不能用 \s：它还匹配 json.loads 不接受的 Unicode 空白）
+_JSON_WS = r"[ \t\n\r]*"
+_JSON_INT_OR_STR = r'(-?(?:0|[1-9][0-9]*)(?![0-9.eE])|"[^"\\\x00-\x1f]*")'
+_JSON_EXTEND_VALUE = r'("[^"\\\x00-\x1f]*"|"(?:[^"\\\x00-\x1f]|\\["\\/bfnrt]|\\u[0-9a-fA-F]{4})*"|true|false)'
+# 常见 extend 取值 token（含 ensure_ascii 输出的 "\u662f" / "\u5426"）直接查表
+_EXTEND_TOKENS = {'"是"': "是", '"否"': "否", '"\\u662f"': "是", '"\\u5426"': "否", "true": "是", "false": "否"}
+_FALLBACK = object()
+
+
+def _schema_member(key: str, value: str) -> str:
+    return _JSON_WS + '"' + key + '"' + _JSON_WS + ":" + _JSON_WS + value + _JSON_WS
+
+
+_SIGNAL_STEP_RE = re.compile(
+    r"\{" + _schema_member("next_phase_id", _JSON_INT_OR_STR) + "," + _schema_member("green_sec", _JSON_INT_OR_STR) + r"\}"
+    r"|\{" + _schema_member("green_sec", _JSON_INT_OR_STR) + "," + _schema_member("next_phase_id", _JSON_INT_OR_STR) + r"\}"
+)
+_EXTEND_DECISION_RE = re.compile(
+    r"\{" + _schema_member("extend", _JSON_EXTEND_VALUE) + "(?:," + _schema_member("extend_sec", _JSON_INT_OR_STR) + r")?\}"
+    r"|\{" + _schema_member("extend_sec", _JSON_INT_OR_STR) + "," + _schema_member("extend", _JSON_EXTEND_VALUE) + r"\}"
+)
+
+
+def _last_flat_object_span(text: str) -> Union[tuple, None]:
+    """
+    _extract_json_object 会优先采用的 (start, end)：最后一个扁平 {...}。
+    不确定时（没有扁平对象、整段是另一个 JSON 候选）返回 None。
+    """
+    end = text.rfind("}")
+    start = text.rfind("{", 0, end) if end > 0 else -1
+    if start < 0 or text.find("}", start, end) >= 0:
+        return None
+    if start or end + 1 != len(text):
+        # 整段以 { 开头、以 } 结尾时，_extract_json_object 先尝试整段；只有整段就是这个对象时才等价
+        s = text.strip()
+        if s[:1] == "{" and s[-1:] == "}" and len(s) != end - start + 1:
+            return None
+    return start, end + 1
+
+
+def _match_schema(pattern: "re.Pattern", text: str) -> Union["re.Match", None]:
+    # 最常见的是整段就是该对象：一次 fullmatch 即可（能匹配说明整段是合法 JSON，与原解析器的整段 json.loads 一致）
+    m = pattern.fullmatch(text) if text[:1] == "{" else None
+    if m is None:
+        span = _last_flat_object_span(text)
+        m = pattern.fullmatch(text, *span) if span else None
+    return m
+
+
+def _int_token(token: str) -> int:
+    """整数或数值字符串 token -> int（与原解析器的 int(str) 容忍规则相同，失败抛 ValueError）"""
+    return int(token[1:-1]) if token[0] == '"' else int(token)
+
+
+def _fast_parse_signal_step(text: str) -> Any:
+    m = _match_schema(_SIGNAL_STEP_RE, text) if text else None
+    if m is None:
+        return _FALLBACK
+    next_phase_id, green_sec, g2, p2 = m.groups()
+    if next_phase_id is None:
+        next_phase_id, green_sec = p2, g2
+    try:
+        next_phase_id, green_sec = _int_token(next_phase_id), _int_token(green_sec)
+    except ValueError:
+        return None
+    if green_sec <= 0:
+        return None
+    return {"next_phase_id": next_phase_id, "green_sec": green_sec}
+
+
+def _fast_parse_extend_decision(text: str) -> Any:
+    m = _match_schema(_EXTEND_DECISION_RE, text) if text else None
+    if m is None:
+        return _FALLBACK
+    extend, extend_sec, s2, e2 = m.groups()
+    if extend is None:
+        extend, extend_sec = e2, s2
+    if extend in _EXTEND_TOKENS:
+        extend = _EXTEND_TOKENS[extend]
+    else:
+        extend = _normalize_extend_value(extend[1:-1] if "\\" not in extend else json.loads(extend))
+    if extend is None:
+        return None
+    if extend == "否":
+        return None if extend_sec is not None else {"extend": "否", "extend_sec": 0}
+    if extend_sec is None:
+        return None
+    try:
+        extend_sec = _int_token(extend_sec)
+    except ValueError:
+        return None
+    if extend_sec < 0:
+        return None
+    return {"extend": extend, "extend_sec": extend_sec}
+
+
+def _normalize_extend_value(extend: str) -> Union[str, None]:
+    """extend 字符串同义值 -> "是"/"否"（无法识别返回 None）"""
+    extend_lower = extend.lower().strip()
+    # 兼容模型输出把中文写成字面量转义（例如 "\\u662f"），此时 json.loads 后会得到 "\u662f"
+    if "\\u" in extend_lower and _LITERAL_UNICODE_ESCAPE_RE.search(extend_lower):
+        try:
+            extend_lower = extend_lower.encode("utf-8").decode("unicode_escape").lower().strip()
+        except Exception:
+            pass
+    if extend_lower in ("是", "yes", "true", "1", "延长"):
+        return "是"
+    if extend_lower in ("否", "no", "false", "0", "不延长"):
+        return "否"
+    return None
+
+
 def _parse_signal_step_output(text: str, debug: bool = False) -> Union[Dict[str, int], None]:
     """
     解析 signal_step 输出，容忍多余字段和数值字符串。
     """
+    if not debug and REWARD_CONFIG.get("fast_completion_parser", True):
+        parsed = _fast_parse_signal_step(text)
+        if parsed is not _FALLBACK:
+            return parsed
     obj = _extract_json_object(text)
     if not isinstance(obj, dict):
         if debug: print(f"  - 提取的不是dict: {type(obj)}")
@@ -519,6 +1922,10 @@ def _parse_extend_decision_output(text: str, debug: bool = False) -> Union[Dict[
     """
     解析 extend_decision 输出，容忍多余字段、数值字符串和extend同义值。
     """
+    if not debug and REWARD_CONFIG.get("fast_completion_parser", True):
+        parsed = _fast_parse_extend_decision(text)
+        if parsed is not _FALLBACK:
+            return parsed
     obj = _extract_json_object(text)
     if not isinstance(obj, dict):
         if debug: print(f"  - 提取的不是dict: {type(obj)}")
@@ -532,22 +1939,11 @@ def _parse_extend_decision_output(text: str, debug: bool = False) -> Union[Dict[
         # 容忍 extend 的同义值
         extend = obj.get("extend")
         if isinstance(extend, str):
-            extend_lower = extend.lower().strip()
-            # 兼容模型输出把中文写成字面量转义（例如 "\\u662f"），此时 json.loads 后会得到 "\u662f"
-            if re.search(r"\\u[0-9a-fA-F]{4}", extend_lower):
-                try:
-                    extend_decoded = extend_lower.encode("utf-8").decode("unicode_escape").lower().strip()
-                    extend_lower = extend_decoded
-                except Exception:
-                    pass
-            # 映射同义值
-            if extend_lower in ("是", "yes", "true", "1", "延长"):
-                extend = "是"
-            elif extend_lower in ("否", "no", "false", "0", "不延长"):
-                extend = "否"
-            else:
+            normalized = _normalize_extend_value(extend)
+            if normalized is None:
                 if debug: print(f"  - extend值无法识别: {extend}")
                 return None
+            extend = normalized
         elif isinstance(extend, bool):
             extend = "是" if extend else "否"
         else:
@@ -693,6 +2089,18 @@ def validate_action(
     return False, "unsupported_task_type", action
 
 
+def validate_actions(
+    task_types: List[str],
+    actions: List[Dict[str, Any]],
+    contexts: List[Dict[str, Any]],
+) -> List[tuple]:
+    """
+    批量 validate_action：contexts[k] 为第 k 个动作的 validate_action 关键字参数。
+    逐个调用 validate_action（每批只有几十行，构造数组的开销高于规则判断本身）。
+    """
+    return [validate_action(t, a, **ctx) for t, a, ctx in zip(task_types, actions, contexts)]
+
+
 def aggregate_reward(
     *,
     valid: bool,
@@ -716,6 +2124,30 @@ def aggregate_reward(
     }
 
 
+def _sim_reward_from_metrics(task_type: str, sim_metrics: Dict[str, Any]) -> tuple[float, str]:
+    """
+    由原始仿真指标计算 sim_reward 与 reason（使用当前 REWARD_CONFIG 权重）。
+    score_* 与 rollout 缓存命中路径共用，保证两者一致。
+    """
+    avg_passed = float(sim_metrics["avg_passed_veh"])
+    avg_queue = float(sim_metrics["avg_queue_veh"])
+    sim_reward = float(REWARD_CONFIG["alpha_passed"] * avg_passed - REWARD_CONFIG["beta_queue"] * avg_queue)
+
+    reason = "ok"
+    if sim_metrics.get("non_green_phase"):
+        reason = f"{task_type}_target_phase_not_green"
+    elif sim_metrics.get("duration_zero"):
+        reason = f"{task_type}_duration_zero"
+    return sim_reward, reason
+
+
+def _reward_from_rollout_record(task_type: str, record: Dict[str, Any]) -> tuple[float, str]:
+    """由 worker 返回/缓存中的 rollout 记录重算 (reward, reason)"""
+    if not record.get("valid", False):
+        return float(REWARD_CONFIG["invalid_output_reward"]), str(record.get("reason", "invalid"))
+    return _sim_reward_from_metrics(task_type, record)
+
+
 def score_signal_step(
     simulator: "SUMOSimulator",
     tl_id: str,
@@ -727,63 +2159,141 @@ def score_signal_step(
     tls_phase_durations: Union[List[Any], None],
     green_sec_min: Union[int, None] = None,
     green_sec_max: Union[int, None] = None,
+    topology: Union[Dict[str, Any], None] = None,
 ) -> Dict[str, Any]:
     """
     Score a signal_step action by running a short SUMO roll-forward.
     """
-    invalid = float(REWARD_CONFIG["invalid_output_reward"])
-    ok, reason, action = validate_action(
-        "signal_step",
-        action,
+    return score_signal_step_variants(
+        simulator,
+        tl_id,
+        [action],
         phase_ids=phase_ids,
+        decision_lead_sec=decision_lead_sec,
+        decision_remaining_sec=decision_remaining_sec,
+        tls_phase_durations=tls_phase_durations,
         green_sec_min=green_sec_min,
         green_sec_max=green_sec_max,
-    )
-    if not ok:
-        return aggregate_reward(
-            valid=False,
-            sim_reward=0.0,
-            invalid_reward=invalid,
-            reward_components={"task": "signal_step"},
-            error_tags=[reason],
-            reason=reason,
+        topology=topology,
+    )[0]
+
+
+def _warm_snapshot_path() -> str:
+    """signal_step 决策点快照文件路径（优先 tmpfs），按进程/线程区分"""
+    snap_dir = REWARD_CONFIG.get("warm_snapshot_dir")
+    if not snap_dir:
+        snap_dir = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(snap_dir, f"tsc_reward_warm_{os.getpid()}_{threading.get_ident()}.xml")
+
+
+def score_signal_step_variants(
+    simulator: "SUMOSimulator",
+    tl_id: str,
+    actions: List[Dict[str, Any]],
+    *,
+    phase_ids: Union[List[int], None],
+    decision_lead_sec: int,
+    decision_remaining_sec: Union[int, None],
+    tls_phase_durations: Union[List[Any], None],
+    green_sec_min: Union[int, None] = None,
+    green_sec_max: Union[int, None] = None,
+    branch: str = "loadstate",
+    topology: Union[Dict[str, Any], None] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Score several signal_step actions of the same state.
+
+    The pre-decision stretch (decision_remaining_sec under the original program) is identical for
+    every candidate, so it runs once. Candidates then branch from the decision point:
+      - branch="loadstate": save the decision point and loadState it before each further candidate.
+      - branch="fork": os.fork() one child per candidate (in-process libsumo only, see _fork_map).
+
+    topology: optional static TL index (scu_tsc_newprompt.tl_topology); skips per-window lane/phase queries.
+    """
+    invalid = float(REWARD_CONFIG["invalid_output_reward"])
+    outs: List[Union[Dict[str, Any], None]] = [None] * len(actions)
+    valid_actions: Dict[int, Dict[str, Any]] = {}
+    for i, action in enumerate(actions):
+        ok, reason, action = validate_action(
+            "signal_step",
+            action,
+            phase_ids=phase_ids,
+            green_sec_min=green_sec_min,
+            green_sec_max=green_sec_max,
         )
+        if not ok:
+            outs[i] = aggregate_reward(
+                valid=False,
+                sim_reward=0.0,
+                invalid_reward=invalid,
+                reward_components={"task": "signal_step"},
+                error_tags=[reason],
+                reason=reason,
+            )
+            continue
+        valid_actions[i] = action
 
-    import traci
+    if not valid_actions:
+        return outs
 
-    _apply_tls_phase_durations(tl_id, tls_phase_durations or [])
+    traci = _sim_api()
+
+    with _stage("apply_tls"):
+        _apply_tls_phase_durations(tl_id, tls_phase_durations or [])
 
     decision_rem = decision_remaining_sec if decision_remaining_sec is not None else int(decision_lead_sec)
-    for _ in range(int(max(0, decision_rem))):
-        traci.simulationStep()
+    with _stage("step"):
+        for _ in range(int(max(0, decision_rem))):
+            traci.simulationStep()
 
-    next_phase_id = int(action["next_phase_id"])
-    green_sec = int(action["green_sec"])
-    sim_metrics = _simulate_phase_window(simulator, tl_id, next_phase_id, green_sec)
+    def _window(action: Dict[str, Any]) -> Dict[str, float]:
+        return _simulate_phase_window(
+            simulator, tl_id, int(action["next_phase_id"]), int(action["green_sec"]), topology=topology
+        )
 
-    avg_passed = float(sim_metrics["avg_passed_veh"])
-    avg_queue = float(sim_metrics["avg_queue_veh"])
-    sim_reward = float(REWARD_CONFIG["alpha_passed"] * avg_passed - REWARD_CONFIG["beta_queue"] * avg_queue)
+    if branch == "fork" and len(valid_actions) > 1:
+        metrics_list = _fork_map(_window, list(valid_actions.values()))
+    else:
+        metrics_list = []
+        snapshot = None
+        if len(valid_actions) > 1:
+            snapshot = _warm_snapshot_path()
+            with _stage("restore_state"):
+                traci.simulation.saveState(snapshot)
+        try:
+            for n, action in enumerate(valid_actions.values()):
+                if n > 0:
+                    with _stage("restore_state"):
+                        simulator.restore_simulation_state(snapshot)
+                metrics_list.append(_window(action))
+        finally:
+            if snapshot is not None:
+                try:
+                    os.remove(snapshot)
+                except OSError:
+                    pass
 
-    final_reason = "ok"
-    if sim_metrics.get("non_green_phase"):
-        final_reason = "signal_step_target_phase_not_green"
-    elif sim_metrics.get("duration_zero"):
-        final_reason = "signal_step_duration_zero"
-
-    return aggregate_reward(
-        valid=True,
-        sim_reward=sim_reward,
-        invalid_reward=invalid,
-        reward_components={
-            "task": "signal_step",
-            "sim_avg_passed": avg_passed,
-            "sim_avg_queue": avg_queue,
-            "sim_reward": sim_reward,
-        },
-        error_tags=[] if final_reason == "ok" else [final_reason],
-        reason=final_reason,
-    )
+    for i, sim_metrics in zip(valid_actions.keys(), metrics_list):
+        avg_passed = float(sim_metrics["avg_passed_veh"])
+        avg_queue = float(sim_metrics["avg_queue_veh"])
+        sim_reward, final_reason = _sim_reward_from_metrics("signal_step", sim_metrics)
+
+        out = aggregate_reward(
+            valid=True,
+            sim_reward=sim_reward,
+            invalid_reward=invalid,
+            reward_components={
+                "task": "signal_step",
+                "sim_avg_passed": avg_passed,
+                "sim_avg_queue": avg_queue,
+                "sim_reward": sim_reward,
+            },
+            error_tags=[] if final_reason == "ok" else [final_reason],
+            reason=final_reason,
+        )
+        out["sim_metrics"] = sim_metrics
+        outs[i] = out
+    return outs
 
 
 def score_extend_decision(
@@ -796,15 +2306,55 @@ def score_extend_decision(
     current_elapsed_sec: Union[int, None],
     tls_phase_durations: Union[List[Any], None],
     max_extend_sec: Union[int, None] = None,
+    topology: Union[Dict[str, Any], None] = None,
+    shared_window: bool = False,
 ) -> Dict[str, Any]:
     """
     Score an extend_decision action by validating bounds and simulating the phase window.
+    shared_window=True scores it with the prefix-sharing window semantics (see score_extend_decision_variants).
+    """
+    return score_extend_decision_variants(
+        simulator,
+        tl_id,
+        [action],
+        phase_limits=phase_limits,
+        wait_time_for_phase_change=wait_time_for_phase_change,
+        current_elapsed_sec=current_elapsed_sec,
+        tls_phase_durations=tls_phase_durations,
+        max_extend_sec=max_extend_sec,
+        topology=topology,
+        shared_window=shared_window,
+    )[0]
+
+
+def score_extend_decision_variants(
+    simulator: "SUMOSimulator",
+    tl_id: str,
+    actions: List[Dict[str, Any]],
+    *,
+    phase_limits: Union[Dict[str, Any], None],
+    wait_time_for_phase_change: int,
+    current_elapsed_sec: Union[int, None],
+    tls_phase_durations: Union[List[Any], None],
+    max_extend_sec: Union[int, None] = None,
+    topology: Union[Dict[str, Any], None] = None,
+    shared_window: bool = True,
+) -> List[Dict[str, Any]]:
+    """
+    Score several extend_decision actions of the same state with a single roll-forward.
+
+    All variants hold the current green for (extend_sec + wait_time) seconds, so each window is a
+    prefix of the longest one (see _simulate_phase_window_prefixes).
+
+    shared_window=False keeps the single-window semantics (phase duration = window length) and
+    accepts only actions with one window length; see _extend_window_mode.
     """
     invalid = float(REWARD_CONFIG["invalid_output_reward"])
 
-    import traci
+    traci = _sim_api()
 
-    _apply_tls_phase_durations(tl_id, tls_phase_durations or [])
+    with _stage("apply_tls"):
+        _apply_tls_phase_durations(tl_id, tls_phase_durations or [])
 
     # Identify current phase + elapsed (prefer dataset-provided elapsed)
     current_phase_idx = traci.trafficlight.getPhase(tl_id)
@@ -817,176 +2367,173 @@ def score_extend_decision(
     else:
         current_elapsed_sec = int(current_elapsed_sec)
 
-    ok, reason, action = validate_action(
-        "extend_decision",
-        action,
-        phase_limits=phase_limits,
-        current_phase_id=current_phase_id,
-        current_elapsed_sec=current_elapsed_sec,
-        wait_time_for_phase_change=wait_time_for_phase_change,
-        max_extend_sec=max_extend_sec,
-    )
-    if not ok:
-        return aggregate_reward(
-            valid=False,
-            sim_reward=0.0,
-            invalid_reward=invalid,
-            reward_components={"task": "extend_decision", "current_phase_id": current_phase_id},
-            error_tags=[reason],
-            reason=reason,
+    outs: List[Union[Dict[str, Any], None]] = [None] * len(actions)
+    durations: Dict[int, int] = {}
+    for i, action in enumerate(actions):
+        ok, reason, action = validate_action(
+            "extend_decision",
+            action,
+            phase_limits=phase_limits,
+            current_phase_id=current_phase_id,
+            current_elapsed_sec=current_elapsed_sec,
+            wait_time_for_phase_change=wait_time_for_phase_change,
+            max_extend_sec=max_extend_sec,
         )
+        if not ok:
+            outs[i] = aggregate_reward(
+                valid=False,
+                sim_reward=0.0,
+                invalid_reward=invalid,
+                reward_components={"task": "extend_decision", "current_phase_id": current_phase_id},
+                error_tags=[reason],
+                reason=reason,
+            )
+            continue
 
-    extend = str(action["extend"])
-    extend_sec = int(action["extend_sec"])
-    duration = extend_sec + int(wait_time_for_phase_change) if extend == "是" else int(wait_time_for_phase_change)
-    sim_metrics = _simulate_phase_window(simulator, tl_id, current_phase_id, duration)
+        extend = str(action["extend"])
+        extend_sec = int(action["extend_sec"])
+        duration = extend_sec + int(wait_time_for_phase_change) if extend == "是" else int(wait_time_for_phase_change)
+        durations[i] = max(0, int(duration))
 
-    avg_passed = float(sim_metrics["avg_passed_veh"])
-    avg_queue = float(sim_metrics["avg_queue_veh"])
-    sim_reward = float(REWARD_CONFIG["alpha_passed"] * avg_passed - REWARD_CONFIG["beta_queue"] * avg_queue)
+    if not durations:
+        return outs
 
-    final_reason = "ok"
-    if sim_metrics.get("non_green_phase"):
-        final_reason = "extend_decision_target_phase_not_green"
-    elif sim_metrics.get("duration_zero"):
-        final_reason = "extend_decision_duration_zero"
-
-    return aggregate_reward(
-        valid=True,
-        sim_reward=sim_reward,
-        invalid_reward=invalid,
-        reward_components={
-            "task": "extend_decision",
-            "current_phase_id": current_phase_id,
-            "current_elapsed_sec": int(current_elapsed_sec),
-            "duration": int(duration),
-            "sim_avg_passed": avg_passed,
-            "sim_avg_queue": avg_queue,
-            "sim_reward": sim_reward,
-        },
-        error_tags=[] if final_reason == "ok" else [final_reason],
-        reason=final_reason,
+    metrics_by_duration = _simulate_phase_window_prefixes(
+        simulator, tl_id, current_phase_id, list(durations.values()), topology=topology, hold_past_end=shared_window
     )
+    for i, duration in durations.items():
+        sim_metrics = metrics_by_duration[duration]
+        avg_passed = float(sim_metrics["avg_passed_veh"])
+        avg_queue = float(sim_metrics["avg_queue_veh"])
+        sim_reward, final_reason = _sim_reward_from_metrics("extend_decision", sim_metrics)
+
+        out = aggregate_reward(
+            valid=True,
+            sim_reward=sim_reward,
+            invalid_reward=invalid,
+            reward_components={
+                "task": "extend_decision",
+                "current_phase_id": current_phase_id,
+                "current_elapsed_sec": int(current_elapsed_sec),
+                "duration": int(duration),
+                "sim_avg_passed": avg_passed,
+                "sim_avg_queue": avg_queue,
+                "sim_reward": sim_reward,
+            },
+            error_tags=[] if final_reason == "ok" else [final_reason],
+            reason=final_reason,
+        )
+        out["sim_metrics"] = sim_metrics
+        outs[i] = out
+    return outs
 
 
-def _extract_phase_limits_from_prompt(prompt_messages: List[dict]) -> Union[Dict[str, Any], None]:
-    """
-    从 prompt 文本中提取 phase_limits（用于 extend_decision 任务）。
-    
-    当 dataset 没有 phase_limits 列时，从 prompt 中的 JSON 提取。
-    """
-    if not prompt_messages:
-        return None
-    
-    # 获取 user message 内容
-    user_content = None
-    for msg in prompt_messages:
-        if msg.get('role') == 'user':
-            user_content = msg.get('content', '')
-            break
-    
-    if not user_content:
-        return None
-    
-    # 提取 extend_decision_input_json
-    match = re.search(r'【extend_decision_input_json】(.*?)【/extend_decision_input_json】', user_content, re.DOTALL)
+_PROMPT_TAG_RE = {
+    tag: re.compile(rf"【{tag}】(.*?)【/{tag}】", re.DOTALL)
+    for tag in ("extend_decision_input_json", "signal_step_input_json")
+}
+# user message 内容摘要 -> 解析出的元数据（LRU，容量 prompt_meta_cache_size）
+_PROMPT_META_CACHE: "OrderedDict[bytes, Dict[str, Any]]" = OrderedDict()
+_PROMPT_META_LOCK = threading.Lock()
+
+
+def _tagged_json(user_content: str, tag: str) -> Any:
+    """【tag】...【/tag】 之间的 JSON；缺失或解析失败时 None"""
+    match = _PROMPT_TAG_RE[tag].search(user_content)
     if not match:
         return None
-    
     try:
-        data = json.loads(match.group(1))
-        return data.get('phase_limits')
+        return json.loads(match.group(1))
     except Exception:
         return None
 
 
-def _extract_wait_time_from_prompt(prompt_messages: List[dict]) -> Union[int, None]:
-    """
-    从 prompt 文本中提取 wait_time_for_phase_change（用于 extend_decision 任务）。
-    """
-    if not prompt_messages:
-        return None
-    
-    user_content = None
-    for msg in prompt_messages:
-        if msg.get('role') == 'user':
-            user_content = msg.get('content', '')
+def _parse_prompt_metadata(user_content: str) -> Dict[str, Any]:
+    """一次解析 prompt 中的输入 JSON，得到 current_phase_id / phase_limits / wait_time / max_extend_sec"""
+    meta: Dict[str, Any] = {"current_phase_id": None, "phase_limits": None, "wait_time": None, "max_extend_sec": None}
+    extend = _tagged_json(user_content, "extend_decision_input_json")
+    if isinstance(extend, dict):
+        meta["phase_limits"] = extend.get("phase_limits")
+        state = extend.get("state", {})
+        meta["wait_time"] = state.get("wait_time_for_phase_change") if isinstance(state, dict) else None
+        meta["max_extend_sec"] = extend.get("max_extend_sec")
+
+    # extend_decision_input_json / signal_step_input_json 都包含 state.current_phase_id
+    for data in (extend, _tagged_json(user_content, "signal_step_input_json")):
+        if not isinstance(data, dict):
+            continue
+        state = data.get("state", {}) or {}
+        try:
+            v = state.get("current_phase_id", None)
+            if v is None:
+                continue
+            meta["current_phase_id"] = int(v)
             break
-    
-    if not user_content:
-        return None
-    
-    match = re.search(r'【extend_decision_input_json】(.*?)【/extend_decision_input_json】', user_content, re.DOTALL)
-    if not match:
-        return None
-    
-    try:
-        data = json.loads(match.group(1))
-        state = data.get('state', {})
-        return state.get('wait_time_for_phase_change')
-    except Exception:
-        return None
+        except Exception:
+            continue
+    return meta
 
 
-def _extract_max_extend_sec_from_prompt(prompt_messages: List[dict]) -> Union[int, None]:
+def _prompt_metadata(prompt_messages: List[dict]) -> Dict[str, Any]:
     """
-    从 prompt 文本中提取 max_extend_sec（用于 extend_decision 任务）。
+    prompt 元数据（见 _parse_prompt_metadata），按第一条 user message 内容的摘要 LRU 缓存：
+    旧 dataset 没有 current_phase_id / max_extend_sec 等列时，同一 prompt 只解析一次。
     """
+    empty = {"current_phase_id": None, "phase_limits": None, "wait_time": None, "max_extend_sec": None}
     if not prompt_messages:
-        return None
-    
+        return empty
+
+    # 获取 user message 内容
     user_content = None
     for msg in prompt_messages:
-        if msg.get('role') == 'user':
-            user_content = msg.get('content', '')
+        if msg.get("role") == "user":
+            user_content = msg.get("content", "")
             break
-    
     if not user_content:
-        return None
-    
-    match = re.search(r'【extend_decision_input_json】(.*?)【/extend_decision_input_json】', user_content, re.DOTALL)
-    if not match:
-        return None
-    
-    try:
-        data = json.loads(match.group(1))
-        return data.get('max_extend_sec')
-    except Exception:
-        return None
+        return empty
+
+    key = hashlib.blake2b(user_content.encode("utf-8"), digest_size=16).digest()
+    with _PROMPT_META_LOCK:
+        meta = _PROMPT_META_CACHE.get(key)
+        if meta is not None:
+            _PROMPT_META_CACHE.move_to_end(key)
+            return meta
+    meta = _parse_prompt_metadata(user_content)
+    with _PROMPT_META_LOCK:
+        _PROMPT_META_CACHE[key] = meta
+        while len(_PROMPT_META_CACHE) > max(1, int(REWARD_CONFIG.get("prompt_meta_cache_size", 4096))):
+            _PROMPT_META_CACHE.popitem(last=False)
+    return meta
 
 
-def _extract_current_phase_id_from_prompt(prompt_messages: List[dict]) -> Union[int, None]:
+def _extract_phase_limits_from_prompt(prompt_messages: List[dict]) -> Union[Dict[str, Any], None]:
     """
-    从 prompt 文本中提取 current_phase_id（用于 extend_decision / signal_step 的无仿真校验兜底）。
+    从 prompt 文本中提取 phase_limits（用于 extend_decision 任务）。
+    
+    当 dataset 没有 phase_limits 列时，从 prompt 中的 JSON 提取。
     """
-    if not prompt_messages:
-        return None
+    return _prompt_metadata(prompt_messages)["phase_limits"]
 
-    user_content = None
-    for msg in prompt_messages:
-        if msg.get("role") == "user":
-            user_content = msg.get("content", "")
-            break
 
-    if not user_content:
-        return None
+def _extract_wait_time_from_prompt(prompt_messages: List[dict]) -> Union[int, None]:
+    """
+    从 prompt 文本中提取 wait_time_for_phase_change（用于 extend_decision 任务）。
+    """
+    return _prompt_metadata(prompt_messages)["wait_time"]
+
 
-    # extend_decision_input_json / signal_step_input_json 都包含 state.current_phase_id
-    for tag in ("extend_decision_input_json", "signal_step_input_json"):
-        match = re.search(rf"【{tag}】(.*?)【/{tag}】", user_content, re.DOTALL)
-        if not match:
-            continue
-        try:
-            data = json.loads(match.group(1))
-            state = data.get("state", {}) or {}
-            v = state.get("current_phase_id", None)
-            if v is None:
-                continue
-            return int(v)
-        except Exception:
-            continue
+def _extract_max_extend_sec_from_prompt(prompt_messages: List[dict]) -> Union[int, None]:
+    """
+    从 prompt 文本中提取 max_extend_sec（用于 extend_decision 任务）。
+    """
+    return _prompt_metadata(prompt_messages)["max_extend_sec"]
 
-    return None
+
+def _extract_current_phase_id_from_prompt(prompt_messages: List[dict]) -> Union[int, None]:
+    """
+    从 prompt 文本中提取 current_phase_id（用于 extend_decision / signal_step 的无仿真校验兜底）。
+    """
+    return _prompt_metadata(prompt_messages)["current_phase_id"]
 
 
 def _apply_tls_phase_durations(tl_id: str, durations: List[int]):
@@ -997,7 +2544,7 @@ def _apply_tls_phase_durations(tl_id: str, durations: List[int]):
         tl_id: 信号灯ID
         durations: 各相位的duration列表
     """
-    import traci
+    traci = _sim_api()
     
     if not durations:
         return
@@ -1011,6 +2558,11 @@ def _apply_tls_phase_durations(tl_id: str, durations: List[int]):
         # 确保durations数量与phases数量匹配
         if len(durations) != len(logic.phases):
             return
+
+        # 常驻 session：登记修改前的原始程序，供下一个任务还原
+        tls_baseline = _worker().tls_baseline
+        if tls_baseline is not None and tl_id not in tls_baseline:
+            tls_baseline[tl_id] = logic
         
         phases = []
         for i, ph in enumerate(logic.phases):
@@ -1029,13 +2581,20 @@ def _apply_tls_phase_durations(tl_id: str, durations: List[int]):
         print(f"应用 tls_phase_durations 失败: {e}")
 
 
-def _get_phase_incoming_lanes(simulator: SUMOSimulator, tl_id: str, phase_id: int) -> List[str]:
-    phase_idx = max(0, int(phase_id) - 1)
-    info = simulator.get_phase_controlled_lanes(tl_id, phase_idx)
+def _get_phase_incoming_lanes(
+    simulator: SUMOSimulator, tl_id: str, phase_id: int, topology: Union[Dict[str, Any], None] = None
+) -> List[str]:
+    if topology is not None:
+        return topology_phase_lanes(topology, phase_id)
+    info = simulator.get_phase_controlled_lanes(tl_id, max(0, int(phase_id) - 1))
     return list(info.get("incoming_lanes", []))
 
 
-def _get_all_incoming_lanes(simulator: SUMOSimulator, tl_id: str) -> List[str]:
+def _get_all_incoming_lanes(
+    simulator: SUMOSimulator, tl_id: str, topology: Union[Dict[str, Any], None] = None
+) -> List[str]:
+    if topology is not None:
+        return list(topology.get("all_lanes", []))
     phase_info = simulator.get_phase_info(tl_id)
     n = int(phase_info.get("num_phases", 0))
     all_lanes = set()
@@ -1044,80 +2603,287 @@ def _get_all_incoming_lanes(simulator: SUMOSimulator, tl_id: str) -> List[str]:
     return list(all_lanes)
 
 
+class _LaneWatch:
+    """
+    仿真窗口内的车道读数：默认对车道做 TraCI 订阅，每次 step() 的响应里一次带回
+    所有车道的排队数（及所需车道的车辆 ID），之后的读取都是客户端本地查表；close() 时退订。
+    尚未 step() 过或 lane_subscriptions=False 时逐车道查询（每车道一次往返）。
+    无法订阅/查询的车道按 0 辆计，与逐车道查询时吞掉异常的行为一致。
+    step() 计入 step 阶段，订阅/读取/退订计入 lane_poll 阶段（见 _stage）。
+    """
+
+    def __init__(self, traci, halting_lanes: List[str], id_lanes: List[str]):
+        with _stage("lane_poll"):
+            self._setup(traci, halting_lanes, id_lanes)
+
+    def _setup(self, traci, halting_lanes: List[str], id_lanes: List[str]):
+        self._traci = traci
+        self.halting_lanes = list(halting_lanes)
+        self.id_lanes = list(id_lanes)
+        self._subscribed: List[str] = []
+        self._use_subs = bool(REWARD_CONFIG.get("lane_subscriptions", True))
+        self._fresh = False  # 订阅结果是否对应当前仿真步
+        if not self._use_subs:
+            return
+        tc = traci.constants
+        id_set = set(self.id_lanes)
+        for ln in dict.fromkeys(self.halting_lanes + self.id_lanes):
+            varids = [tc.LAST_STEP_VEHICLE_HALTING_NUMBER]
+            if ln in id_set:
+                varids.append(tc.LAST_STEP_VEHICLE_ID_LIST)
+            try:
+                traci.lane.subscribe(ln, varids)
+                self._subscribed.append(ln)
+            except Exception:
+                pass
+
+    def step(self):
+        with _stage("step"):
+            self._traci.simulationStep()
+        self._fresh = self._use_subs
+
+    def _result(self, ln: str) -> Dict[int, Any]:
+        return self._traci.lane.getSubscriptionResults(ln) or {}
+
+    def halting_total(self) -> float:
+        with _stage("lane_poll"):
+            return self._halting_total()
+
+    def _halting_total(self) -> float:
+        traci = self._traci
+        q = 0.0
+        if self._fresh:
+            var = traci.constants.LAST_STEP_VEHICLE_HALTING_NUMBER
+            for ln in self.halting_lanes:
+                q += self._result(ln).get(var, 0)
+            return q
+        for ln in self.halting_lanes:
+            try:
+                q += traci.lane.getLastStepHaltingNumber(ln)
+            except Exception:
+                pass
+        return q
+
+    def vehicle_ids(self) -> set:
+        with _stage("lane_poll"):
+            return self._vehicle_ids()
+
+    def _vehicle_ids(self) -> set:
+        traci = self._traci
+        ids = set()
+        if self._fresh:
+            var = traci.constants.LAST_STEP_VEHICLE_ID_LIST
+            for ln in self.id_lanes:
+                ids.update(self._result(ln).get(var, ()))
+            return ids
+        for ln in self.id_lanes:
+            try:
+                ids.update(traci.lane.getLastStepVehicleIDs(ln))
+            except Exception:
+                pass
+        return ids
+
+    def close(self):
+        with _stage("lane_poll"):
+            for ln in self._subscribed:
+                try:
+                    self._traci.lane.unsubscribe(ln)
+                except Exception:
+                    pass
+        self._subscribed = []
+
+
 def _simulate_phase_window(
     simulator: SUMOSimulator,
     tl_id: str,
     phase_id: int,
     duration_sec: int,
+    topology: Union[Dict[str, Any], None] = None,
 ) -> Dict[str, float]:
-    import traci
-
     duration = max(0, int(duration_sec))
-    lanes = _get_phase_incoming_lanes(simulator, tl_id, phase_id)
-    all_lanes = _get_all_incoming_lanes(simulator, tl_id) or lanes
+    return _simulate_phase_window_prefixes(
+        simulator, tl_id, phase_id, [duration], topology=topology, hold_past_end=False
+    )[duration]
+
+
+def _simulate_phase_window_prefixes(
+    simulator: SUMOSimulator,
+    tl_id: str,
+    phase_id: int,
+    durations: List[int],
+    topology: Union[Dict[str, Any], None] = None,
+    hold_past_end: bool = True,
+) -> Dict[int, Dict[str, float]]:
+    """
+    一次仿真得到多个保持时长的窗口指标：只运行最长窗口，沿途累计逐秒排队量，
+    并在每个所需时长处记录已通过车辆，较短时长的指标取自该前缀。
+    Returns {duration: 与 _simulate_phase_window 相同格式的指标}。
+
+    hold_past_end=True（共享前缀）：目标相位的 phaseDuration 设为最长时长 + 1 秒，所有时长（含最长的）
+    在窗口内都完整保持目标相位，每个时长的指标与一同仿真的其他时长无关。
+    hold_past_end=False（单个窗口的原始语义）：phaseDuration 设为该时长，最后一秒可能已切入下一相位；
+    只能用于一个时长。
+
+    topology: 静态拓扑索引（tl_topology.build_tl_topology），提供时不再向 SUMO 查询车道/相位 state。
+
+    topology: 静态拓扑索引（tl_topology.build_tl_topology），提供时不再向 SUMO 查询车道/相位 state。
+    """
+    traci = _sim_api()
+
+    wanted = sorted(set(max(0, int(d)) for d in durations))
+    if not hold_past_end and len(wanted) > 1:
+        raise ValueError("hold_past_end=False 只支持单个时长")
+    out: Dict[int, Dict[str, float]] = {}
+    lanes = _get_phase_incoming_lanes(simulator, tl_id, phase_id, topology)
+    all_lanes = _get_all_incoming_lanes(simulator, tl_id, topology) or lanes
     vehicles_before = set()
-    for ln in lanes:
-        try:
-            vehicles_before.update(traci.lane.getLastStepVehicleIDs(ln))
-        except Exception:
-            pass
+    with _stage("lane_poll"):
+        for ln in lanes:
+            try:
+                vehicles_before.update(traci.lane.getLastStepVehicleIDs(ln))
+            except Exception:
+                pass
 
-    if duration <= 0:
-        return {
+    if wanted and wanted[0] <= 0:
+        out[0] = {
             "passed_total": 0.0,
             "avg_passed_veh": 0.0,
             "avg_queue_veh": 0.0,
             "non_green_phase": False,
             "duration_zero": True,
         }
+        wanted = wanted[1:]
+    if not wanted:
+        return out
 
     # 防御性检查：确保目标相位是绿灯相位
-    phase_info = simulator.get_phase_info(tl_id)
-    phase_states = phase_info.get('phase_states', [])
+    if topology is not None:
+        phase_states = topology.get('phase_states', [])
+    else:
+        phase_states = simulator.get_phase_info(tl_id).get('phase_states', [])
     target_idx = max(0, int(phase_id) - 1)
     if target_idx < len(phase_states):
         target_state = phase_states[target_idx]
         if not (("G" in target_state) or ("g" in target_state)):
             # 非绿灯相位，返回零 reward
-            return {
-                "passed_total": 0.0,
-                "avg_passed_veh": 0.0,
-                "avg_queue_veh": 0.0,
-                "non_green_phase": True,
-                "duration_zero": False,
-            }
+            for d in wanted:
+                out[d] = {
+                    "passed_total": 0.0,
+                    "avg_passed_veh": 0.0,
+                    "avg_queue_veh": 0.0,
+                    "non_green_phase": True,
+                    "duration_zero": False,
+                }
+            return out
 
+    longest = wanted[-1]
+    wanted_set = set(wanted)
     traci.trafficlight.setPhase(tl_id, target_idx)
-    traci.trafficlight.setPhaseDuration(tl_id, duration)
+    traci.trafficlight.setPhaseDuration(tl_id, longest + 1 if hold_past_end else longest)
 
     total_queue = 0.0
-    for _ in range(duration):
-        traci.simulationStep()
-        q = 0.0
-        for ln in all_lanes:
-            try:
-                q += traci.lane.getLastStepHaltingNumber(ln)
-            except Exception:
-                pass
-        total_queue += q
+    watch = _LaneWatch(traci, all_lanes, lanes)
+    try:
+        for t in range(1, longest + 1):
+            watch.step()
+            total_queue += watch.halting_total()
 
-    vehicles_after = set()
-    for ln in lanes:
-        try:
-            vehicles_after.update(traci.lane.getLastStepVehicleIDs(ln))
-        except Exception:
-            pass
+            if t not in wanted_set:
+                continue
+            vehicles_after = watch.vehicle_ids()
+            passed_total = float(len(vehicles_before - vehicles_after))
+            out[t] = {
+                "passed_total": passed_total,
+                "avg_passed_veh": passed_total / max(1, t),  # 平均通过车辆数
+                "avg_queue_veh": float(total_queue / max(1, t)),
+                "non_green_phase": False,
+                "duration_zero": False,
+            }
+    finally:
+        watch.close()
+    return out
+
+
+# ==================== 批次共享解析（sim / format / constraint 共用） ====================
+def _completion_text(completion: Any) -> str:
+    """conversational completion 取最后一条消息的 content，否则转为字符串"""
+    if isinstance(completion, list) and len(completion) > 0 and isinstance(completion[-1], dict):
+        return completion[-1].get("content", "")
+    return str(completion)
+
+
+class _RewardBatch:
+    """
+    一个生成批次的共享解析结果。GRPOTrainer 对同一批依次调用 reward_funcs 中的各函数，传入同一组 prompts /
+    completions 对象；completion 文本、sample_idx、parse_output 结果、prompt 兜底字段和仿真上下文只计算一次（按需）。
+    """
+
+    def __init__(self, prompts: List[Any], completions: List[Any], kwargs: Dict[str, Any]):
+        self.prompts = prompts
+        self.completions = completions
+        self.kwargs = kwargs
+        self.texts = [_completion_text(c) for c in completions]
+        # 优先使用 kwargs 中的 num_generations；否则用 prompts 长度推断
+        num_generations = kwargs.get("num_generations")
+        if not num_generations:
+            num_generations = len(self.texts) // max(1, len(prompts))
+        self.num_generations = max(1, int(num_generations))
+        self.task_types = kwargs.get("task_type", [])
+        # dataset 列是否按 completion 展开（否则按 prompt 给出，每 num_generations 个 completion 一行）
+        column = kwargs.get("task_type") or kwargs.get("state_path") or []
+        self.expanded = len(column) == len(self.texts)
+        self._parsed: List[Union[tuple, None]] = [None] * len(self.texts)
+        self._prompt_values: Dict[tuple, Any] = {}
+        self._sim_contexts: Dict[int, Union[Dict[str, Any], None]] = {}
+
+    def sample_idx(self, i: int) -> int:
+        return i if self.expanded else i // self.num_generations
+
+    def task_type(self, i: int) -> Union[str, None]:
+        sample_idx = self.sample_idx(i)
+        return self.task_types[sample_idx] if (self.task_types and sample_idx < len(self.task_types)) else None
+
+    def parsed(self, i: int) -> tuple:
+        """parse_output(completion_i, task_type) -> (action, reason)"""
+        if self._parsed[i] is None:
+            self._parsed[i] = parse_output(self.texts[i], str(self.task_type(i)), debug=False)
+        return self._parsed[i]
+
+    def prompt_value(self, sample_idx: int, name: str) -> Any:
+        """从样本 prompt 提取的兜底字段（见 _prompt_metadata）；prompt 不是消息列表时为 None"""
+        key = (sample_idx, name)
+        if key not in self._prompt_values:
+            messages = self.prompts[sample_idx] if sample_idx < len(self.prompts) else None
+            self._prompt_values[key] = _prompt_metadata(messages)[name] if isinstance(messages, list) else None
+        return self._prompt_values[key]
+
+    def sim_context(self, sample_idx: int) -> Union[Dict[str, Any], None]:
+        if sample_idx not in self._sim_contexts:
+            self._sim_contexts[sample_idx] = _sim_sample_context(
+                self.prompts, self.kwargs, sample_idx, extract=lambda name: self.prompt_value(sample_idx, name)
+            )
+        return self._sim_contexts[sample_idx]
 
-    passed_total = float(len(vehicles_before - vehicles_after))
-    avg_passed_veh = passed_total / max(1, duration)  # 平均通过车辆数
-    avg_queue = float(total_queue / max(1, duration))
-    return {
-        "passed_total": passed_total,
-        "avg_passed_veh": avg_passed_veh,
-        "avg_queue_veh": avg_queue,
-        "non_green_phase": False,
-        "duration_zero": False,
-    }
+
+# 最近一批的共享解析；持有 completions 的引用，身份比较不会因对象回收而误命中
+_LAST_REWARD_BATCH: Union[_RewardBatch, None] = None
+
+
+def _reward_batch(prompts: List[Any], completions: List[Any], kwargs: Dict[str, Any]) -> _RewardBatch:
+    """同一 (prompts, completions) 对象的调用复用同一个 _RewardBatch（reward_batch_context=False 时每次新建）"""
+    global _LAST_REWARD_BATCH
+    batch = _LAST_REWARD_BATCH
+    if (
+        REWARD_CONFIG.get("reward_batch_context", True)
+        and batch is not None
+        and batch.completions is completions
+        and batch.prompts is prompts
+        and len(batch.texts) == len(completions)
+    ):
+        return batch
+    batch = _RewardBatch(prompts, completions, kwargs)
+    _LAST_REWARD_BATCH = batch if REWARD_CONFIG.get("reward_batch_context", True) else None
+    return batch
 
 
 # ==================== Multi-Reward Functions (GRPOTrainer reward_funcs=[...]) ====================
@@ -1139,23 +2905,10 @@ def tsc_reward_format_fn(
     valid_reward = float(REWARD_CONFIG.get("format_reward_valid", 0.0))
     invalid_reward = float(REWARD_CONFIG.get("format_reward_invalid", -1.0))
 
-    task_types = kwargs.get("task_type", [])
-
-    completion_texts: List[str] = []
-    for c in completions:
-        if isinstance(c, list) and len(c) > 0 and isinstance(c[-1], dict):
-            completion_texts.append(c[-1].get("content", ""))
-        else:
-            completion_texts.append(str(c))
-
-    # 优先使用 kwargs 中的 num_generations；否则用 prompts 长度推断
-    num_generations = kwargs.get('num_generations')
-    if not num_generations:
-        num_generations = len(completion_texts) // max(1, len(prompts))
-    num_generations = max(1, int(num_generations))
-    
-    # 检测 task_types 是否按 completion 展开
-    task_types_expanded = (len(task_types) == len(completion_texts))
+    batch = _reward_batch(prompts, completions, kwargs)
+    task_types = batch.task_types
+    completion_texts = batch.texts
+    num_generations = batch.num_generations
 
     trainer_state = kwargs.get("trainer_state", None)
     global_step = getattr(trainer_state, "global_step", None)
@@ -1181,7 +2934,7 @@ def tsc_reward_format_fn(
                 if task_type != "extend_decision":
                     continue
                 # Quick parse to check extend value
-                parsed = _parse_extend_decision_output(ct, debug=False)
+                parsed, _reason = batch.parsed(idx)
                 if parsed:
                     if parsed.get("extend") == "是":
                         if len(extend_yes_samples) < 2:
@@ -1216,12 +2969,9 @@ def tsc_reward_format_fn(
     rewards: List[float] = []
     reasons: List[str] = []
 
-    for i, completion_text in enumerate(completion_texts):
-        sample_idx = i if task_types_expanded else (i // max(1, num_generations))
-        task_type = task_types[sample_idx] if (task_types and sample_idx < len(task_types)) else None
-
+    for i in range(len(completion_texts)):
         # PURE FORMAT CHECK: only parse output, do not validate constraints
-        action, reason = parse_output(completion_text, str(task_type), debug=False)
+        action, reason = batch.parsed(i)
         if not action:
             rewards.append(invalid_reward)
             reasons.append(reason)
@@ -1233,8 +2983,7 @@ def tsc_reward_format_fn(
     try:
         _REWARD_DIAG["window_total"] += len(rewards)
         for i, (r, reason) in enumerate(zip(rewards, reasons)):
-            sample_idx = i if task_types_expanded else (i // max(1, num_generations))
-            task_type = task_types[sample_idx] if (task_types and sample_idx < len(task_types)) else "unknown"
+            task_type = batch.task_type(i) or "unknown"
             _REWARD_DIAG["window_total_by_task"][task_type] += 1
             if float(r) == invalid_reward:
                 _REWARD_DIAG["window_invalid"] += 1
@@ -1283,24 +3032,12 @@ def tsc_reward_constraint_fn(
     - For signal_step: return 0 (no constraints to check in this function)
     - Parse failure: return 0 (format_fn handles this)
     """
-    task_types = kwargs.get("task_type", [])
+    batch = _reward_batch(prompts, completions, kwargs)
     phase_limits_list = kwargs.get("phase_limits", [])
     wait_times = kwargs.get("wait_time_for_phase_change", [])
     elapsed_list = kwargs.get("current_phase_elapsed_sec", [])
-
-    completion_texts: List[str] = []
-    for c in completions:
-        if isinstance(c, list) and len(c) > 0 and isinstance(c[-1], dict):
-            completion_texts.append(c[-1].get("content", ""))
-        else:
-            completion_texts.append(str(c))
-
-    num_generations = kwargs.get('num_generations')
-    if not num_generations:
-        num_generations = len(completion_texts) // max(1, len(prompts))
-    num_generations = max(1, int(num_generations))
-    
-    task_types_expanded = (len(task_types) == len(completion_texts))
+    current_phase_ids = kwargs.get("current_phase_id", [])
+    max_extend_secs = kwargs.get("max_extend_sec", [])
 
     valid_reward = float(REWARD_CONFIG.get("constraint_reward_extend_valid", 0.1))
     no_extend_reward = float(REWARD_CONFIG.get("constraint_reward_extend_no", 0.0))
@@ -1312,9 +3049,9 @@ def tsc_reward_constraint_fn(
 
     rewards: List[float] = []
 
-    for i, completion_text in enumerate(completion_texts):
-        sample_idx = i if task_types_expanded else (i // max(1, num_generations))
-        task_type = task_types[sample_idx] if (task_types and sample_idx < len(task_types)) else None
+    for i in range(len(batch.texts)):
+        sample_idx = batch.sample_idx(i)
+        task_type = batch.task_type(i)
 
         # Only extend_decision needs constraint checking
         if str(task_type) != "extend_decision":
@@ -1322,7 +3059,7 @@ def tsc_reward_constraint_fn(
             continue
 
         # Parse the output
-        action, _reason = parse_output(completion_text, str(task_type), debug=False)
+        action, _reason = batch.parsed(i)
         if not action:
             rewards.append(0.0)  # format_fn handles parse errors
             continue
@@ -1346,7 +3083,6 @@ def tsc_reward_constraint_fn(
             continue
 
         # Extract context from prompt for constraint validation
-        prompt_messages = prompts[sample_idx] if sample_idx < len(prompts) else None
         phase_limits = phase_limits_list[sample_idx] if phase_limits_list and sample_idx < len(phase_limits_list) else None
         if wait_times and sample_idx < len(wait_times):
             wait_time_raw = wait_times[sample_idx]
@@ -1355,17 +3091,19 @@ def tsc_reward_constraint_fn(
             wait_time = 0
         elapsed = int(elapsed_list[sample_idx]) if elapsed_list and sample_idx < len(elapsed_list) else None
 
-        current_phase_id = None
-        max_extend_sec = None
-        if isinstance(prompt_messages, list):
-            current_phase_id = _extract_current_phase_id_from_prompt(prompt_messages)
-            if not phase_limits:
-                phase_limits = _extract_phase_limits_from_prompt(prompt_messages)
-            if not wait_time:
-                extracted_wait = _extract_wait_time_from_prompt(prompt_messages)
-                if extracted_wait is not None:
-                    wait_time = int(extracted_wait)
-            max_extend_sec = _extract_max_extend_sec_from_prompt(prompt_messages)
+        # dataset 列优先，旧 dataset 从 prompt 提取
+        current_phase_id = _column_value(current_phase_ids, sample_idx)
+        if current_phase_id is None:
+            current_phase_id = batch.prompt_value(sample_idx, "current_phase_id")
+        if not phase_limits:
+            phase_limits = batch.prompt_value(sample_idx, "phase_limits")
+        if not wait_time:
+            extracted_wait = batch.prompt_value(sample_idx, "wait_time")
+            if extracted_wait is not None:
+                wait_time = int(extracted_wait)
+        max_extend_sec = _column_value(max_extend_secs, sample_idx)
+        if max_extend_sec is None:
+            max_extend_sec = batch.prompt_value(sample_idx, "max_extend_sec")
 
         # Check max_extend_sec constraint
         if max_extend_sec is not None and extend_sec > max_extend_sec:
@@ -1374,145 +3112,565 @@ def tsc_reward_constraint_fn(
             rewards.append(-penalty)
             continue
 
-        # Check phase_limits bounds
-        if phase_limits and current_phase_id is not None and elapsed is not None:
-            limits = phase_limits.get(str(int(current_phase_id)), None) if isinstance(phase_limits, dict) else None
-            if limits:
-                min_green = int(limits.get("min_green", 0))
-                max_green = int(limits.get("max_green", 120))
-                final_green = int(elapsed) + extend_sec + int(wait_time)
-                
-                if final_green > max_green:
-                    exceed = final_green - max_green
-                    penalty = penalty_oob_base + penalty_oob_per_sec * exceed
-                    rewards.append(-penalty)
-                    continue
-                elif final_green < min_green:
-                    deficit = min_green - final_green
-                    penalty = penalty_oob_base + penalty_oob_per_sec * deficit
-                    rewards.append(-penalty)
-                    continue
+        # Check phase_limits bounds
+        if phase_limits and current_phase_id is not None and elapsed is not None:
+            limits = phase_limits.get(str(int(current_phase_id)), None) if isinstance(phase_limits, dict) else None
+            if limits:
+                min_green = int(limits.get("min_green", 0))
+                max_green = int(limits.get("max_green", 120))
+                final_green = int(elapsed) + extend_sec + int(wait_time)
+                
+                if final_green > max_green:
+                    exceed = final_green - max_green
+                    penalty = penalty_oob_base + penalty_oob_per_sec * exceed
+                    rewards.append(-penalty)
+                    continue
+                elif final_green < min_green:
+                    deficit = min_green - final_green
+                    penalty = penalty_oob_base + penalty_oob_per_sec * deficit
+                    rewards.append(-penalty)
+                    continue
+
+        # All constraints satisfied → positive reward
+        rewards.append(valid_reward)
+
+    return rewards
+
+
+def _unpack_valid_action_task(args: tuple) -> tuple:
+    """
+    统一 sim 任务元组格式：兼容 13~16 元组（max_extend_sec / port / tl_topology 可选），返回 16 元组。
+    """
+    return tuple(args) + (None,) * (16 - len(args))
+
+
+def _rollout_record(out: Dict[str, Any]) -> Dict[str, Any]:
+    """把 score_* 的输出压缩为可缓存的 rollout 记录（原始指标 + 有效性），不含 reward"""
+    sim_metrics = out.get("sim_metrics")
+    if sim_metrics is None:
+        return {"valid": False, "reason": str(out["reason"])}
+    return {
+        "valid": True,
+        "passed_total": float(sim_metrics["passed_total"]),
+        "avg_passed_veh": float(sim_metrics["avg_passed_veh"]),
+        "avg_queue_veh": float(sim_metrics["avg_queue_veh"]),
+        "non_green_phase": bool(sim_metrics.get("non_green_phase", False)),
+        "duration_zero": bool(sim_metrics.get("duration_zero", False)),
+    }
+
+
+def _score_valid_action(simulator: SUMOSimulator, args: tuple) -> tuple[float, str, Union[Dict[str, Any], None]]:
+    """
+    在已恢复 state 的 simulator 上对单个已校验动作打分。
+    Returns (sim_reward, reason, rollout_record)；rollout_record 为 None 表示不可缓存。
+    """
+    (
+        task_type,
+        action,
+        _state_path,
+        _scenario,
+        tl_id,
+        _sumocfg,
+        phase_ids,
+        decision_lead_sec,
+        decision_remaining_sec,
+        wait_time,
+        phase_limits,
+        current_elapsed_sec,
+        tls_phase_durations,
+        max_extend_sec,
+        _port,
+        tl_topology,
+    ) = _unpack_valid_action_task(args)
+    topology = _resolve_tl_topology(simulator, _sumocfg, tl_id, tl_topology)
+
+    if task_type == "signal_step":
+        out = score_signal_step(
+            simulator,
+            tl_id,
+            action,
+            phase_ids=phase_ids,
+            decision_lead_sec=int(decision_lead_sec),
+            decision_remaining_sec=decision_remaining_sec,
+            tls_phase_durations=tls_phase_durations,
+            topology=topology,
+        )
+        return float(out["reward"]), str(out["reason"]), _rollout_record(out)
+
+    if task_type == "extend_decision":
+        out = score_extend_decision(
+            simulator,
+            tl_id,
+            action,
+            phase_limits=phase_limits,
+            wait_time_for_phase_change=int(wait_time or 0),
+            current_elapsed_sec=current_elapsed_sec,
+            tls_phase_durations=tls_phase_durations,
+            max_extend_sec=max_extend_sec,
+            topology=topology,
+            shared_window=_extend_window_mode() == "shared",
+        )
+        return float(out["reward"]), str(out["reason"]), _rollout_record(out)
+
+    return 0.0, "unsupported_task_type", None
+
+
+def _score_action_variants(simulator: SUMOSimulator, tasks: List[tuple], branch: str = "loadstate") -> List[tuple]:
+    """
+    同一 state/上下文的多个动作共用一次仿真前缀：
+    extend_decision 只跑最长窗口（score_extend_decision_variants），
+    signal_step 只跑一次决策前推进并从快照分支（score_signal_step_variants）。
+    Returns [(sim_reward, reason, rollout_record), ...]。
+    """
+    first = _unpack_valid_action_task(tasks[0])
+    topology = _resolve_tl_topology(simulator, first[5], first[4], first[15])
+    if first[0] == "signal_step":
+        outs = score_signal_step_variants(
+            simulator,
+            first[4],
+            [t[1] for t in tasks],
+            phase_ids=first[6],
+            decision_lead_sec=int(first[7]),
+            decision_remaining_sec=first[8],
+            tls_phase_durations=first[12],
+            branch=branch,
+            topology=topology,
+        )
+    else:
+        outs = score_extend_decision_variants(
+            simulator,
+            first[4],
+            [t[1] for t in tasks],
+            phase_limits=first[10],
+            wait_time_for_phase_change=int(first[9] or 0),
+            current_elapsed_sec=first[11],
+            tls_phase_durations=first[12],
+            max_extend_sec=first[13],
+            topology=topology,
+            shared_window=_extend_window_mode() == "shared",
+        )
+    return [(float(out["reward"]), str(out["reason"]), _rollout_record(out)) for out in outs]
+
+
+def _variant_batch_key(task: tuple, idx: int) -> Any:
+    """
+    组内可共用一次仿真前缀的批次 key：按除动作/port 外的全部字段；
+    对应开关关闭或不支持的任务各自成批。
+    """
+    flag = {
+        "extend_decision": "extend_prefix_sharing",
+        "signal_step": "signal_step_warm_sharing",
+    }.get(task[0])
+    if flag is None or not REWARD_CONFIG.get(flag, True):
+        return ("single", idx)
+    fields = task[:1] + task[2:14]
+    return json.dumps(fields, sort_keys=True, ensure_ascii=False, default=str)
+
+
+def _simulate_valid_action_group_worker(group: List[tuple]) -> List[tuple]:
+    """
+    Parallel worker（组模式）：一组共享同一 sumocfg/state_path 的已校验动作。
+    只获取一次 simulator，批次之间在进程内重新 loadState；
+    同一上下文的动作合并为一个批次，共用仿真前缀（见 _score_action_variants）。
+    Returns [(sim_reward, reason, rollout_record), ...]。
+    """
+    # 只在 worker 进程内 fork：训练主进程（串行回退）和线程 worker 所在进程是多线程的（CUDA、vLLM），
+    # fork 不安全，且 libsumo 每进程只有一个仿真
+    if (
+        REWARD_CONFIG.get("branching_engine", "loadstate") == "fork"
+        and _worker().is_pool_worker
+        and _fork_engine_available()
+    ):
+        return _fork_engine_group_worker(group)
+    return _run_valid_action_group(group)
+
+
+def _run_valid_action_group(group: List[tuple], branch: str = "loadstate") -> List[tuple]:
+    """在当前后端上按批次执行一组已校验动作（见 _simulate_valid_action_group_worker）"""
+    tasks = [_unpack_valid_action_task(args) for args in group]
+    keyed = [(_variant_batch_key(t, i), t) for i, t in enumerate(tasks)]
+    batches = _group_task_indices(keyed, lambda kt: kt[0])
+
+    results: List[Any] = [None] * len(tasks)
+    simulator = None
+    held_sumocfg = None
+    for batch in batches:
+        batch_tasks = [tasks[i] for i in batch]
+        task = batch_tasks[0]
+        state_path, sumocfg, port = task[2], task[5], task[14]
+        try:
+            if simulator is not None and sumocfg != held_sumocfg:
+                _release_worker_simulator(held_sumocfg, simulator)
+                simulator = None
+            if simulator is None:
+                simulator, reason = _acquire_worker_simulator(sumocfg, state_path, port)
+                held_sumocfg = sumocfg
+                if simulator is None:
+                    for i in batch:
+                        results[i] = (0.0, reason, None)
+                    continue
+            else:
+                _reload_worker_state(simulator, state_path)
+            if len(batch_tasks) > 1:
+                batch_results = _score_action_variants(simulator, batch_tasks, branch=branch)
+            else:
+                batch_results = [_score_valid_action(simulator, task)]
+            for i, r in zip(batch, batch_results):
+                results[i] = r
+        except Exception as e:
+            _release_worker_simulator(held_sumocfg, simulator, broken=True)
+            simulator = None
+            for i in batch:
+                results[i] = (0.0, f"exception:{type(e).__name__}", None)
+    _release_worker_simulator(held_sumocfg, simulator)
+    return results
+
+
+def _sim_job_profile(job: List[tuple]) -> JobProfile:
+    """调度属性：一组已校验动作的仿真秒数之和（决策前推进 + 绿灯 / 等待 + 延长）× state 规模"""
+    first = _unpack_valid_action_task(job[0])
+    window = 0.0
+    for args in job:
+        task = _unpack_valid_action_task(args)
+        action = task[1] or {}
+        if task[0] == "signal_step":
+            lead = task[8] if task[8] is not None else task[7]
+            window += float(lead or 0) + float(action.get("green_sec", 0) or 0)
+        else:
+            window += float(task[9] or 0)
+            if action.get("extend") == "是":
+                window += float(action.get("extend_sec", 0) or 0)
+    return JobProfile(str(first[5]), str(first[2]), str(first[3]), job_work(first[2], window))
+
+
+def _sim_job_labels(job: List[tuple]) -> tuple:
+    """阶段耗时的汇总键：(场景, 任务类型)"""
+    task = _unpack_valid_action_task(job[0])
+    return task[3], task[0]
+
+
+def _sim_job_failed(job: List[tuple], reason: str) -> List[tuple]:
+    """超时/异常的任务：组内每个动作记 (0.0, reason, None)，与 worker 内的失败结果一致"""
+    return [(0.0, reason, None)] * len(job)
+
+
+def _column_value(column: Union[List[Any], None], sample_idx: int) -> Any:
+    """dataset 列中第 sample_idx 行的值；列缺失或越界时 None"""
+    return column[sample_idx] if column and sample_idx < len(column) else None
+
+
+def _sim_sample_context(
+    prompts: Union[List[str], List[List[dict]]],
+    kwargs: Dict[str, Any],
+    sample_idx: int,
+    extract=None,
+) -> Union[Dict[str, Any], None]:
+    """
+    解析一个样本（prompt）的仿真上下文：dataset 列优先，缺失时从 prompt 兜底提取。
+    找不到 sumocfg 时返回 None。tsc_reward_sim_fn 与离线 reward 表预计算共用。
+    extract(name) 给出 prompt 兜底字段（见 _prompt_metadata）；None 时直接解析该样本的 prompt。
+    """
+    state_paths = kwargs.get("state_path", [])
+    scenarios = kwargs.get("scenario", [])
+    tl_ids = kwargs.get("tl_id", [])
+    task_types = kwargs.get("task_type", [])
+    phase_ids_list = kwargs.get("phase_ids", [])
+    phase_limits_list = kwargs.get("phase_limits", [])
+    decision_lead_secs = kwargs.get("decision_lead_sec", [])
+    decision_remaining_secs = kwargs.get("decision_remaining_sec", [])
+    wait_times = kwargs.get("wait_time_for_phase_change", [])
+    elapsed_list = kwargs.get("current_phase_elapsed_sec", [])
+    tls_durs_list = kwargs.get("tls_phase_durations", [])
+    sumocfg_paths = kwargs.get("sumocfg_path", [])
+    topologies = kwargs.get("tl_topology", [])
+    current_phase_ids = kwargs.get("current_phase_id", [])
+    max_extend_secs = kwargs.get("max_extend_sec", [])
+
+    task_type = task_types[sample_idx] if (task_types and sample_idx < len(task_types)) else None
+    phase_ids = phase_ids_list[sample_idx] if phase_ids_list else None
+    phase_limits = phase_limits_list[sample_idx] if phase_limits_list else None
+    if wait_times and sample_idx < len(wait_times):
+        wait_time_raw = wait_times[sample_idx]
+        wait_time = int(wait_time_raw) if wait_time_raw is not None else 0
+    else:
+        wait_time = 0
+    elapsed = int(elapsed_list[sample_idx]) if elapsed_list and sample_idx < len(elapsed_list) else None
+    tls_durs = tls_durs_list[sample_idx] if tls_durs_list and sample_idx < len(tls_durs_list) else []
+
+    current_phase_id = None
+    max_extend_sec = None
+    if str(task_type) == "extend_decision":
+        if extract is None:
+            prompt_messages = prompts[sample_idx] if sample_idx < len(prompts) else None
+            if isinstance(prompt_messages, list):
+                extract = lambda name: _prompt_metadata(prompt_messages)[name]
+            else:
+                extract = lambda name: None
+        # current_phase_id / max_extend_sec 优先用 dataset 列，旧 dataset 从 prompt 提取
+        current_phase_id = _column_value(current_phase_ids, sample_idx)
+        if current_phase_id is None:
+            current_phase_id = extract("current_phase_id")
+        # Fallback: 如果 dataset 中缺失 phase_limits，从 prompt 提取
+        if not phase_limits:
+            phase_limits = extract("phase_limits")
+        # Fallback: 如果 dataset 中缺失 wait_time，从 prompt 提取
+        if not wait_time:
+            extracted_wait = extract("wait_time")
+            if extracted_wait is not None:
+                wait_time = int(extracted_wait)
+        max_extend_sec = _column_value(max_extend_secs, sample_idx)
+        if max_extend_sec is None:
+            max_extend_sec = extract("max_extend_sec")
+
+    # Resolve sumocfg
+    if sumocfg_paths and sample_idx < len(sumocfg_paths):
+        sumocfg = sumocfg_paths[sample_idx]
+    else:
+        scenario_dir = os.path.join("sumo_simulation/environments", scenarios[sample_idx])
+        sumocfg = None
+        for f in os.listdir(scenario_dir):
+            if f.endswith(".sumocfg"):
+                sumocfg = os.path.join(scenario_dir, f)
+                break
+    if not sumocfg:
+        return None
+
+    return {
+        "state_path": state_paths[sample_idx],
+        "scenario": scenarios[sample_idx],
+        "tl_id": tl_ids[sample_idx],
+        "sumocfg": sumocfg,
+        "phase_ids": phase_ids,
+        "phase_limits": phase_limits,
+        "decision_lead_sec": decision_lead_secs[sample_idx] if decision_lead_secs else 10,
+        "decision_remaining_sec": (
+            decision_remaining_secs[sample_idx]
+            if decision_remaining_secs and sample_idx < len(decision_remaining_secs)
+            else None
+        ),
+        "wait_time": wait_time,
+        "current_elapsed_sec": elapsed,
+        "tls_phase_durations": tls_durs,
+        "current_phase_id": current_phase_id,
+        "max_extend_sec": max_extend_sec,
+        "tl_topology": topologies[sample_idx] if topologies and sample_idx < len(topologies) else None,
+    }
+
+
+def _sim_validation_kwargs(ctx: Dict[str, Any]) -> Dict[str, Any]:
+    """sim 预筛用的 validate_action 关键字参数（不含 max_extend_sec：超出部分由 constraint reward 惩罚）"""
+    return {
+        "phase_ids": ctx["phase_ids"],
+        "phase_limits": ctx["phase_limits"],
+        "current_phase_id": ctx["current_phase_id"],
+        "current_elapsed_sec": ctx["current_elapsed_sec"],
+        "wait_time_for_phase_change": ctx["wait_time"],
+    }
+
+
+def _make_validated_sim_task(ctx: Dict[str, Any], task_type: str, action: Dict[str, Any]) -> Union[tuple, None]:
+    """校验动作并构造 sim 任务元组（见 _unpack_valid_action_task）；校验不通过返回 None"""
+    ok, _v_reason, action = validate_action(task_type, action, **_sim_validation_kwargs(ctx))
+    if not ok:
+        return None
+    return _sim_task_tuple(ctx, task_type, action)
+
+
+def _make_validated_sim_tasks(items: List[tuple]) -> List[Union[tuple, None]]:
+    """_make_validated_sim_task 的批量版本：items 为 (ctx, task_type, action)，整批一次 validate_actions"""
+    checks = validate_actions(
+        [task_type for _ctx, task_type, _action in items],
+        [action for _ctx, _task_type, action in items],
+        [_sim_validation_kwargs(ctx) for ctx, _task_type, _action in items],
+    )
+    return [
+        _sim_task_tuple(ctx, task_type, action) if ok else None
+        for (ctx, task_type, _action), (ok, _v_reason, action) in zip(items, checks)
+    ]
+
+
+def _sim_task_tuple(ctx: Dict[str, Any], task_type: str, action: Dict[str, Any]) -> tuple:
+    return (
+        task_type,
+        action,
+        ctx["state_path"],
+        ctx["scenario"],
+        ctx["tl_id"],
+        ctx["sumocfg"],
+        ctx["phase_ids"],
+        ctx["decision_lead_sec"],
+        ctx["decision_remaining_sec"],
+        ctx["wait_time"],
+        ctx["phase_limits"],
+        ctx["current_elapsed_sec"],
+        ctx["tls_phase_durations"],
+        ctx["max_extend_sec"],
+        None,
+        ctx["tl_topology"],
+    )
+
+
+def action_table_key(task_type: str, action: Dict[str, Any]) -> str:
+    """归一化动作在离线 reward 表中的 key：signal_step -> "3:25"，extend_decision -> "是:4" """
+    if task_type == "signal_step":
+        return f"{int(action['next_phase_id'])}:{int(action['green_sec'])}"
+    return f"{action['extend']}:{int(action['extend_sec'])}"
+
+
+def _reward_table_candidates(task_type: str, ctx: Dict[str, Any], sweep: Dict[str, int]) -> List[Dict[str, Any]]:
+    """
+    枚举一个样本的候选动作：
+    - extend_decision：否 + 是×[0, max_extend_sec]（共 max_extend_sec + 2 个）
+    - signal_step：phase_ids × [green_min, green_max] 按 coarse_step 粗扫
+    """
+    if task_type == "extend_decision":
+        max_ext = ctx.get("max_extend_sec")
+        max_ext = int(max_ext) if max_ext is not None else 10
+        return [{"extend": "否", "extend_sec": 0}] + [
+            {"extend": "是", "extend_sec": s} for s in range(0, max_ext + 1)
+        ]
+    if task_type == "signal_step":
+        lo, hi = sweep["green_min"], sweep["green_max"]
+        green_secs = sorted(set(range(lo, hi + 1, sweep["coarse_step"])) | {hi})
+        return [
+            {"next_phase_id": int(pid), "green_sec": int(g)}
+            for pid in (ctx.get("phase_ids") or [])
+            for g in green_secs
+        ]
+    return []
+
+
+def _reward_table_sample_worker(job: tuple) -> Dict[str, Dict[str, Any]]:
+    """
+    Parallel worker（离线 reward 表）：在一个 worker 内枚举单个样本的动作空间。
+    signal_step 先粗扫，再在 reward 最高的 top_k 个 (相位, 时长) 附近逐秒细扫。
+    job 中携带扫描参数（与调用 precompute_reward_tables 时的 REWARD_CONFIG 一致）。
+    Returns {action_table_key: rollout_record}。
+    """
+    task_type, ctx, sweep = job
+    table: Dict[str, Dict[str, Any]] = {}
+    ranked: List[tuple] = []
+
+    def _run(actions: List[Dict[str, Any]]):
+        tasks = []
+        for task in _make_validated_sim_tasks([(ctx, task_type, a) for a in actions]):
+            if task is not None and action_table_key(task_type, task[1]) not in table:
+                tasks.append(task)
+        for task, (reward, _reason, record) in zip(tasks, _simulate_valid_action_group_worker(tasks)):
+            if record is None:
+                continue
+            table[action_table_key(task_type, task[1])] = record
+            ranked.append((reward, task[1]))
 
-        # All constraints satisfied → positive reward
-        rewards.append(valid_reward)
+    _run(_reward_table_candidates(task_type, ctx, sweep))
 
-    return rewards
+    top_k, step = sweep["refine_top_k"], sweep["coarse_step"]
+    if task_type == "signal_step" and top_k > 0 and step > 1:
+        lo, hi = sweep["green_min"], sweep["green_max"]
+        fine = []
+        for _reward, a in sorted(ranked, key=lambda x: x[0], reverse=True)[:top_k]:
+            g0 = int(a["green_sec"])
+            for g in range(max(lo, g0 - step + 1), min(hi, g0 + step - 1) + 1):
+                fine.append({"next_phase_id": int(a["next_phase_id"]), "green_sec": g})
+        _run(fine)
+    return table
 
 
-def _simulate_valid_action_worker(args: tuple) -> tuple[float, str]:
+def precompute_reward_tables(
+    prompts: Union[List[str], List[List[dict]]],
+    columns: Dict[str, List[Any]],
+    progress_every: int = 100,
+) -> List[Union[str, None]]:
     """
-    Parallel worker: assumes parse/format validation already passed. Returns (sim_reward, reason).
-    args tuple now includes a `port` field at the end for fixed port assignment.
+    离线枚举每个样本的动作空间并仿真，返回与样本一一对应的 reward_table（紧凑 JSON 字符串，
+    {action_table_key: rollout_record, "_meta": 仿真语义}；只存原始指标，reward 训练时按当前权重重算）。
+    无法解析上下文或不支持的任务类型返回 None。每个样本一个 pool 任务，复用 worker 常驻 SUMO。
     """
-    # 解包参数，最后一个是 port（可选）
-    if len(args) == 15:
-        (
-            task_type,
-            action,
-            state_path,
-            scenario,
-            tl_id,
-            sumocfg,
-            phase_ids,
-            decision_lead_sec,
-            decision_remaining_sec,
-            wait_time,
-            phase_limits,
-            current_elapsed_sec,
-            tls_phase_durations,
-            max_extend_sec,
-            port,
-        ) = args
-    elif len(args) == 14:
-        (
-            task_type,
-            action,
-            state_path,
-            scenario,
-            tl_id,
-            sumocfg,
-            phase_ids,
-            decision_lead_sec,
-            decision_remaining_sec,
-            wait_time,
-            phase_limits,
-            current_elapsed_sec,
-            tls_phase_durations,
-            max_extend_sec,
-        ) = args
-        port = None
+    task_types = columns.get("task_type", [])
+    sweep = {
+        "green_min": int(REWARD_CONFIG["green_sec_min"]),
+        "green_max": int(REWARD_CONFIG["green_sec_max"]),
+        "coarse_step": max(1, int(REWARD_CONFIG.get("reward_table_coarse_step", 5))),
+        "refine_top_k": int(REWARD_CONFIG.get("reward_table_refine_top_k", 0)),
+    }
+    jobs = []
+    job_indices = []
+    for i in range(len(prompts)):
+        task_type = str(task_types[i]) if i < len(task_types) else None
+        if task_type not in ("signal_step", "extend_decision"):
+            continue
+        ctx = _sim_sample_context(prompts, columns, i)
+        if ctx is None:
+            continue
+        jobs.append((task_type, ctx, sweep))
+        job_indices.append(i)
+
+    tables: List[Union[str, None]] = [None] * len(prompts)
+    pool = _ensure_mp_pool_initialized() if REWARD_CONFIG.get("parallel_workers", 0) > 0 else None
+    if pool is None:
+        results = map(_reward_table_sample_worker, jobs)
     else:
-        (
-            task_type,
-            action,
-            state_path,
-            scenario,
-            tl_id,
-            sumocfg,
-            phase_ids,
-            decision_lead_sec,
-            decision_remaining_sec,
-            wait_time,
-            phase_limits,
-            current_elapsed_sec,
-            tls_phase_durations,
-        ) = args
-        max_extend_sec = None
-        port = None
+        results = pool.imap(_reward_table_sample_worker, jobs, chunksize=1)
 
-    try:
-        if port is None:
-            port = _get_worker_port()
-        simulator = SUMOSimulator(
-            config_file=sumocfg,
-            junctions_file=None,
-            gui=False,
-            additional_options=["--device.rerouting.probability", "0"],
-            verbose=False,
-            port=port,  # 使用分配的固定端口
-        )
-        if not simulator.start_simulation():
-            return 0.0, "start_simulation_failed"
-        if not os.path.exists(state_path):
-            simulator.close()
-            return 0.0, "state_path_missing"
-        simulator.restore_simulation_state(state_path)
+    meta = _reward_table_meta()
+    for n, (i, table) in enumerate(zip(job_indices, results), 1):
+        table[_REWARD_TABLE_META_KEY] = meta
+        tables[i] = json.dumps(table, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+        if progress_every and n % int(progress_every) == 0:
+            print(f"[precompute_reward_tables] {n}/{len(jobs)}")
+    return tables
 
-        if task_type == "signal_step":
-            out = score_signal_step(
-                simulator,
-                tl_id,
-                action,
-                phase_ids=phase_ids,
-                decision_lead_sec=int(decision_lead_sec),
-                decision_remaining_sec=decision_remaining_sec,
-                tls_phase_durations=tls_phase_durations,
-            )
-            simulator.close()
-            return float(out["reward"]), str(out["reason"])
 
-        if task_type == "extend_decision":
-            out = score_extend_decision(
-                simulator,
-                tl_id,
-                action,
-                phase_limits=phase_limits,
-                wait_time_for_phase_change=int(wait_time or 0),
-                current_elapsed_sec=current_elapsed_sec,
-                tls_phase_durations=tls_phase_durations,
-                max_extend_sec=max_extend_sec,
+# reward 表中记录仿真语义的保留 key（动作 key 形如 "3:25" / "是:4"，不会冲突）
+_REWARD_TABLE_META_KEY = "_meta"
+_STALE_REWARD_TABLE_WARNED = False
+
+
+def _reward_table_meta() -> Dict[str, Any]:
+    """当前代码的仿真语义：与表中 _meta 不同（或旧表没有 _meta）时整表不用"""
+    return {"schema": ROLLOUT_CACHE_SCHEMA, "extend_window": _extend_window_mode()}
+
+
+def _load_reward_table(text: Any) -> Union[Dict[str, Any], None]:
+    """解析一个样本的 reward_table 列；为空、无法解析或仿真语义与当前不一致时 None（全部走在线仿真）"""
+    global _STALE_REWARD_TABLE_WARNED
+    if not text:
+        return None
+    try:
+        table = json.loads(text)
+    except Exception:
+        return None
+    if not isinstance(table, dict):
+        return None
+    if table.get(_REWARD_TABLE_META_KEY) != _reward_table_meta():
+        if not _STALE_REWARD_TABLE_WARNED:
+            _STALE_REWARD_TABLE_WARNED = True
+            print(
+                f"[tsc_reward_sim_fn] reward_table 的仿真语义 {table.get(_REWARD_TABLE_META_KEY)} 与当前 "
+                f"{_reward_table_meta()} 不一致，忽略该表（请重新运行 precompute_reward_table.py）"
             )
-            simulator.close()
-            return float(out["reward"]), str(out["reason"])
+        return None
+    return table
+
+
+def _lookup_reward_table(table: Any, task_type: str, action: Dict[str, Any]) -> Union[Dict[str, Any], None]:
+    """在样本已解析的 reward_table 中查找已归一化动作的 rollout 记录；未命中返回 None"""
+    if not isinstance(table, dict):
+        return None
+    return table.get(action_table_key(task_type, action))
 
-        simulator.close()
-        return 0.0, "unsupported_task_type"
-    except Exception as e:
-        try:
-            simulator.close()
-        except Exception:
-            pass
-        return 0.0, f"exception:{type(e).__name__}"
+
+def _clip_sim_reward(r: float) -> float:
+    clip_min = float(REWARD_CONFIG.get("sim_reward_clip_min", -1.0))
+    clip_max = float(REWARD_CONFIG.get("sim_reward_clip_max", 1.0))
+    rr = float(r)
+    if rr != rr:  # NaN guard
+        rr = 0.0
+    if rr < clip_min:
+        rr = clip_min
+    elif rr > clip_max:
+        rr = clip_max
+    return rr
 
 
 def tsc_reward_sim_fn(
@@ -1525,348 +3683,320 @@ def tsc_reward_sim_fn(
     Simulation reward: run SUMO roll-forward for valid actions, otherwise 0.
     """
     state_paths = kwargs.get("state_path", [])
-    scenarios = kwargs.get("scenario", [])
-    tl_ids = kwargs.get("tl_id", [])
-    task_types = kwargs.get("task_type", [])
-    phase_ids_list = kwargs.get("phase_ids", [])
-    phase_limits_list = kwargs.get("phase_limits", [])
-    decision_lead_secs = kwargs.get("decision_lead_sec", [])
-    decision_remaining_secs = kwargs.get("decision_remaining_sec", [])
-    wait_times = kwargs.get("wait_time_for_phase_change", [])
-    elapsed_list = kwargs.get("current_phase_elapsed_sec", [])
-    tls_durs_list = kwargs.get("tls_phase_durations", [])
-    sumocfg_paths = kwargs.get("sumocfg_path", [])
+    reward_tables = kwargs.get("reward_table", [])
 
     if not state_paths:
         raise ValueError("tsc_reward_sim_fn 需要 state_path 字段")
 
-    completion_texts: List[str] = []
-    for c in completions:
-        if isinstance(c, list) and len(c) > 0 and isinstance(c[-1], dict):
-            completion_texts.append(c[-1].get("content", ""))
-        else:
-            completion_texts.append(str(c))
-
-    # 优先使用 kwargs 中的 num_generations；否则用 prompts 长度推断
-    num_generations = kwargs.get('num_generations')
-    if not num_generations:
-        num_generations = len(completion_texts) // max(1, len(prompts))
-    num_generations = max(1, int(num_generations))
-    
-    # 检测 state_paths 是否按 completion 展开
-    state_paths_expanded = (len(state_paths) == len(completion_texts))
-    sim_rewards = [0.0] * len(completion_texts)
+    batch = _reward_batch(prompts, completions, kwargs)
+    sim_rewards = [0.0] * len(batch.texts)
 
     tasks = []
     task_indices = []
+    tables: Dict[int, Any] = {}
+    use_table = bool(REWARD_CONFIG.get("use_reward_table", True)) and bool(reward_tables)
+    table_hits = 0
 
-    for i, completion_text in enumerate(completion_texts):
-        sample_idx = i if state_paths_expanded else (i // max(1, num_generations))
-        task_type = task_types[sample_idx] if (task_types and sample_idx < len(task_types)) else None
+    candidates = []
+    for i in range(len(batch.texts)):
+        sample_idx = batch.sample_idx(i)
+        task_type = batch.task_type(i)
 
-        action, _reason = parse_output(completion_text, str(task_type), debug=False)
+        action, _reason = batch.parsed(i)
         if not action:
             continue
 
-        phase_ids = phase_ids_list[sample_idx] if phase_ids_list else None
-        phase_limits = phase_limits_list[sample_idx] if phase_limits_list else None
-        if wait_times and sample_idx < len(wait_times):
-            wait_time_raw = wait_times[sample_idx]
-            wait_time = int(wait_time_raw) if wait_time_raw is not None else 0
-        else:
-            wait_time = 0
-        elapsed = int(elapsed_list[sample_idx]) if elapsed_list and sample_idx < len(elapsed_list) else None
-        tls_durs = tls_durs_list[sample_idx] if tls_durs_list and sample_idx < len(tls_durs_list) else []
-
-        current_phase_id = None
-        if str(task_type) == "extend_decision":
-            prompt_messages = prompts[sample_idx] if sample_idx < len(prompts) else None
-            if isinstance(prompt_messages, list):
-                current_phase_id = _extract_current_phase_id_from_prompt(prompt_messages)
-                # Fallback: 如果 dataset 中缺失 phase_limits，从 prompt 提取
-                if not phase_limits:
-                    phase_limits = _extract_phase_limits_from_prompt(prompt_messages)
-                # Fallback: 如果 dataset 中缺失 wait_time，从 prompt 提取
-                if not wait_time:
-                    extracted_wait = _extract_wait_time_from_prompt(prompt_messages)
-                    if extracted_wait is not None:
-                        wait_time = int(extracted_wait)
-                # 提取 max_extend_sec
-                max_extend_sec = _extract_max_extend_sec_from_prompt(prompt_messages)
-            else:
-                max_extend_sec = None
-        else:
-            max_extend_sec = None
-
-        ok, _v_reason, action = validate_action(
-            str(task_type),
-            action,
-            phase_ids=phase_ids,
-            phase_limits=phase_limits,
-            current_phase_id=current_phase_id,
-            current_elapsed_sec=elapsed,
-            wait_time_for_phase_change=wait_time,
-        )
-        if not ok:
+        # 同一 prompt 的上下文只解析一次（与 format / constraint 共用）
+        ctx = batch.sim_context(sample_idx)
+        if ctx is None:
             continue
+        candidates.append((i, sample_idx, (ctx, str(task_type), action)))
 
-        # Resolve sumocfg
-        if sumocfg_paths and sample_idx < len(sumocfg_paths):
-            sumocfg = sumocfg_paths[sample_idx]
-        else:
-            scenario_dir = os.path.join("sumo_simulation/environments", scenarios[sample_idx])
-            sumocfg = None
-            for f in os.listdir(scenario_dir):
-                if f.endswith(".sumocfg"):
-                    sumocfg = os.path.join(scenario_dir, f)
-                    break
-        if not sumocfg:
+    # 整批校验，不通过的动作不进入仿真
+    validated = _make_validated_sim_tasks([item for _i, _sample_idx, item in candidates])
+    for (i, sample_idx, (_ctx, task_type, _action)), task in zip(candidates, validated):
+        if task is None:
             continue
 
-        tasks.append(
-            (
-                str(task_type),
-                action,
-                state_paths[sample_idx],
-                scenarios[sample_idx],
-                tl_ids[sample_idx],
-                sumocfg,
-                phase_ids,
-                decision_lead_secs[sample_idx] if decision_lead_secs else 10,
-                decision_remaining_secs[sample_idx] if decision_remaining_secs and sample_idx < len(decision_remaining_secs) else None,
-                wait_time,
-                phase_limits,
-                elapsed,
-                tls_durs,
-                max_extend_sec,
-            )
-        )
+        # 离线 reward 表：命中时直接由预计算指标重算 reward，不进入仿真
+        if use_table and sample_idx < len(reward_tables):
+            if sample_idx not in tables:
+                tables[sample_idx] = _load_reward_table(reward_tables[sample_idx])
+            record = _lookup_reward_table(tables[sample_idx], str(task_type), task[1])
+            if record is not None:
+                reward, _reason = _reward_from_rollout_record(str(task_type), record)
+                sim_rewards[i] = _clip_sim_reward(reward)
+                table_hits += 1
+                continue
+
+        tasks.append(task)
         task_indices.append(i)
 
+    if table_hits:
+        _REWARD_DIAG["window_table_hits"] = int(_REWARD_DIAG.get("window_table_hits", 0)) + table_hits
     if not tasks:
         return sim_rewards
 
-    if REWARD_CONFIG.get("parallel_workers", 0) > 0 and len(tasks) > 1:
+    # 批内去重：相同动作只仿真一次，结果回填给所有重复项
+    if REWARD_CONFIG.get("dedup_sim_actions", True):
+        dup_groups = _group_task_indices(tasks, _sim_task_dedup_key)
+    else:
+        dup_groups = [[i] for i in range(len(tasks))]
+    unique_tasks = [tasks[idxs[0]] for idxs in dup_groups]
+    _REWARD_DIAG["window_sim_tasks"] = int(_REWARD_DIAG.get("window_sim_tasks", 0)) + len(tasks)
+    _REWARD_DIAG["window_sim_unique_tasks"] = int(_REWARD_DIAG.get("window_sim_unique_tasks", 0)) + len(unique_tasks)
+
+    # 跨 epoch 缓存：命中的任务直接由缓存指标按当前权重重算 reward
+    unique_results: List[Any] = [None] * len(unique_tasks)
+    cache_keys: List[Union[str, None]] = [None] * len(unique_tasks)
+    cache = _get_rollout_cache()
+    if cache is not None:
+        cache_keys = [_rollout_cache_key(t) for t in unique_tasks]
+        try:
+            cached = cache.get_many([k for k in cache_keys if k])
+        except Exception as e:
+            print(f"[tsc_reward_sim_fn] rollout 缓存读取失败: {e}")
+            cached = {}
+        for j, key in enumerate(cache_keys):
+            record = cached.get(key) if key else None
+            if record is not None:
+                reward, reason = _reward_from_rollout_record(unique_tasks[j][0], record)
+                unique_results[j] = (reward, reason, record)
+        hits = sum(1 for r in unique_results if r is not None)
+        _REWARD_DIAG["window_cache_hits"] = int(_REWARD_DIAG.get("window_cache_hits", 0)) + hits
+        _REWARD_DIAG["window_cache_misses"] = int(_REWARD_DIAG.get("window_cache_misses", 0)) + len(unique_tasks) - hits
+    pending = [j for j, r in enumerate(unique_results) if r is None]
+    pending_tasks = [unique_tasks[j] for j in pending]
+
+    # group 模式：同一 (sumocfg, state_path) 的动作合并为一个任务，worker 内复用已加载的 state
+    if str(REWARD_CONFIG.get("reward_dispatch_mode", "completion")) == "group":
+        groups = _group_task_indices(pending_tasks, lambda t: (t[5], t[2]))
+    else:
+        groups = [[i] for i in range(len(pending_tasks))]
+    jobs = [[pending_tasks[i] for i in idxs] for idxs in groups]
+
+    if REWARD_CONFIG.get("parallel_workers", 0) > 0 and len(jobs) > 1:
         pool = _ensure_mp_pool_initialized()
         if pool is None:
-            results = list(map(_simulate_valid_action_worker, tasks))
+            grouped_results = _map_reward_jobs(_simulate_valid_action_group_worker, jobs, _sim_job_labels)
         else:
             try:
-                results = pool.map(_simulate_valid_action_worker, tasks, chunksize=1)
+                grouped_results = _dispatch_reward_jobs(
+                    pool, _simulate_valid_action_group_worker, jobs, _sim_job_profile, _sim_job_failed, _sim_job_labels
+                )
+                _record_pool_step(pool, kwargs)
             except Exception as e:
                 print(f"[tsc_reward_sim_fn] 并行执行失败，回退到串行: {e}")
-                results = list(map(_simulate_valid_action_worker, tasks))
+                grouped_results = _map_reward_jobs(_simulate_valid_action_group_worker, jobs, _sim_job_labels)
     else:
-        results = list(map(_simulate_valid_action_worker, tasks))
-
-    for idx, (r, _reason) in zip(task_indices, results):
-        clip_min = float(REWARD_CONFIG.get("sim_reward_clip_min", -1.0))
-        clip_max = float(REWARD_CONFIG.get("sim_reward_clip_max", 1.0))
-        rr = float(r)
-        if rr != rr:  # NaN guard
-            rr = 0.0
-        if rr < clip_min:
-            rr = clip_min
-        elif rr > clip_max:
-            rr = clip_max
-        sim_rewards[idx] = rr
+        grouped_results = _map_reward_jobs(_simulate_valid_action_group_worker, jobs, _sim_job_labels)
+
+    new_entries = []
+    for j, res in zip(pending, _scatter_group_results(groups, grouped_results, len(pending_tasks))):
+        unique_results[j] = res
+        if cache_keys[j] and res[2] is not None:
+            new_entries.append((cache_keys[j], res[2]))
+    if cache is not None and new_entries:
+        try:
+            cache.put_many(new_entries)
+        except Exception as e:
+            print(f"[tsc_reward_sim_fn] rollout 缓存写入失败: {e}")
+
+    results = _scatter_group_results(
+        dup_groups,
+        [[r] * len(idxs) for idxs, r in zip(dup_groups, unique_results)],
+        len(tasks),
+    )
+
+    for idx, (r, _reason, _record) in zip(task_indices, results):
+        sim_rewards[idx] = _clip_sim_reward(r)
 
     return sim_rewards
 
 
 # ==================== 并行 Worker 函数 ====================
-def _evaluate_single_completion(args: tuple) -> float:
+def _unpack_completion_task(args: tuple) -> tuple:
     """
-    并行worker函数：评估单个completion的reward
-    
-    Args:
-        args: (completion_text, state_path, scenario, tl_id, sumocfg, task_type, ..., port)
-    
-    Returns:
-        float: 该completion的reward
+    统一 completion 任务元组格式：兼容 14/15/16 元组（max_extend_sec / port 可选），返回 16 元组。
     """
-    # 解包参数，最后一个是 port（可选）
     if len(args) == 16:
-        (completion_text, state_path, scenario, tl_id, sumocfg,
-         task_type, phase_ids, decision_lead_sec, decision_remaining_sec,
-         wait_time, phase_order, phase_limits, current_elapsed,
-         tls_phase_durations, max_extend_sec, port) = args
-    elif len(args) == 15:
-        (completion_text, state_path, scenario, tl_id, sumocfg,
-         task_type, phase_ids, decision_lead_sec, decision_remaining_sec,
-         wait_time, phase_order, phase_limits, current_elapsed,
-         tls_phase_durations, max_extend_sec) = args
-        port = None
-    else:
-        (completion_text, state_path, scenario, tl_id, sumocfg,
-         task_type, phase_ids, decision_lead_sec, decision_remaining_sec,
-         wait_time, phase_order, phase_limits, current_elapsed,
-         tls_phase_durations) = args
-        max_extend_sec = None
-        port = None
-
-    invalid = float(REWARD_CONFIG["invalid_output_reward"])
-    try:
-        # 创建独立的simulator实例
-        simulator = SUMOSimulator(
-            config_file=sumocfg,
-            junctions_file=None,
-            gui=False,  # 并行worker强制关闭GUI
-            additional_options=['--device.rerouting.probability', '0'],
-            verbose=False,
-            port=port,  # 使用分配的固定端口
-        )
-        
-        if not simulator.start_simulation():
-            return invalid
-        
-        # 恢复SUMO state
-        if not os.path.exists(state_path):
-            simulator.close()
-            return invalid
-        
-        simulator.restore_simulation_state(state_path)
-        
-        # 根据task_type计算reward
-        if task_type == "signal_step":
-            action, _reason = parse_output(completion_text, "signal_step", debug=True)
-            if not action:
-                simulator.close()
-                return invalid
-            result = score_signal_step(
-                simulator,
-                tl_id,
-                action,
-                phase_ids=phase_ids,
-                decision_lead_sec=int(decision_lead_sec),
-                decision_remaining_sec=decision_remaining_sec,
-                tls_phase_durations=tls_phase_durations,
-            )
-            simulator.close()
-            return float(result["reward"])
-        
-        elif task_type == "extend_decision":
-            action, _reason = parse_output(completion_text, "extend_decision", debug=True)
-            if not action:
-                simulator.close()
-                return invalid
-            result = score_extend_decision(
-                simulator,
-                tl_id,
-                action,
-                phase_limits=phase_limits,
-                wait_time_for_phase_change=int(wait_time or 0),
-                current_elapsed_sec=current_elapsed,
-                tls_phase_durations=tls_phase_durations,
-                max_extend_sec=max_extend_sec,
-            )
-            simulator.close()
-            return float(result["reward"])
-        
-        else:
-            # 旧任务类型（cycle_predict等）
-            simulator.close()
-            return invalid
-    
-    except Exception as e:
-        print(f"评估失败 [{scenario}/{tl_id}]: {e}")
+        return tuple(args)
+    if len(args) == 15:
+        return tuple(args) + (None,)
+    # 兼容旧格式（无 max_extend_sec 和 port 参数）
+    return tuple(args) + (None, None)
+
+
+def _completion_window_estimate(task: tuple) -> float:
+    """completion 尚未解析时的仿真窗口估计：cycle_predict 为各相位 (min_green + max_green) / 2 之和，其余为 sched_default_window_sec"""
+    default = float(REWARD_CONFIG.get("sched_default_window_sec", 30))
+    if task[5] in ("signal_step", "extend_decision"):
+        return default
+    phase_order, phase_limits = task[10], task[11]
+    if not phase_order or not isinstance(phase_limits, dict):
+        return default
+    total = 0.0
+    for pid in phase_order:
+        lim = phase_limits.get(str(pid)) or {}
         try:
-            simulator.close()
-        except:
-            pass
-        return invalid
+            total += (float(lim["min_green"]) + float(lim["max_green"])) / 2.0
+        except (KeyError, TypeError, ValueError):
+            total += default
+    return total or default
 
 
-# Diagnostics-friendly worker: returns (reward, reason_code)
-# args tuple now includes a `port` field at the end for fixed port assignment
-def _evaluate_single_completion_diag(args: tuple) -> tuple[float, str]:
-    # 解包参数，最后一个是 port（可选）
-    if len(args) == 16:
-        (completion_text, state_path, scenario, tl_id, sumocfg,
-         task_type, phase_ids, decision_lead_sec, decision_remaining_sec,
-         wait_time, phase_order, phase_limits, current_elapsed,
-         tls_phase_durations, max_extend_sec, port) = args
-    elif len(args) == 15:
-        (completion_text, state_path, scenario, tl_id, sumocfg,
-         task_type, phase_ids, decision_lead_sec, decision_remaining_sec,
-         wait_time, phase_order, phase_limits, current_elapsed,
-         tls_phase_durations, max_extend_sec) = args
-        port = None
-    else:
-        # 兼容旧格式（无 max_extend_sec 和 port 参数）
-        (completion_text, state_path, scenario, tl_id, sumocfg,
-         task_type, phase_ids, decision_lead_sec, decision_remaining_sec,
-         wait_time, phase_order, phase_limits, current_elapsed,
-         tls_phase_durations) = args
-        max_extend_sec = None
-        port = None
+def _completion_job_profile(job: List[tuple]) -> JobProfile:
+    """调度属性：completion 尚未解析，窗口长度按 _completion_window_estimate 估计"""
+    tasks = [_unpack_completion_task(args) for args in job]
+    window = sum(_completion_window_estimate(t) for t in tasks)
+    task = tasks[0]
+    return JobProfile(str(task[4]), str(task[1]), str(task[2]), job_work(task[1], window))
 
-    invalid = float(REWARD_CONFIG["invalid_output_reward"])
-    try:
-        if port is None:
-            port = _get_worker_port()
-        simulator = SUMOSimulator(
-            config_file=sumocfg,
-            junctions_file=None,
-            gui=False,
-            additional_options=['--device.rerouting.probability', '0'],
-            verbose=False,
-            port=port,  # 使用分配的固定端口
+
+def _completion_job_labels(job: List[tuple]) -> tuple:
+    """阶段耗时的汇总键：(场景, 任务类型)"""
+    task = _unpack_completion_task(job[0])
+    return task[2], task[5]
+
+
+def _completion_job_failed(job: List[tuple], reason: str) -> List[tuple[float, str]]:
+    """超时/异常的任务：组内每个 completion 记 (invalid_output_reward, reason)"""
+    return [(float(REWARD_CONFIG["invalid_output_reward"]), reason)] * len(job)
+
+
+def _score_completion_diag(simulator: SUMOSimulator, task: tuple, action: Dict[str, Any]) -> tuple[float, str]:
+    """在已恢复 state 的 simulator 上对已解析的 completion 打分。Returns (reward, reason)。"""
+    (_completion_text, _state_path, _scenario, tl_id, _sumocfg,
+     task_type, phase_ids, decision_lead_sec, decision_remaining_sec,
+     wait_time, _phase_order, phase_limits, current_elapsed,
+     tls_phase_durations, max_extend_sec, _port) = task
+    topology = _resolve_tl_topology(simulator, _sumocfg, tl_id)
+
+    if task_type == "signal_step":
+        result = score_signal_step(
+            simulator,
+            tl_id,
+            action,
+            phase_ids=phase_ids,
+            decision_lead_sec=int(decision_lead_sec),
+            decision_remaining_sec=decision_remaining_sec,
+            tls_phase_durations=tls_phase_durations,
+            topology=topology,
         )
-        if not simulator.start_simulation():
-            return invalid, "start_simulation_failed"
+        return float(result["reward"]), str(result["reason"])
 
-        if not os.path.exists(state_path):
-            simulator.close()
-            return invalid, "state_path_missing"
+    result = score_extend_decision(
+        simulator,
+        tl_id,
+        action,
+        phase_limits=phase_limits,
+        wait_time_for_phase_change=int(wait_time or 0),
+        current_elapsed_sec=current_elapsed,
+        tls_phase_durations=tls_phase_durations,
+        max_extend_sec=max_extend_sec,
+        topology=topology,
+    )
+    return float(result["reward"]), str(result["reason"])
 
-        simulator.restore_simulation_state(state_path)
 
-        if task_type == "signal_step":
-            action, reason = parse_output(completion_text, "signal_step", debug=True)
-            if not action:
-                simulator.close()
-                return invalid, reason
-            result = score_signal_step(
-                simulator,
-                tl_id,
-                action,
-                phase_ids=phase_ids,
-                decision_lead_sec=int(decision_lead_sec),
-                decision_remaining_sec=decision_remaining_sec,
-                tls_phase_durations=tls_phase_durations,
-            )
-            simulator.close()
-            return float(result["reward"]), str(result["reason"])
+# cycle_predict 在 worker 内只仿真、不打分：返回 (constraint_score, _CYCLE_PREDICT_SIM, sim_result)，
+# 由主进程按 tl_id 更新 AdaptiveScaler 后计算 reward（见 _merge_cycle_predict_results）
+_CYCLE_PREDICT_SIM = "cycle_predict_sim"
+
 
-        if task_type == "extend_decision":
-            action, reason = parse_output(completion_text, "extend_decision", debug=True)
+def _evaluate_completion_group_diag(group: List[tuple]) -> List[tuple]:
+    """
+    Diagnostics-friendly worker（组模式）：一组共享同一 sumocfg/state_path 的 completion。
+    先解析（解析失败不触碰 SUMO），只获取一次 simulator，completion 之间在进程内重新 loadState。
+    Returns [(reward, reason_code), ...]；cycle_predict 仿真成功时为 (constraint_score, _CYCLE_PREDICT_SIM, sim_result)。
+    """
+    invalid = float(REWARD_CONFIG["invalid_output_reward"])
+    results: List[tuple] = []
+    simulator = None
+    held_sumocfg = None
+    for args in group:
+        task = _unpack_completion_task(args)
+        completion_text, state_path, scenario, tl_id, sumocfg, task_type = task[:6]
+        port = task[15]
+
+        constraint_score = None
+        if task_type in ("signal_step", "extend_decision"):
+            action, reason = parse_output(completion_text, task_type, debug=True)
             if not action:
-                simulator.close()
-                return invalid, reason
-            result = score_extend_decision(
-                simulator,
-                tl_id,
-                action,
-                phase_limits=phase_limits,
-                wait_time_for_phase_change=int(wait_time or 0),
-                current_elapsed_sec=current_elapsed,
-                tls_phase_durations=tls_phase_durations,
-                max_extend_sec=max_extend_sec,
+                results.append((invalid, reason))
+                continue
+        else:
+            # 旧任务 cycle_predict：格式 / 相位顺序等硬约束不通过时不触碰 SUMO
+            constraint_score, info, action = score_constraints_and_format(
+                completion_text=completion_text,
+                phase_order=task[10],
+                phase_limits=task[11],
+                D0=REWARD_CONFIG.get('D0', 30.0),
             )
-            simulator.close()
-            return float(result["reward"]), str(result["reason"])
-
-        simulator.close()
-        return invalid, "unsupported_task_type"
+            if action is None:
+                reward = compute_total_reward(
+                    constraint_score=constraint_score,
+                    sim_reward=0.0,
+                    w_sim=REWARD_CONFIG['w_sim'],
+                    w_constraint=REWARD_CONFIG['w_constraint'],
+                )
+                results.append((float(reward), f"cycle_predict_hard_constraint:{info.get('error')}"))
+                continue
 
-    except Exception as e:
-        print(f"评估失败 [{scenario}/{tl_id}]: {e}")
         try:
-            simulator.close()
-        except Exception:
-            pass
-        return invalid, "exception"
+            if simulator is not None and sumocfg != held_sumocfg:
+                _release_worker_simulator(held_sumocfg, simulator)
+                simulator = None
+            if simulator is None:
+                simulator, reason = _acquire_worker_simulator(sumocfg, state_path, port)
+                held_sumocfg = sumocfg
+                if simulator is None:
+                    results.append((invalid, reason))
+                    continue
+            else:
+                _reload_worker_state(simulator, state_path)
+            if constraint_score is None:
+                results.append(_score_completion_diag(simulator, task, action))
+            else:
+                topology = _resolve_tl_topology(simulator, sumocfg, tl_id)
+                sim_result = evaluate_plan_once_reward_fn(simulator, tl_id, action, topology=topology)
+                results.append((float(constraint_score), _CYCLE_PREDICT_SIM, sim_result))
+        except Exception as e:
+            print(f"评估失败 [{scenario}/{tl_id}]: {e}")
+            _release_worker_simulator(held_sumocfg, simulator, broken=True)
+            simulator = None
+            results.append((invalid, "exception"))
+    _release_worker_simulator(held_sumocfg, simulator)
+    return results
+
+
+def _merge_cycle_predict_results(rows: List[tuple]) -> Dict[int, float]:
+    """
+    并行模式的 cycle_predict：rows 为 (completion 下标, tl_id, constraint_score, sim_result)，按 completion 顺序。
+    worker 只返回原始指标；这里按 tl_id 依次并入主进程的 AdaptiveScaler 再打分，与顺序模式的更新顺序相同。
+    Returns {completion 下标: total_reward}。
+    """
+    by_tl: Dict[str, List[tuple]] = OrderedDict()
+    for row in rows:
+        by_tl.setdefault(row[1], []).append(row)
+    out: Dict[int, float] = {}
+    for tl_id, items in by_tl.items():
+        sim_rewards = compute_sim_rewards_adaptive(
+            [sim_result for _idx, _tl_id, _score, sim_result in items],
+            _GLOBAL_POOL.get_scaler(tl_id),
+            w_passed=REWARD_CONFIG['w_passed'],
+            w_queue=REWARD_CONFIG['w_queue'],
+            w_proxy=REWARD_CONFIG['w_proxy'],
+            observe=True,
+        )
+        for (idx, _tl_id, constraint_score, _sim_result), sim_reward in zip(items, sim_rewards.tolist()):
+            out[idx] = float(compute_total_reward(
+                constraint_score=constraint_score,
+                sim_reward=sim_reward,
+                w_sim=REWARD_CONFIG['w_sim'],
+                w_constraint=REWARD_CONFIG['w_constraint'],
+            ))
+    return out
 
 
 # ==================== 主 Reward 函数 ====================
@@ -1909,6 +4039,7 @@ def tsc_reward_fn(
     phase_lane_maps = kwargs.get('phase_lane_map', [])
     decision_lead_secs = kwargs.get('decision_lead_sec', [])
     wait_times = kwargs.get('wait_time_for_phase_change', [])
+    max_extend_secs = kwargs.get('max_extend_sec', [])
     
     if not state_paths:
         raise ValueError("reward_fn 需要 state_path 字段")
@@ -1977,6 +4108,7 @@ def tsc_reward_fn(
     if REWARD_CONFIG['parallel_workers'] > 0 and len(completion_texts) > 1:
         # 准备并行任务参数
         tasks = []
+        skipped: Dict[int, str] = {}  # 未提交的 completion -> reason
         for i in range(len(completion_texts)):
             # 如果 state_paths 按 completion 展开，直接用 i；否则按组索引
             sample_idx = i if state_paths_expanded else (i // num_generations)
@@ -2010,6 +4142,7 @@ def tsc_reward_fn(
             
             if not sumocfg:
                 tasks.append(None)  # 标记为无效任务
+                skipped[i] = "sumocfg_missing"
                 continue
             
             # phase_order和phase_limits只在某些任务类型中需要
@@ -2048,10 +4181,24 @@ def tsc_reward_fn(
                     current_elapsed = elapsed_list[sample_idx]
                 if tls_durs_list and sample_idx < len(tls_durs_list):
                     tls_phase_durations = tls_durs_list[sample_idx]
+            else:
+                # 旧任务 cycle_predict：需要 phase_order 和 phase_limits
+                if not (phase_orders and sample_idx < len(phase_orders)):
+                    tasks.append(None)
+                    skipped[i] = "cycle_predict_phase_order_missing"
+                    continue
+                if not (phase_limits_list and sample_idx < len(phase_limits_list)):
+                    tasks.append(None)
+                    skipped[i] = "cycle_predict_phase_limits_missing"
+                    continue
+                phase_order = phase_orders[sample_idx]
+                phase_limits = phase_limits_list[sample_idx]
             
-            # 提取 max_extend_sec
-            prompt_messages = prompts[sample_idx] if sample_idx < len(prompts) else None
-            max_extend_sec = _extract_max_extend_sec_from_prompt(prompt_messages) if isinstance(prompt_messages, list) else None
+            # max_extend_sec: 优先 dataset 列；否则从 prompt 提取
+            max_extend_sec = _column_value(max_extend_secs, sample_idx)
+            if max_extend_sec is None:
+                prompt_messages = prompts[sample_idx] if sample_idx < len(prompts) else None
+                max_extend_sec = _extract_max_extend_sec_from_prompt(prompt_messages) if isinstance(prompt_messages, list) else None
             
             tasks.append((
                 completion_text, state_path, scenario, tl_id, sumocfg,
@@ -2079,19 +4226,45 @@ def tsc_reward_fn(
                     valid_tasks.append(task)
                     valid_indices.append(i)
             
+            # group 模式：同一 (sumocfg, state_path) 的 completion 合并为一个任务
+            if str(REWARD_CONFIG.get("reward_dispatch_mode", "completion")) == "group":
+                groups = _group_task_indices(valid_tasks, lambda t: (t[4], t[1]))
+            else:
+                groups = [[i] for i in range(len(valid_tasks))]
+            jobs = [[valid_tasks[i] for i in idxs] for idxs in groups]
+
             # 使用 map 并行执行所有有效任务（返回 (reward, reason)）
             try:
-                results = pool.map(_evaluate_single_completion_diag, valid_tasks, chunksize=1)
+                grouped_results = _dispatch_reward_jobs(
+                    pool,
+                    _evaluate_completion_group_diag,
+                    jobs,
+                    _completion_job_profile,
+                    _completion_job_failed,
+                    _completion_job_labels,
+                )
+                _record_pool_step(pool, kwargs)
+                results = _scatter_group_results(groups, grouped_results, len(valid_tasks))
             except Exception as e:
                 print(f"[错误] 进程池 map 失败: {e}")
                 results = [(invalid_reward, "parallel_exception")] * len(valid_tasks)
             
             # 组装最终结果
             final_rewards = [invalid_reward] * len(tasks)
-            final_reasons = ["sumocfg_missing" if task is None else "unknown" for task in tasks]
-            for idx, (reward, reason) in zip(valid_indices, results):
-                final_rewards[idx] = float(reward)
-                final_reasons[idx] = str(reason)
+            final_reasons = [skipped.get(i, "unknown") for i in range(len(tasks))]
+            cycle_rows = []
+            for idx, res in zip(valid_indices, results):
+                if res[1] == _CYCLE_PREDICT_SIM:
+                    cycle_rows.append((idx, tasks[idx][3], res[0], res[2]))
+                    final_reasons[idx] = "ok"
+                    continue
+                final_rewards[idx] = float(res[0])
+                final_reasons[idx] = str(res[1])
+            # cycle_predict：worker 返回的原始指标在主进程并入各路口 scaler 后打分
+            if cycle_rows:
+                for idx, reward in _merge_cycle_predict_results(cycle_rows).items():
+                    final_rewards[idx] = reward
+                _GLOBAL_POOL.save_scalers()
 
             # Diagnostics (parallel mode: has reasons via diag worker)
             try:
@@ -2217,6 +4390,11 @@ def tsc_reward_fn(
                 continue
             
             simulator.restore_simulation_state(state_path)
+            topologies = kwargs.get('tl_topology', [])
+            topology = _resolve_tl_topology(
+                simulator, sumocfg, tl_id,
+                topologies[sample_idx] if topologies and sample_idx < len(topologies) else None,
+            )
 
             if task_type in ("signal_step", "extend_decision"):
                 if task_type == "signal_step":
@@ -2244,6 +4422,7 @@ def tsc_reward_fn(
                         decision_lead_sec=int(decision_lead_sec),
                         decision_remaining_sec=decision_rem,
                         tls_phase_durations=tls_durs,
+                        topology=topology,
                     )
                     rewards.append(float(result["reward"]))
                     reasons.append(str(result["reason"]))
@@ -2271,9 +4450,11 @@ def tsc_reward_fn(
                         if isinstance(prompt_messages, list):
                             phase_limits = _extract_phase_limits_from_prompt(prompt_messages)
 
-                    # 提取 max_extend_sec
-                    prompt_messages = prompts[sample_idx] if sample_idx < len(prompts) else None
-                    max_extend_sec = _extract_max_extend_sec_from_prompt(prompt_messages) if isinstance(prompt_messages, list) else None
+                    # max_extend_sec: 优先 dataset 列；否则从 prompt 提取
+                    max_extend_sec = _column_value(max_extend_secs, sample_idx)
+                    if max_extend_sec is None:
+                        prompt_messages = prompts[sample_idx] if sample_idx < len(prompts) else None
+                        max_extend_sec = _extract_max_extend_sec_from_prompt(prompt_messages) if isinstance(prompt_messages, list) else None
 
                     result = score_extend_decision(
                         simulator,
@@ -2284,6 +4465,7 @@ def tsc_reward_fn(
                         current_elapsed_sec=elapsed,
                         tls_phase_durations=tls_durs,
                         max_extend_sec=max_extend_sec,
+                        topology=topology,
                     )
                     rewards.append(float(result["reward"]))
                     reasons.append(str(result["reason"]))
@@ -2309,7 +4491,7 @@ def tsc_reward_fn(
                 completion_text=completion_text,
                 phase_order=phase_order,
                 phase_limits=phase_limits,
-                D0=REWARD_CONFIG['D0'],
+                D0=REWARD_CONFIG.get('D0', 30.0),
             )
 
             if plan is None:
@@ -2323,7 +4505,7 @@ def tsc_reward_fn(
                 reasons.append(f"cycle_predict_hard_constraint:{info.get('error')}")
                 continue
 
-            sim_result = evaluate_plan_once_reward_fn(simulator, tl_id, plan)
+            sim_result = evaluate_plan_once_reward_fn(simulator, tl_id, plan, topology=topology)
 
             scaler.add_observation(
                 passed=sim_result['passed_vehicles'],
@@ -2357,6 +4539,8 @@ def tsc_reward_fn(
             rewards.append(float(REWARD_CONFIG['invalid_output_reward']))
             reasons.append("exception")
 
+    _GLOBAL_POOL.save_scalers()
+
     # Diagnostics aggregation (sequential mode)
     try:
         invalid_value = float(REWARD_CONFIG["invalid_output_reward"])
@@ -2421,6 +4605,157 @@ def cleanup_global_pool():
     _cleanup_mp_pool()
 
 
+# ==================== OpenMetrics 导出 ====================
+_METRICS_EXPORTER: Union[MetricsExporter, None] = None
+_TRAIN_METRICS: Dict[str, Any] = {}  # 最近一次 on_log 的训练指标，整体替换（无锁）
+
+
+def record_train_metrics(global_step: int, logs: Dict[str, Any]):
+    """记录训练日志中的数值指标（loss / kl / reward 等），随 reward 诊断一起导出为 tsc_train_* gauge"""
+    global _TRAIN_METRICS
+    values = {}
+    for k, v in (logs or {}).items():
+        try:
+            values[str(k)] = float(v)
+        except (TypeError, ValueError):
+            continue
+    _TRAIN_METRICS = {"global_step": float(global_step), "logs": values}
+
+
+def _diag_cumulative() -> Dict[str, Any]:
+    """累计诊断计数 = 已 reset 的窗口之和 + 当前窗口（调用方持有 _DIAG_TOTALS_LOCK）"""
+    out: Dict[str, Any] = {k: int(_REWARD_DIAG_TOTALS[k]) + int(_REWARD_DIAG.get(k, 0)) for k in _DIAG_COUNTER_KEYS}
+    for key in ("window_total_by_task", "window_invalid_by_task"):
+        out[key] = Counter(_REWARD_DIAG_TOTALS[key]) + Counter(dict(_REWARD_DIAG.get(key, {})))
+    reasons: Dict[str, Counter] = {task: Counter(c) for task, c in _REWARD_DIAG_TOTALS["window_reason_by_task"].items()}
+    for task, c in list(_REWARD_DIAG.get("window_reason_by_task", {}).items()):
+        reasons.setdefault(task, Counter()).update(dict(c))
+    out["window_reason_by_task"] = reasons
+    return out
+
+
+def _metric_families() -> List[MetricFamily]:
+    with _DIAG_TOTALS_LOCK:
+        diag = _diag_cumulative()
+    fams: List[MetricFamily] = []
+
+    def fam(name: str, kind: str, help_text: str, samples: List[Sample]):
+        fams.append(MetricFamily(name, kind, help_text, samples))
+
+    total_by_task = diag["window_total_by_task"]
+    invalid_by_task = diag["window_invalid_by_task"]
+    fam("tsc_reward_completions", "counter", "Scored completions by task type",
+        [Sample("_total", {"task_type": t}, n) for t, n in sorted(total_by_task.items())])
+    fam("tsc_reward_invalid", "counter", "Completions given the invalid-output reward by task type",
+        [Sample("_total", {"task_type": t}, invalid_by_task.get(t, 0)) for t in sorted(total_by_task)])
+    fam("tsc_reward_invalid_ratio", "gauge", "Invalid completions / scored completions since start, by task type",
+        [Sample("", {"task_type": t}, invalid_by_task.get(t, 0) / n) for t, n in sorted(total_by_task.items()) if n])
+    fam("tsc_reward_reasons", "counter", "Reward reasons by task type",
+        [Sample("_total", {"task_type": t, "reason": r}, n)
+         for t, c in sorted(diag["window_reason_by_task"].items()) for r, n in sorted(c.items())])
+    fam("tsc_reward_sim_tasks", "counter", "Validated actions needing simulation (tsc_reward_sim_fn)",
+        [Sample("_total", {}, diag["window_sim_tasks"])])
+    fam("tsc_reward_sim_unique_tasks", "counter", "Actions actually submitted for simulation after dedup",
+        [Sample("_total", {}, diag["window_sim_unique_tasks"])])
+    fam("tsc_reward_table_hits", "counter", "Offline reward-table hits",
+        [Sample("_total", {}, diag["window_table_hits"])])
+
+    cache = rollout_cache_stats()
+    if cache:
+        for k in ("hits", "misses", "writes"):
+            fam(f"tsc_reward_rollout_cache_{k}", "counter", f"Rollout metrics cache {k}", [Sample("_total", {}, cache[k])])
+        fam("tsc_reward_rollout_cache_hit_ratio", "gauge", "Rollout metrics cache hit ratio since start",
+            [Sample("", {}, cache["hit_rate"])])
+
+    sched = reward_scheduler_stats() or {}
+    for k in ("jobs", "affinity_hits", "steals", "hedges", "failures"):
+        if k in sched:
+            fam(f"tsc_reward_scheduler_{k}", "counter", f"AffinityScheduler {k}", [Sample("_total", {}, sched[k])])
+    pool = sched.get("pool") or {}
+    for k in ("started", "retired", "timeouts", "recycled", "killed_sumo"):
+        if k in pool:
+            fam(f"tsc_reward_pool_{k}", "counter", f"Worker pool {k}", [Sample("_total", {}, pool[k])])
+    for k, name in (("busy_sec", "busy_seconds"), ("slot_sec", "slot_seconds")):
+        if k in pool:
+            fam(f"tsc_reward_pool_{name}", "counter", f"Worker pool {name.replace('_', ' ')}", [Sample("_total", {}, pool[k])])
+    for k in ("workers", "running", "utilisation", "idle_fraction"):
+        if pool.get(k) is not None:
+            fam(f"tsc_reward_pool_{k}", "gauge", f"Worker pool {k} (last dispatch)", [Sample("", {}, pool[k])])
+    if pool.get("slot_utilisation"):
+        fam("tsc_reward_pool_slot_utilisation", "gauge", "Busy seconds / wall seconds per worker slot (last dispatch)",
+            [Sample("", {"slot": str(i)}, u) for i, u in enumerate(pool["slot_utilisation"])])
+
+    if _RESOURCE_SAMPLER is not None:
+        res = _RESOURCE_SAMPLER.snapshot()
+        slots = res.get("slots") or {}
+        fam("tsc_reward_worker_memory_bytes", "gauge", "Memory (PSS, else RSS) per worker slot",
+            [Sample("", {"slot": str(slot), "process": kind}, v[f"{kind}_mb"] * 2 ** 20)
+             for slot, v in slots.items() for kind in ("worker", "sumo")])
+        fam("tsc_reward_worker_cpu_utilisation", "gauge", "CPU seconds / wall seconds per worker slot (diagnostics window)",
+            [Sample("", {"slot": str(slot)}, v["cpu_util"]) for slot, v in slots.items()])
+        fam("tsc_reward_worker_threads", "gauge", "Threads of worker + SUMO processes per slot",
+            [Sample("", {"slot": str(slot)}, v["threads"]) for slot, v in slots.items()])
+        fam("tsc_reward_worker_open_fds", "gauge", "Open fds of worker + SUMO processes per slot",
+            [Sample("", {"slot": str(slot)}, v["fds"]) for slot, v in slots.items()])
+        fam("tsc_reward_scenario_peak_memory_bytes", "gauge", "Peak worker + SUMO memory while running a scenario (diagnostics window)",
+            [Sample("", {"scenario": sc}, mb * 2 ** 20) for sc, mb in (res.get("scenario_peak_mb") or {}).items()])
+        if res.get("worker_mem_mb") is not None:
+            fam("tsc_reward_worker_memory_estimate_bytes", "gauge", "Per-worker memory used for pool sizing",
+                [Sample("", {}, res["worker_mem_mb"] * 2 ** 20)])
+
+    stages = _REWARD_DIAG["window_stage_profile"].snapshot(cumulative=True)
+    samples = []
+    for key, per_stage in stages.items():
+        scenario, task_type = key.rsplit("/", 1)
+        for stage, st in per_stage.items():
+            labels = {"scenario": scenario, "task_type": task_type, "stage": stage}
+            for q in ("p50", "p95", "p99"):
+                samples.append(Sample("", {**labels, "quantile": str(int(q[1:]) / 100.0)}, st[q]))
+            samples.append(Sample("_sum", labels, st["sum"]))
+            samples.append(Sample("_count", labels, st["n"]))
+    fam("tsc_reward_stage_seconds", "summary", "Per-job seconds spent in each reward worker stage", samples)
+
+    train = _TRAIN_METRICS
+    if train:
+        fam("tsc_train_global_step", "gauge", "Trainer global step at the last log event", [Sample("", {}, train["global_step"])])
+        fam("tsc_train_metric", "gauge", "Numeric trainer log values at the last log event",
+            [Sample("", {"name": metric_name(k)}, v) for k, v in sorted(train["logs"].items())])
+    return fams
+
+
+def reward_metrics_text() -> str:
+    """当前 reward / 训练诊断的 OpenMetrics 文本（计数为自启动以来的累计值）"""
+    return render(_metric_families())
+
+
+def start_metrics_exporter() -> Union[MetricsExporter, None]:
+    """按 metrics_http_port / metrics_textfile 启动 OpenMetrics 导出（已启动或均未配置时直接返回）"""
+    global _METRICS_EXPORTER
+    if _METRICS_EXPORTER is not None:
+        return _METRICS_EXPORTER
+    port = REWARD_CONFIG.get("metrics_http_port")
+    textfile = REWARD_CONFIG.get("metrics_textfile")
+    if port is None and not textfile:
+        return None
+    exporter = MetricsExporter(
+        reward_metrics_text,
+        http_port=port,
+        host=str(REWARD_CONFIG.get("metrics_http_host", "127.0.0.1")),
+        textfile=textfile,
+        interval_sec=float(REWARD_CONFIG.get("metrics_interval_sec", 15)),
+    )
+    try:
+        exporter.start()
+    except OSError as e:
+        print(f"[tsc_reward_function] OpenMetrics 导出启动失败: {e}")
+        return None
+    _METRICS_EXPORTER = exporter
+    atexit.register(exporter.stop)
+    where = [f"http://{exporter.address[0]}:{exporter.address[1]}/metrics"] if exporter.address else []
+    where += [textfile] if textfile else []
+    print(f"[tsc_reward_function] OpenMetrics 导出: {', '.join(where)}")
+    return exporter
+
 # ==================== 测试代码 ====================
 if __name__ == '__main__':
     # 简单测试